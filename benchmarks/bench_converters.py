@@ -0,0 +1,39 @@
+"""Time the conversion of many gtar records through `Cache.query`.
+
+Usage::
+
+    python benchmarks/bench_converters.py [num_frames] [repeats]
+
+"""
+import os
+import sys
+import tempfile
+import timeit
+
+import gtar
+import numpy as np
+
+import pyqaxe as pyq
+from pyqaxe.mines.gtar import GTAR
+
+def main(num_frames=20000, repeats=3):
+    with tempfile.TemporaryDirectory() as dirname:
+        with gtar.GTAR(os.path.join(dirname, 'test.zip'), 'w') as traj:
+            for frame in range(num_frames):
+                traj.writePath('frames/{}/position.f32.ind'.format(frame),
+                               np.zeros((4, 3), dtype=np.float32))
+
+        cache = pyq.Cache()
+        cache.index(pyq.mines.Directory(dirname))
+        cache.index(GTAR())
+
+        def run():
+            for (data,) in cache.query('SELECT data FROM gtar_records'):
+                pass
+
+        best = min(timeit.repeat(run, number=1, repeat=repeats))
+        print('{} records: {:.3f} s ({:.1f} us/record)'.format(
+            num_frames, best, best/num_frames*1e6))
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
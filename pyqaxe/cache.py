@@ -1,17 +1,129 @@
+import collections
+import concurrent.futures
+import contextlib
 import datetime
+import io
 import logging
+import mmap
 import os
 import pickle
 import shutil
 import sqlite3
 import tempfile
+import threading
+import time
 import urllib, urllib.parse
 import uuid
 import weakref
 
 logger = logging.getLogger(__name__)
 
-from .util import LRU_Cache
+from .util import (
+    BatchWriter, ExtractionDirectory, LRU_Cache, conversion_deferred,
+    deferred_conversion, resolve_row)
+
+class ThreadConnection_:
+    """Database connection owned by a single thread, which is closed
+    once the thread's local storage is discarded (i.e. the thread
+    exits)."""
+    __slots__ = ('connection', '__weakref__')
+
+    def __init__(self, connection, connections, lock):
+        self.connection = connection
+        weakref.finalize(self, self.close_, connection, connections, lock)
+
+    @staticmethod
+    def close_(connection, connections, lock):
+        with lock:
+            try:
+                connections.remove(connection)
+            except ValueError:
+                # already closed by Cache.close()
+                return
+        connection.close()
+
+class SharedCursor_:
+    """Cursor of a :py:class:`SharedConnection_`, which fetches rows
+    while holding the connection's lock.
+
+    Values are converted after the lock is released (unless
+    conversion is deferred by the caller), since converters may need
+    to wait for other threads that use the connection.
+
+    """
+    def __init__(self, cursor, lock):
+        self.cursor = cursor
+        self.lock_ = lock
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        deferred = conversion_deferred()
+        with self.lock_, deferred_conversion():
+            row = next(self.cursor)
+        return row if deferred else resolve_row(row)
+
+    def fetchone(self):
+        try:
+            return next(self)
+        except StopIteration:
+            return None
+
+    def fetchmany(self, *args):
+        return self.fetchall_(self.cursor.fetchmany, *args)
+
+    def fetchall(self):
+        return self.fetchall_(self.cursor.fetchall)
+
+    def fetchall_(self, method, *args):
+        deferred = conversion_deferred()
+        with self.lock_, deferred_conversion():
+            rows = method(*args)
+        return rows if deferred else [resolve_row(row) for row in rows]
+
+class SharedConnection_:
+    """Connection shared by several threads (i.e. to an in-memory
+    database), which runs each statement, fetch, and commit of the
+    underlying connection while holding a lock."""
+    def __init__(self, connection):
+        self.connection = connection
+        self.lock_ = threading.RLock()
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+    def execute(self, *args, **kwargs):
+        with self.lock_:
+            return SharedCursor_(self.connection.execute(*args, **kwargs), self.lock_)
+
+    def executemany(self, *args, **kwargs):
+        with self.lock_:
+            return SharedCursor_(self.connection.executemany(*args, **kwargs), self.lock_)
+
+    def executescript(self, *args, **kwargs):
+        with self.lock_:
+            return SharedCursor_(self.connection.executescript(*args, **kwargs), self.lock_)
+
+    def commit(self):
+        with self.lock_:
+            self.connection.commit()
+
+    def rollback(self):
+        with self.lock_:
+            self.connection.rollback()
+
+    def __enter__(self):
+        with self.lock_:
+            self.connection.__enter__()
+        return self
+
+    def __exit__(self, *args):
+        with self.lock_:
+            return self.connection.__exit__(*args)
 
 class Cache:
     """A queryable cache of data found in one or more datasets
@@ -34,6 +146,35 @@ class Cache:
     modifications to the underlying database. Data can be selected
     from read-only databases, but indexing mines will not work.
 
+    On-disk caches can be opened with `journal='wal'` to use sqlite's
+    write-ahead log. In this mode, other processes can open the same
+    file (for example, with `read_only=True`) and run queries while a
+    mine is being indexed. Indexing commits its progress every
+    `commit_interval` seconds (by default, every 10 seconds in WAL
+    mode and only at the end of indexing otherwise) so that readers
+    see the data indexed so far. Note that periodic commits mean
+    that an interrupted index keeps the rows it has already
+    committed; re-index the mine with `force=True` to complete it.
+
+    Caches can be used from multiple threads. Each thread is given
+    its own connection to an on-disk database (in-memory databases
+    share a single connection between threads, which is used by one
+    thread at a time), and mines with a `register(cache, conn,
+    mine_id)` method use it to register any functions or collations
+    they need with each connection as it is created. Opened files are shared between threads;
+    :py:meth:`pinned_file` can be used to keep a file from being
+    closed while it is in use.
+
+    Files found inside other files (i.e. archive members) must be
+    copied to a temporary file when a reader requires a real file on
+    disk. By default, these copies are deleted when the file is
+    closed. If `extract_dir` is given, they are instead kept in that
+    directory, so they can be reused after the file is closed or the
+    cache is reopened, even by other processes. Copies are identified
+    by the cache, file, and modification time of the file, and the
+    least-recently-used copies are deleted when the directory grows
+    larger than `extract_bytes` bytes.
+
     Caches can be used as context managers. When the context exits,
     the cache (and all of its open file handles) will be closed
     automatically.
@@ -52,11 +193,33 @@ class Cache:
 
     - path: The path of the file being referenced
     - mine_id: Integer ID of the mine that provides the file
+    - update_time: The modification time of the file
+    - parent: Integer ID (files table rowid) of the file containing this file, if any
+    - suffix: Lowercase file extension (i.e. 'tar' or 'zip'), for fast lookups by file type
 
     """
     opened_caches_ = weakref.WeakValueDictionary()
 
-    def __init__(self, location=':memory:', read_only=False):
+    # number of rows to buffer per table in batch_writer
+    insert_chunk_size = 1024
+
+    # number of files table rows to remember in get_file_row
+    FILE_ROW_CACHE_SIZE = 1 << 16
+
+    # number of memory maps of files to keep for map_file
+    MAPPED_FILE_CACHE_SIZE = 16
+
+    # default number of seconds between commits while indexing in WAL mode
+    WAL_COMMIT_INTERVAL = 10
+
+    # default number of rows in each batch returned by iter_batches
+    QUERY_BATCH_SIZE = 1024
+
+    # default number of rows decoded ahead of time by query_prefetched
+    QUERY_PREFETCH = 16
+
+    def __init__(self, location=':memory:', read_only=False, journal=None,
+                 commit_interval=None, extract_dir=None, extract_bytes=None):
         self.location = location
 
         if location == ':memory:' and read_only:
@@ -66,11 +229,47 @@ class Cache:
         self.read_only = read_only
 
         query_string = '?mode=ro' if read_only else ''
-        location = 'file:{}{}'.format(urllib.parse.quote(location, safe=':/'), query_string)
-        self.connection_ = sqlite3.connect(
-            location, uri=True,
-            detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES)
-        self.opened_file_cache_ = LRU_Cache(self.open_file_, self.close_file_, 32)
+        self.uri_ = 'file:{}{}'.format(urllib.parse.quote(location, safe=':/'), query_string)
+        self.mines = {}
+        self.local_ = threading.local()
+        self.connections_ = []
+        self.connection_lock_ = threading.Lock()
+        # in-memory databases can't be opened more than once, so all
+        # threads share a single connection
+        self.shared_connection_ = None
+        # mines whose functions have been registered with the shared
+        # connection (or each thread's own connection, in local_)
+        self.shared_registered_mines_ = set()
+        # number of workers -> thread pool used by query_prefetched
+        self.decode_pools_ = {}
+        if location == ':memory:':
+            self.shared_connection_ = SharedConnection_(self.connect_())
+        else:
+            self.local_.connection = self.connect_thread_()
+        self.local_.registered_mines = set()
+
+        if journal is not None and not read_only and self.location != ':memory:':
+            self.set_journal_mode(journal)
+
+        if commit_interval is None and self.journal_mode == 'wal':
+            commit_interval = self.WAL_COMMIT_INTERVAL
+        self.commit_interval = commit_interval
+        self.last_commit_time_ = time.monotonic()
+
+        self.extraction_directory_ = None
+        if extract_dir is not None:
+            self.extraction_directory_ = ExtractionDirectory(extract_dir, extract_bytes)
+
+        self.opened_file_cache_ = LRU_Cache(
+            self.open_file_, self.close_file_, 32, sizer=self.file_size_)
+        # files table row -> mmap (or None, if the file can't be
+        # mapped); maps are closed by the garbage collector once no
+        # views of them remain
+        self.mapped_files_ = LRU_Cache(
+            self.map_file_, lambda mapped: None, self.MAPPED_FILE_CACHE_SIZE)
+        # incremented whenever the files table is modified through this
+        # cache, to discard the rows remembered by each thread
+        self.files_version_ = 0
 
         with self.connection_ as conn:
 
@@ -94,15 +293,90 @@ class Cache:
             conn.execute(
                 'CREATE TABLE IF NOT EXISTS files '
                 '(path TEXT, mine_id INTEGER, update_time TIMESTAMP, '
-                'parent INTEGER, CONSTRAINT unique_path '
+                'parent INTEGER, suffix TEXT, CONSTRAINT unique_path '
                 'UNIQUE (path, mine_id, parent) ON CONFLICT REPLACE)')
 
-            self.mines = {}
+            if not self.read_only:
+                self.add_file_suffixes_(conn)
+                conn.execute('CREATE INDEX IF NOT EXISTS files_parents '
+                             'ON files (parent)')
+                conn.execute('CREATE INDEX IF NOT EXISTS files_suffixes '
+                             'ON files (suffix, update_time)')
+
+            # finish reading the mines table before mines run any
+            # statements (like schema changes) of their own
             for (rowid, pickle_data) in conn.execute(
-                    'SELECT rowid, pickle from mines'):
+                    'SELECT rowid, pickle from mines').fetchall():
                 mine = self.mines[rowid] = pickle.loads(pickle_data)
+                self.registered_mines_.add(rowid)
                 mine.index(self, conn, rowid, force=False)
 
+    def add_file_suffixes_(self, conn):
+        # populate the suffix column for caches created by older versions
+        columns = [row[1] for row in conn.execute('PRAGMA table_info(files)')]
+        if 'suffix' in columns:
+            return
+
+        conn.create_function('pyq_file_suffix', 1, self.get_file_suffix)
+        conn.execute('ALTER TABLE files ADD COLUMN suffix TEXT')
+        conn.execute('UPDATE files SET suffix = pyq_file_suffix(path)')
+
+    @staticmethod
+    def get_file_suffix(path):
+        """Return the lowercase suffix (extension without the leading '.') of a path."""
+        name = os.path.basename(path)
+        if '.' not in name:
+            return ''
+        return name.rsplit('.', 1)[-1].lower()
+
+    def connect_(self):
+        # connections are only ever used by one thread at a time, but
+        # may be closed from another thread in close()
+        result = sqlite3.connect(
+            self.uri_, uri=True, check_same_thread=False,
+            detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES)
+        with self.connection_lock_:
+            self.connections_.append(result)
+        return result
+
+    def connect_thread_(self):
+        conn = self.connect_()
+        return ThreadConnection_(conn, self.connections_, self.connection_lock_)
+
+    @property
+    def connection_(self):
+        """The database connection to be used by the current thread."""
+        local = self.local_
+        conn = self.shared_connection_
+        if conn is None:
+            if getattr(local, 'connection', None) is None:
+                local.connection = self.connect_thread_()
+            conn = local.connection.connection
+        registered_mines = self.registered_mines_
+
+        if not registered_mines.issuperset(self.mines):
+            # let mines register their functions and collations with
+            # this thread's connection
+            for rowid in sorted(set(self.mines).difference(registered_mines)):
+                registered_mines.add(rowid)
+                mine = self.mines[rowid]
+                if hasattr(mine, 'register'):
+                    mine.register(self, conn, rowid)
+
+        return conn
+
+    @property
+    def registered_mines_(self):
+        """Set of mines that have registered their functions with the
+        connection used by the current thread."""
+        if self.shared_connection_ is not None:
+            return self.shared_registered_mines_
+
+        local = self.local_
+        if not hasattr(local, 'registered_mines'):
+            local.registered_mines = set()
+        return local.registered_mines
+
     def __enter__(self):
         return self
 
@@ -151,9 +425,11 @@ class Cache:
                                  (datetime.datetime.fromtimestamp(0), rowid))
 
             self.mines[rowid] = mine
+            self.registered_mines_.add(rowid)
 
             if force or stored_update_time is None:
                 begin_time = datetime.datetime.now()
+                self.last_commit_time_ = time.monotonic()
                 # force the first index if this source hasn't been indexed before
                 mine.index(self, conn, rowid, force=True)
                 if not self.read_only:
@@ -169,25 +445,454 @@ class Cache:
 
         """
         with self.connection_ as conn:
+            self.check_file_rows_(conn, True)
             for row in conn.execute(*args, **kwargs):
                 yield row
 
+    def query_prefetched(self, sql, parameters=(), prefetch=None, workers=4):
+        """Run a query on the database, decoding upcoming rows in the
+        background.
+
+        Behaves like :py:meth:`query`, but the data stored in files
+        (i.e. `gtar_records.data` or the attributes of
+        `garnett_frames`) is read by a pool of `workers` threads for up
+        to `prefetch` rows ahead of the row currently being consumed,
+        so that file reads overlap with whatever is done with each
+        row. The worker threads are kept and reused by later calls
+        until the cache is closed. Rows are still yielded in the order
+        given by the query::
+
+            for (index, positions) in cache.query_prefetched(
+                    'SELECT gtar_index, data FROM gtar_records WHERE name = ? '
+                    'ORDER BY gtar_index_key', ('position',)):
+                pass
+
+        :param sql: Query to run
+        :param parameters: Parameters for placeholders in `sql`
+        :param prefetch: Maximum number of rows to decode ahead of time (default: `Cache.QUERY_PREFETCH`)
+        :param workers: Number of threads to decode rows with
+
+        """
+        prefetch = max(1, prefetch or self.QUERY_PREFETCH)
+        pending = collections.deque()
+        pool = self.decode_pool_(workers)
+
+        with self.connection_ as conn:
+            self.check_file_rows_(conn, True)
+
+            # rows are fetched with conversion deferred, so the
+            # converters run in the worker threads instead
+            with deferred_conversion():
+                cursor = conn.execute(sql, parameters)
+
+            try:
+                exhausted = False
+                while pending or not exhausted:
+                    while not exhausted and len(pending) < prefetch:
+                        with deferred_conversion():
+                            row = next(cursor, None)
+                        if row is None:
+                            exhausted = True
+                        else:
+                            pending.append(pool.submit(resolve_row, row))
+
+                    if pending:
+                        yield pending.popleft().result()
+            finally:
+                for future in pending:
+                    future.cancel()
+
+    def decode_pool_(self, workers):
+        with self.connection_lock_:
+            if workers not in self.decode_pools_:
+                self.decode_pools_[workers] = concurrent.futures.ThreadPoolExecutor(
+                    workers, thread_name_prefix='pyqaxe-decode')
+            return self.decode_pools_[workers]
+
+    def iter_batches(self, sql, parameters=(), batch_size=None):
+        """Run a query on the database, yielding lists of result rows.
+
+        Unlike :py:meth:`query`, rows are fetched from a single cursor
+        `batch_size` rows at a time (using
+        :py:meth:`sqlite3.Cursor.fetchmany`) and no transaction is
+        kept open while the results are being consumed. Columns are
+        decoded the same way as by :py:meth:`query`; to leave a column
+        undecoded, select it as an expression without a declared type
+        (i.e. `CAST(data AS BLOB)`)::
+
+            for batch in cache.iter_batches(
+                    'SELECT gtar_index, data FROM gtar_records WHERE name = ?',
+                    ('position',)):
+                for (index, positions) in batch:
+                    pass
+
+        The query still reads from a single snapshot of the database
+        until it is exhausted. With the `wal` journal mode (see
+        :py:meth:`set_journal_mode`), other connections can write to
+        the database (i.e. index mines) in between batches; with other
+        journal modes, writers wait until the query finishes.
+
+        :param sql: Query to run
+        :param parameters: Parameters for placeholders in `sql`
+        :param batch_size: Number of rows in each batch (default: `Cache.QUERY_BATCH_SIZE`)
+
+        """
+        batch_size = batch_size or self.QUERY_BATCH_SIZE
+        conn = self.connection_
+        self.check_file_rows_(conn, True)
+
+        cursor = conn.execute(sql, parameters)
+        try:
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield rows
+        finally:
+            cursor.close()
+
+    def query_arrays(self, sql, parameters=(), fill_value=float('nan')):
+        """Run a query on the database, returning a numpy array for each
+        selected column.
+
+        Columns whose values are numeric arrays (i.e.
+        `gtar_records.data` or `garnett_frames.positions`) are stacked
+        into a single array of shape `(number of rows,) + shape`. The
+        number of rows is counted first, so each output array is
+        allocated once and every value is copied directly into its
+        slice as it is decoded, rather than collecting a list of
+        arrays and stacking them. Note that counting runs the query
+        (as a subquery of `SELECT count(*)`) once more, though without
+        decoding any values. All values of such a column must have the
+        same shape as the first non-null value; if a later value has a
+        dtype that can't be cast safely to that of the column (i.e.
+        floats after integers), the column is converted to a common
+        dtype first. Null values (i.e. frames of `gtar_frames` where a
+        quantity is missing) are set to `fill_value`. Other columns are
+        returned as one-dimensional arrays of their values::
+
+            (indices, positions) = cache.query_arrays(
+                'SELECT gtar_index, data FROM gtar_records WHERE name = ? '
+                'ORDER BY gtar_index_key', ('position',))
+
+        This method requires numpy.
+
+        :param sql: Query to run
+        :param parameters: Parameters for placeholders in `sql`
+        :param fill_value: Value for null entries of numeric array columns (raises ValueError if the value can't be stored in the column's dtype)
+        :returns: List of arrays, one for each selected column
+
+        """
+        import numpy as np
+
+        for (count,) in self.query(
+                'SELECT count(*) FROM ({})'.format(sql), parameters):
+            pass
+
+        def fill(column, index):
+            try:
+                column[index] = fill_value
+            except (TypeError, ValueError):
+                raise ValueError(
+                    'Can not store fill value {!r} for null values in column of '
+                    'dtype {}'.format(fill_value, column.dtype))
+
+        with self.connection_ as conn:
+            self.check_file_rows_(conn, True)
+            cursor = conn.execute(sql, parameters)
+            # columns are None until their first non-null value is found
+            columns = [None]*len(cursor.description)
+
+            row_count = 0
+            for row in cursor:
+                if row_count >= count:
+                    raise RuntimeError('Query returned more rows than were counted')
+
+                for (j, value) in enumerate(row):
+                    column = columns[j]
+                    if column is None:
+                        if value is None:
+                            continue
+                        elif isinstance(value, np.ndarray) and value.dtype.kind in 'biufc':
+                            column = np.empty((count,) + value.shape, dtype=value.dtype)
+                            if row_count:
+                                fill(column, slice(0, row_count))
+                        else:
+                            column = [None]*row_count
+                        columns[j] = column
+
+                    if isinstance(column, list):
+                        column.append(value)
+                    elif value is None:
+                        fill(column, row_count)
+                    elif np.shape(value) != column.shape[1:]:
+                        raise ValueError(
+                            'Value of shape {} in row {} of column {} does not match '
+                            'shape {} of the first value'.format(
+                                np.shape(value), row_count, j, column.shape[1:]))
+                    else:
+                        value = np.asarray(value)
+                        if (value.dtype.kind in 'biufc' and
+                                not np.can_cast(value.dtype, column.dtype)):
+                            # promote rather than truncate (i.e. floats
+                            # stored in an integer column)
+                            column = columns[j] = column.astype(
+                                np.result_type(column.dtype, value.dtype))
+                        column[row_count] = value
+                row_count += 1
+
+        result = []
+        for column in columns:
+            if column is None:
+                # only null values
+                column = [None]*row_count
+
+            if isinstance(column, list):
+                try:
+                    column = np.array(column)
+                except ValueError:
+                    # values of different shapes
+                    values, column = column, np.empty(len(column), dtype=object)
+                    for (i, value) in enumerate(values):
+                        column[i] = value
+            else:
+                column = column[:row_count]
+            result.append(column)
+
+        return result
+
+    def lookup_file_row_(self, file_id):
+        for row in self.connection_.execute(
+                'SELECT * FROM files WHERE rowid = ?', (file_id,)):
+            return row
+        raise KeyError('No file with rowid {}'.format(file_id))
+
+    @property
+    def file_rows_(self):
+        """Rows of the files table remembered by the current thread
+        (files table rowid -> row)."""
+        local = self.local_
+        if getattr(local, 'file_rows', None) is None:
+            local.file_rows = LRU_Cache(self.lookup_file_row_, lambda row: None,
+                                        self.FILE_ROW_CACHE_SIZE)
+            local.file_rows_state = (None, None)
+        return local.file_rows
+
+    def check_file_rows_(self, conn, check_other_connections=False):
+        # files_version_ tracks modifications of the files table made
+        # through this cache, data_version commits made by other
+        # connections (which may or may not have modified it)
+        file_rows = self.file_rows_
+        last_state = self.local_.file_rows_state
+        data_version = last_state[1]
+        if check_other_connections:
+            for (data_version,) in conn.execute('PRAGMA data_version'):
+                pass
+
+        state = (self.files_version_, data_version)
+        if state != last_state:
+            self.local_.file_rows_state = state
+            file_rows.clear()
+
+    def mark_files_modified(self):
+        """Discard the remembered rows of the files table.
+
+        :py:meth:`insert_file` and :py:meth:`remove_files` call this
+        automatically; mines that modify the files table directly
+        (i.e. with an UPDATE statement) should call it afterward.
+
+        """
+        with self.connection_lock_:
+            self.files_version_ += 1
+
+    def get_file_row(self, file_id):
+        """Return the row of the files table with the given rowid.
+
+        Rows are remembered between calls, so this is much cheaper
+        than running `SELECT * FROM files WHERE rowid = ?` for each
+        record when converting many records from the same files. The
+        remembered rows are discarded whenever the files table is
+        modified through this cache, or the database is modified by
+        another connection.
+
+        """
+        self.check_file_rows_(self.connection_)
+        return self.file_rows_(file_id)
+
+    @property
+    def journal_mode(self):
+        """The current sqlite journal mode of the database (i.e. 'delete' or 'wal')."""
+        for (mode,) in self.connection_.execute('PRAGMA journal_mode'):
+            return mode.lower()
+
+    def set_journal_mode(self, mode):
+        """Set the sqlite journal mode of the database.
+
+        The write-ahead log mode ('wal') is persistent: caches opened
+        later from the same file will use it as well.
+
+        :param mode: Journal mode to use: 'delete', 'truncate', 'persist', 'memory', 'wal', or 'off'
+        :returns: The resulting journal mode
+
+        """
+        if mode.upper() not in ('DELETE', 'TRUNCATE', 'PERSIST', 'MEMORY', 'WAL', 'OFF'):
+            raise ValueError('Unknown journal mode {}'.format(mode))
+
+        for (result,) in self.connection_.execute(
+                'PRAGMA journal_mode = {}'.format(mode)):
+            pass
+
+        result = result.lower()
+        if result != mode.lower():
+            logger.warning('Failed to set journal mode to {} (using {})'.format(
+                mode, result))
+        return result
+
+    def checkpoint(self, mode='passive'):
+        """Checkpoint the write-ahead log into the database file.
+
+        :param mode: sqlite checkpoint mode: 'passive', 'full', 'restart', or 'truncate'
+        :returns: (busy, log, checkpointed) tuple as reported by sqlite
+
+        """
+        mode = mode.upper()
+        if mode not in ('PASSIVE', 'FULL', 'RESTART', 'TRUNCATE'):
+            raise ValueError('Unknown checkpoint mode {}'.format(mode))
+
+        for row in self.connection_.execute('PRAGMA wal_checkpoint({})'.format(mode)):
+            return tuple(row)
+
+    def set_autocheckpoint(self, pages):
+        """Set the write-ahead log size (in pages) that triggers an automatic checkpoint.
+
+        Set to 0 to disable automatic checkpoints, in which case
+        :py:meth:`checkpoint` should be called periodically.
+
+        """
+        self.connection_.execute('PRAGMA wal_autocheckpoint = {}'.format(int(pages)))
+
+    def commit_if_due_(self, conn):
+        if self.commit_interval is None:
+            return
+
+        now = time.monotonic()
+        if now - self.last_commit_time_ >= self.commit_interval:
+            conn.commit()
+            self.last_commit_time_ = now
+
     def close(self):
-        """Close the connection to the database."""
-        self.connection_.close()
+        """Close the connections to the database."""
+        with self.connection_lock_:
+            connections = list(self.connections_)
+            self.connections_.clear()
+            pools, self.decode_pools_ = self.decode_pools_, {}
+        for pool in pools.values():
+            pool.shutdown()
+        for conn in connections:
+            conn.close()
         self.opened_file_cache_.clear()
+        self.mapped_files_.clear()
+        self.file_rows_.clear()
+
+    def batch_writer(self, conn, chunk_size=None):
+        """Create a :py:class:`pyqaxe.util.BatchWriter` for a connection.
+
+        Mines should use a batch writer (as a context manager) to
+        insert many rows at once, rather than executing an INSERT
+        statement for each row. When a `commit_interval` is set, the
+        writer writes its buffered rows and commits the indexing
+        progress whenever a row is inserted `commit_interval` seconds
+        or more after the last commit, even if fewer than `chunk_size`
+        rows have been buffered.
+
+        :param conn: Connection to write to
+        :param chunk_size: Number of rows to buffer per table (default: `Cache.insert_chunk_size`)
 
-    def insert_file(self, conn, mine_id, path, mtime=None, parent=None):
-        """Insert a new entry into the files table."""
+        """
+        if chunk_size is None:
+            chunk_size = self.insert_chunk_size
+        return BatchWriter(conn, chunk_size,
+                           on_flush=lambda tables: self.on_batch_flush_(conn, tables),
+                           flush_interval=self.commit_interval)
+
+    def on_batch_flush_(self, conn, tables):
+        if 'files' in tables:
+            self.mark_files_modified()
+        self.commit_if_due_(conn)
+
+    def insert_file(self, conn, mine_id, path, mtime=None, parent=None,
+                    writer=None, returning=False):
+        """Insert a new entry into the files table.
+
+        If `writer` (a batch writer created by :py:meth:`batch_writer`)
+        is given, the row is buffered in the writer and None is
+        returned, unless `returning` is True, in which case the rowid
+        of the new entry is returned. Without a writer, the row is
+        inserted immediately and the cursor is returned.
+
+        """
         if mtime is None:
             mtime = datetime.datetime.now()
 
-        return conn.execute(
-            'INSERT INTO files VALUES (?, ?, ?, ?)',
-            (path, mine_id, mtime, parent))
+        values = (path, mine_id, mtime, parent, self.get_file_suffix(path))
+        if writer is not None:
+            # buffered rows are noted as modifications when they are flushed
+            result = writer.insert('files', values, returning=returning)
+            if returning:
+                self.mark_files_modified()
+            return result
+
+        result = conn.execute('INSERT INTO files VALUES (?, ?, ?, ?, ?)', values)
+        self.mark_files_modified()
+        return result
+
+    def remove_files(self, conn, file_ids):
+        """Remove entries from the files table.
+
+        Files contained within the removed files (i.e. entries whose
+        parent is a removed file) are removed as well. Each mine with
+        a `remove_files(cache, conn, file_ids)` method is given the
+        list of all removed file IDs so that it can remove any rows
+        that refer to them.
+
+        :param conn: Connection to modify
+        :param file_ids: Iterable of files table rowids to remove
+        :returns: List of all file IDs that were removed
+
+        """
+        removed = []
+        to_remove = list(file_ids)
+        while to_remove:
+            removed.extend(to_remove)
+            children = []
+            for file_id in to_remove:
+                children.extend(row[0] for row in conn.execute(
+                    'SELECT rowid FROM files WHERE parent = ?', (file_id,)))
+            to_remove = children
+
+        if not removed:
+            return removed
+
+        for mine in self.ordered_mines:
+            if hasattr(mine, 'remove_files'):
+                mine.remove_files(self, conn, removed)
+
+        conn.executemany('DELETE FROM files WHERE rowid = ?',
+                         [(file_id,) for file_id in removed])
+        self.mark_files_modified()
+        return removed
 
     def open_file_(self, row, mode, named):
-        (path, mine_id, _, parent) = row
+        (path, mine_id, update_time, parent) = row[:4]
+
+        if named and parent is not None and self.extraction_directory_ is not None:
+            def write(target):
+                with self.mines[mine_id].open(path, 'rb', self, parent) as source:
+                    shutil.copyfileobj(source, target)
+
+            key = [self.unique_id, mine_id, parent, path, str(update_time)]
+            return self.extraction_directory_.open(
+                key, os.path.basename(path), mode, write)
 
         if mine_id is not None:
             result = self.mines[mine_id].open(path, mode, self, parent)
@@ -209,6 +914,15 @@ class Cache:
     def close_file_(f):
         return f.close()
 
+    @staticmethod
+    def file_size_(f):
+        try:
+            return os.fstat(f.fileno()).st_size
+        except (AttributeError, OSError, io.UnsupportedOperation):
+            # file-like objects without a backing file (i.e. archive
+            # members) aren't counted
+            return 0
+
     def open_file(self, row, mode='r', named=False):
         """Open an entry from the files table.
 
@@ -220,6 +934,75 @@ class Cache:
         """
         return self.opened_file_cache_(row, mode, named)
 
+    @contextlib.contextmanager
+    def pinned_file(self, row, mode='r', named=False):
+        """Context manager to open an entry from the files table.
+
+        The file is guaranteed to stay open (even if other threads
+        open many other files) until the context exits. Like
+        :py:meth:`open_file`, the file object is shared, so it should
+        not be closed by the caller.
+
+        """
+        with self.opened_file_cache_.pinned(row, mode, named) as result:
+            yield result
+
+    def pin_file(self, row, mode='r', named=False):
+        """Open an entry from the files table and keep it open.
+
+        Works like :py:meth:`open_file`, but the returned file will
+        not be closed by the open file cache until a matching call to
+        :py:meth:`unpin_file` is made (or the cache is closed).
+
+        """
+        return self.opened_file_cache_.pin(row, mode, named)
+
+    def unpin_file(self, row, mode='r', named=False):
+        """Release a file previously pinned by :py:meth:`pin_file`."""
+        self.opened_file_cache_.unpin(row, mode, named)
+
+    def map_file(self, row):
+        """Return a read-only `memoryview` of the contents of an entry
+        from the files table.
+
+        Files on disk are memory-mapped rather than read, and mines can
+        expose files they contain (i.e. members of uncompressed tar
+        archives) as slices of the mapping of their parent file, so
+        large binary files can be used without being copied::
+
+            data = numpy.frombuffer(cache.map_file(row), dtype=numpy.float32)
+
+        Other files are read into memory. The mappings of recently-used
+        files are kept, so mapping many members of the same archive
+        maps the archive only once.
+
+        """
+        (path, mine_id, _, parent) = row[:4]
+
+        mine = self.mines.get(mine_id)
+        if mine is not None and hasattr(mine, 'map_file'):
+            result = mine.map_file(path, self, parent)
+            if result is not None:
+                return result
+
+        if parent is None:
+            mapped = self.mapped_files_(tuple(row[:4]))
+            if mapped is not None:
+                return memoryview(mapped)
+
+        with self.pinned_file(row, 'rb') as opened_file:
+            opened_file.seek(0)
+            # views of bytes objects are already read-only
+            return memoryview(opened_file.read())
+
+    def map_file_(self, row):
+        with self.pinned_file(row, 'rb') as opened_file:
+            try:
+                return mmap.mmap(opened_file.fileno(), 0, access=mmap.ACCESS_READ)
+            except (AttributeError, OSError, ValueError, io.UnsupportedOperation):
+                # empty files can't be mapped, for example
+                return None
+
     @property
     def named_mines(self):
         """A dictionary mapping active mine type names to objects."""
@@ -237,3 +1020,22 @@ class Cache:
     def set_cache_size(self, value):
         """Set the maximum number of files to keep open."""
         self.opened_file_cache_.max_size = value
+
+    def get_cache_bytes(self):
+        """Return the maximum total size (in bytes) of files to keep open."""
+        return self.opened_file_cache_.max_bytes
+
+    def set_cache_bytes(self, value):
+        """Set the maximum total size (in bytes) of files to keep open.
+
+        Only files with a backing file descriptor (i.e. files in the
+        filesystem and temporary copies of archived files) count
+        toward this limit. Set to None to disable the limit.
+
+        """
+        self.opened_file_cache_.max_bytes = value
+        self.opened_file_cache_.trim()
+
+    def get_cache_stats(self):
+        """Return a dictionary of hit, miss, and eviction counts for opened files."""
+        return self.opened_file_cache_.stats()
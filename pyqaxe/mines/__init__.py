@@ -1,2 +1,3 @@
 from .directory import Directory
 from .tarfile import TarFile
+from .zipfile import ZipFile
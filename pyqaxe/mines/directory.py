@@ -1,4 +1,6 @@
+import concurrent.futures
 import datetime
+import json
 import logging
 import os
 import re
@@ -22,6 +24,9 @@ class Directory:
     :param exclude_regexes: Iterable of regex patterns that should be excluded from addition to the list of files upon a successful search
     :param exclude_suffixes: Iterable of suffixes that should be excluded from addition to the list of files
     :param relative: Whether to store absolute or relative paths (see below)
+    :param incremental: If True, only re-scan directories that have changed when re-indexing (see below)
+    :param workers: Number of threads to use to list directories and stat files (see below)
+    :param ordered: If True (and `workers` is given), insert files in the same order as a single-threaded scan
 
     **Relative paths**: Directory can store relative, rather than
     absolute, paths to files. To use absolute paths, set
@@ -31,14 +36,51 @@ class Directory:
     object that indexes this mine, set `relative=cache` for that cache
     object.
 
+    **Incremental indexing**: With `incremental=True`, the
+    modification time and contents of each scanned directory are
+    recorded in a **directory_listings** table. When the mine is
+    re-indexed, directories whose modification time has not changed
+    are not listed again (only their subdirectories are checked);
+    within changed directories, only new or modified files are
+    inserted, and files (or whole subdirectories) that have
+    disappeared are removed from the files table along with any rows
+    other mines created for them. Note that modifying a file in place
+    does not change the modification time of its directory, so such
+    changes are only detected when something else in the same
+    directory has changed. When an incremental mine is first indexed
+    in a cache that already has a non-incremental `Directory` mine
+    with the same options, it takes over the files that mine found
+    (comparing them against the filesystem), so they aren't inserted
+    or indexed by other mines a second time, and the non-incremental
+    mine is removed from the cache. Indexing a non-incremental mine
+    again afterward (with the same options) updates the files of the
+    incremental mine rather than inserting them again.
+
+    **Parallel scanning**: Listing directories and querying file
+    modification times is usually bound by latency on network
+    filesystems. With `workers=N`, these calls are made by a pool of
+    N threads while the thread that indexes the mine inserts the
+    results into the database. The same paths are found as with a
+    serial scan; by default they are inserted in whichever order the
+    directories finish being listed, while `ordered=True` inserts
+    them in exactly the order a serial scan would. These options only
+    affect how indexing is performed, so they are not stored with the
+    mine in the database.
+
     Examples::
 
         cache.index(Directory(exclude_regexes=[r'/\..*']))
         cache.index(Directory(exclude_suffixes=['txt', 'zip']))
+        cache.index(Directory('/data', incremental=True), force=True)
+        cache.index(Directory('/nfs/data', workers=16))
 
     """
-    def __init__(self, root=os.curdir, exclude_regexes=(), exclude_suffixes=(), relative=False):
+    def __init__(self, root=os.curdir, exclude_regexes=(), exclude_suffixes=(), relative=False,
+                 incremental=False, workers=None, ordered=False):
         self.root = root
+        self.incremental = incremental
+        self.workers = workers
+        self.ordered = ordered
         self.exclude_regexes = set(exclude_regexes)
         self.compiled_regexes_ = [re.compile(pat) for pat in self.exclude_regexes]
         self.exclude_suffixes = set(exclude_suffixes)
@@ -72,48 +114,301 @@ class Directory:
     def index(self, cache, conn, mine_id=None, force=False):
         self.check_adapters()
 
+        if self.incremental:
+            conn.execute('CREATE TABLE IF NOT EXISTS directory_listings '
+                         '(mine_id INTEGER, path TEXT, parent_path TEXT, '
+                         'mtime REAL, files TEXT, '
+                         'CONSTRAINT unique_directory_listing '
+                         'UNIQUE (mine_id, path) ON CONFLICT REPLACE)')
+            conn.execute('CREATE INDEX IF NOT EXISTS directory_listing_parents '
+                         'ON directory_listings (mine_id, parent_path)')
+
         if not force or cache.read_only:
             return
 
-        directory_stack = [self.root]
-        while directory_stack:
+        with cache.batch_writer(conn) as writer:
+            if self.incremental:
+                self.scan_incremental_(cache, conn, mine_id, writer)
+                return
+
+            for (rowid, mine) in self.matching_mines_(cache, mine_id, True):
+                # the files are already tracked by an incremental mine
+                mine.scan_incremental_(cache, conn, rowid, writer)
+                return
+
+            self.scan_(cache, conn, mine_id, writer)
+
+    def list_directory_(self, dirname):
+        """Return the (subdirectories, [(file path, mtime)]) found in a
+        directory, or None if the directory can't be read."""
+        try:
+            entries = scandir(dirname)
+        except (PermissionError, FileNotFoundError, NotADirectoryError):
+            # can't read directory
+            return None
+
+        subdirectories = []
+        files = []
+        for entry in entries:
             try:
-                entries = scandir(directory_stack.pop())
-            except PermissionError:
-                # can't read directory
+                is_directory = entry.is_dir()
+            except OSError:
+                # symlink to itself
+                continue
+
+            if is_directory:
+                if all(regex.search(entry.path) is None for regex in self.compiled_regexes_):
+                    subdirectories.append(entry.path)
+            else:
+                valid = all([
+                    entry.name.split('.')[-1] not in self.exclude_suffixes,
+                    all(regex.search(entry.path) is None for regex in self.compiled_regexes_)
+                    ])
+                if valid:
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        # link to file that doesn't exist, for example
+                        continue
+                    files.append((entry.path, stat.st_mtime))
+
+        return (subdirectories, files)
+
+    def file_path_(self, path):
+        if self.relative_to:
+            path = os.path.relpath(path, self.relative_to)
+        return path
+
+    def traverse_(self, root, probe, handle):
+        """Walk a tree of directories depth-first.
+
+        `probe(item)` performs the filesystem IO for a directory and
+        may be run in a worker thread; `handle(item, result)` is
+        always run in the calling thread (where it may use the
+        database connection) and returns the child items to visit.
+
+        """
+        if not self.workers or self.workers <= 1:
+            stack = [root]
+            while stack:
+                item = stack.pop()
+                stack.extend(handle(item, probe(item)))
+            return
+
+        with concurrent.futures.ThreadPoolExecutor(self.workers) as pool:
+            if self.ordered:
+                # visit directories in exactly the same order as a
+                # serial scan, while listing discovered directories
+                # in the background
+                stack = [(root, pool.submit(probe, root))]
+                while stack:
+                    (item, future) = stack.pop()
+                    stack.extend((child, pool.submit(probe, child))
+                                 for child in handle(item, future.result()))
+            else:
+                pending = {pool.submit(probe, root): root}
+                while pending:
+                    (done, _) = concurrent.futures.wait(
+                        pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        item = pending.pop(future)
+                        for child in handle(item, future.result()):
+                            pending[pool.submit(probe, child)] = child
+
+    def scan_(self, cache, conn, mine_id, writer):
+        def handle(dirname, listing):
+            if listing is None:
+                return []
+
+            (subdirectories, files) = listing
+            for (path, mtime) in files:
+                mtime = datetime.datetime.fromtimestamp(mtime)
+                cache.insert_file(
+                    conn, mine_id, self.file_path_(path), mtime, None, writer=writer)
+            return subdirectories
+
+        self.traverse_(self.root, self.list_directory_, handle)
+
+    def get_listing_(self, conn, mine_id, dirname):
+        for (mtime, files) in conn.execute(
+                'SELECT mtime, files FROM directory_listings '
+                'WHERE mine_id = ? AND path = ?', (mine_id, dirname)):
+            return (mtime, json.loads(files))
+        return None
+
+    def get_child_directories_(self, conn, mine_id, dirname):
+        return [row[0] for row in conn.execute(
+            'SELECT path FROM directory_listings '
+            'WHERE mine_id = ? AND parent_path = ?', (mine_id, dirname))]
+
+    def find_file_ids_(self, conn, mine_id, paths):
+        result = []
+        for path in paths:
+            for (rowid,) in conn.execute(
+                    'SELECT rowid FROM files WHERE path = ? AND mine_id = ? '
+                    'AND parent IS NULL', (self.file_path_(path), mine_id)):
+                result.append(rowid)
+        return result
+
+    def directory_prefix_(self, dirname):
+        """Return the prefix of paths stored in the files table for
+        files directly inside a directory."""
+        return os.path.join(
+            os.path.dirname(self.file_path_(os.path.join(dirname, 'x'))), '')
+
+    def matching_mines_(self, cache, mine_id, incremental):
+        """Return a list of (rowid, mine) for the other Directory mines
+        of a cache that have the same options as this one (besides
+        `incremental`, `workers`, and `ordered`)."""
+        state = self.__getstate__()[:4]
+        return [(rowid, mine) for (rowid, mine) in sorted(cache.mines.items())
+                if rowid != mine_id and isinstance(mine, Directory) and
+                bool(mine.incremental) == incremental and
+                mine.__getstate__()[:4] == state]
+
+    def adopt_files_(self, cache, conn, mine_id):
+        """Take over the files found by non-incremental Directory mines
+        with the same options as this one, removing those mines.
+        Returns True if any mines were found."""
+        result = False
+        for (rowid, _) in self.matching_mines_(cache, mine_id, False):
+            conn.execute('UPDATE files SET mine_id = ? WHERE mine_id = ? '
+                         'AND parent IS NULL', (mine_id, rowid))
+            cache.mark_files_modified()
+            conn.execute('DELETE FROM mines WHERE rowid = ?', (rowid,))
+            del cache.mines[rowid]
+            result = True
+        return result
+
+    def forget_unlisted_files_(self, cache, conn, mine_id):
+        """Remove adopted files in directories that no longer exist."""
+        listed = {self.directory_prefix_(row[0]) for row in conn.execute(
+            'SELECT path FROM directory_listings WHERE mine_id = ?', (mine_id,))}
+        file_ids = [rowid for (rowid, path) in conn.execute(
+            'SELECT rowid, path FROM files WHERE mine_id = ? AND parent IS NULL',
+            (mine_id,)) if os.path.join(os.path.dirname(path), '') not in listed]
+        cache.remove_files(conn, file_ids)
+
+    def find_indexed_mtimes_(self, conn, mine_id, dirname, files):
+        """Return {name: mtime} for the files of a directory that are
+        already present in the files table, for directories that were
+        indexed without a directory listing. Files that no longer
+        exist or have a different modification time map to None."""
+        mtimes = {os.path.basename(path): mtime for (path, mtime) in files}
+        prefix = self.directory_prefix_(dirname)
+
+        query = 'SELECT path, update_time FROM files WHERE mine_id = ? AND parent IS NULL'
+        parameters = (mine_id,)
+        if prefix:
+            # select the range of paths beginning with prefix
+            query += ' AND path >= ? AND path < ?'
+            parameters += (prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1))
+
+        result = {}
+        for (path, update_time) in conn.execute(query, parameters):
+            if os.path.join(os.path.dirname(path), '') != prefix:
                 continue
 
-            for entry in entries:
-                try:
-                    is_directory = entry.is_dir()
-                except OSError:
-                    # symlink to itself
-                    continue
-
-                if is_directory:
-                    if all(regex.search(entry.path) is None for regex in self.compiled_regexes_):
-                        directory_stack.append(entry.path)
-                else:
-                    valid = all([
-                        entry.name.split('.')[-1] not in self.exclude_suffixes,
-                        all(regex.search(entry.path) is None for regex in self.compiled_regexes_)
-                        ])
-                    if valid:
-                        path = entry.path
-                        if self.relative_to:
-                            path = os.path.relpath(path, self.relative_to)
-
-                        try:
-                            stat = entry.stat()
-                        except FileNotFoundError:
-                            # link to file that doesn't exist, for example
-                            continue
-                        mtime = datetime.datetime.fromtimestamp(stat.st_mtime)
-                        cache.insert_file(conn, mine_id, path, mtime, None)
+            name = os.path.basename(path)
+            mtime = mtimes.get(name)
+            if mtime is not None and update_time == datetime.datetime.fromtimestamp(mtime):
+                result[name] = mtime
+            else:
+                result[name] = None
+        return result
+
+    def forget_directory_(self, cache, conn, mine_id, dirname):
+        """Remove a directory, its subdirectories, and all files they
+        contain from the cache."""
+        directory_stack = [dirname]
+        while directory_stack:
+            dirname = directory_stack.pop()
+            listing = self.get_listing_(conn, mine_id, dirname)
+            if listing is not None:
+                paths = [os.path.join(dirname, name) for name in listing[1]]
+                cache.remove_files(conn, self.find_file_ids_(conn, mine_id, paths))
+            directory_stack.extend(self.get_child_directories_(conn, mine_id, dirname))
+            conn.execute('DELETE FROM directory_listings WHERE mine_id = ? AND path = ?',
+                         (mine_id, dirname))
+
+    def probe_incremental_(self, item):
+        (dirname, _, old_listing) = item
+
+        try:
+            dir_mtime = os.stat(dirname).st_mtime
+        except OSError:
+            return (None, None)
+
+        if old_listing is not None and old_listing[0] == dir_mtime:
+            # no entries have been added to or removed from this
+            # directory, so there is no need to list it
+            return (dir_mtime, None)
+
+        return (dir_mtime, self.list_directory_(dirname))
+
+    def scan_incremental_(self, cache, conn, mine_id, writer):
+        adopted = False
+        for _ in conn.execute('SELECT 1 FROM directory_listings WHERE mine_id = ? LIMIT 1',
+                              (mine_id,)):
+            break
+        else:
+            adopted = self.adopt_files_(cache, conn, mine_id)
+
+        def make_item(dirname, parent_path):
+            return (dirname, parent_path, self.get_listing_(conn, mine_id, dirname))
+
+        def handle(item, result):
+            (dirname, parent_path, old_listing) = item
+            (dir_mtime, listing) = result
+
+            if old_listing is not None and old_listing[0] == dir_mtime:
+                # only the subdirectories of unchanged directories
+                # need to be checked
+                return [make_item(child, dirname) for child in
+                        self.get_child_directories_(conn, mine_id, dirname)]
+
+            if listing is None:
+                self.forget_directory_(cache, conn, mine_id, dirname)
+                return []
+
+            (subdirectories, files) = listing
+            if old_listing is not None:
+                old_files = old_listing[1]
+            else:
+                old_files = self.find_indexed_mtimes_(conn, mine_id, dirname, files)
+            new_files = {os.path.basename(path): mtime for (path, mtime) in files}
+
+            stale_paths = [os.path.join(dirname, name) for name in old_files
+                           if name not in new_files or new_files[name] != old_files[name]]
+            cache.remove_files(conn, self.find_file_ids_(conn, mine_id, stale_paths))
+
+            for (path, mtime) in files:
+                if old_files.get(os.path.basename(path)) != mtime:
+                    mtime = datetime.datetime.fromtimestamp(mtime)
+                    cache.insert_file(
+                        conn, mine_id, self.file_path_(path), mtime, None, writer=writer)
+
+            for child in set(self.get_child_directories_(conn, mine_id, dirname)).difference(
+                    subdirectories):
+                self.forget_directory_(cache, conn, mine_id, child)
+
+            conn.execute('INSERT INTO directory_listings VALUES (?, ?, ?, ?, ?)',
+                         (mine_id, dirname, parent_path, dir_mtime, json.dumps(new_files)))
+            return [make_item(child, dirname) for child in subdirectories]
+
+        self.traverse_(make_item(self.root, None), self.probe_incremental_, handle)
+
+        if adopted:
+            self.forget_unlisted_files_(cache, conn, mine_id)
 
     def __getstate__(self):
-        return [self.root, list(sorted(self.exclude_regexes)),
-                list(sorted(self.exclude_suffixes)), self.relative]
+        result = [self.root, list(sorted(self.exclude_regexes)),
+                  list(sorted(self.exclude_suffixes)), self.relative]
+        # only store non-default options so that previously-created
+        # caches keep recognizing their mines
+        if self.incremental:
+            result.append(self.incremental)
+        return result
 
     def __setstate__(self, state):
         state = list(state)
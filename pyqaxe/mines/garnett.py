@@ -1,10 +1,14 @@
+import contextlib
 import garnett
+import io
 import json
 import logging
+import numpy as np
 import re
 import sqlite3
+import threading
 import weakref
-from .. import Cache
+from .. import Cache, util
 
 logger = logging.getLogger(__name__)
 
@@ -14,14 +18,82 @@ def encode_garnett_data(file_id, cache_id, frame, attribute):
 def convert_garnett_data(contents):
     (file_id, cache_id, frame, attribute) = json.loads(contents.decode('UTF-8'))
     cache = Cache.get_opened_cache(cache_id)
-    for row in cache.query('SELECT * from files WHERE rowid = ?', (file_id,)):
-        # set row for open_file below
-        pass
-
-    suffix = row[0].split('.')[-1]
+    row = cache.get_file_row(file_id)
+
+    frame_object = Garnett.get_frame_cache_()(cache_id, file_id, frame, row)
+    result = getattr(frame_object, attribute)
+    # the frame is shared with later queries, so give out read-only
+    # views that can't modify it
+    if hasattr(result, 'setflags'):
+        result.setflags(write=False)
+        result = result.view()
+    return result
+
+def read_garnett_frame(cache_id, file_id, frame, row):
+    cache = Cache.get_opened_cache(cache_id)
+    suffix = Cache.get_file_suffix(row[0])
+
+    if suffix == 'pos':
+        frame_object = Garnett.read_pos_frame_(cache, row, file_id, frame)
+        if frame_object is not None:
+            frame_object.load()
+            return frame_object
+
+    with Garnett.pinned_trajectory(cache, row, suffix) as trajectory:
+        frame_object = trajectory[frame]
+        # read the data while the file is guaranteed to be open; the
+        # file is shared, so only one thread can read it at a time
+        with Garnett.read_lock_:
+            frame_object.load()
+        return frame_object
+
+def scan_pos_frames(stream):
+    """Return a list of (offset, length) byte ranges for each frame in
+    a pos file opened in binary mode.
+
+    Frames are split in the same way as by the pos file reader: each
+    ends with an "eof" line, and any trailing data are counted as a
+    frame if they contain a box.
 
-    trajectory = Garnett.get_opened_trajectory(cache, row, suffix)
-    return getattr(trajectory[frame], attribute)
+    """
+    result = []
+    start = index = 0
+    for line in stream:
+        index += len(line)
+        if line.startswith(b'eof'):
+            result.append((start, index - start))
+            start = index
+
+    if index > start:
+        stream.seek(start)
+        for line in stream:
+            if line.startswith(b'box'):
+                result.append((start, index - start))
+                break
+        else:
+            logger.warning('Unexpected file ending.')
+
+    return result
+
+def garnett_box_volume(box):
+    """Return the volume (or area, for 2D boxes) of a box."""
+    dimensions = getattr(box, 'dimensions', 3)
+    # box matrices are triangular
+    matrix = np.asarray(box.get_box_matrix(), dtype=np.float64)
+    return abs(float(np.prod(np.diagonal(matrix)[:dimensions])))
+
+def scan_garnett_frames(filename, mode, suffix, statistics=False):
+    with open(filename, mode) as f:
+        (frame_count, offsets) = Garnett.scan_frames_(f, suffix)
+
+        stats = None
+        if statistics:
+            f.seek(0)
+            stream = io.TextIOWrapper(f) if suffix == 'pos' else f
+            trajectory = Garnett.readers[suffix]().read(stream)
+            stats = Garnett.frame_statistics_(trajectory)
+
+        return (frame_count, offsets, stats)
 
 class Garnett:
     """Expose frames of garnett-readable trajectory formats.
@@ -31,9 +103,27 @@ class Garnett:
     number of frames and data are read on-demand as frame data are
     selected.
 
-    Garnett objects create the following table in the database:
+    :param exclude_regexes: Iterable of regex patterns of file paths that should not be opened
+    :param exclude_suffixes: Iterable of file suffixes that should not be opened
+    :param processes: Number of processes to use to count the frames of trajectories when indexing
+    :param statistics: If True, read every frame when indexing to store a summary of its contents (see below)
+
+    Trajectory files are normally opened one at a time to count their
+    frames, which can dominate the time needed to index many files.
+    With `processes=N`, files are instead parsed by a pool of N worker
+    processes, which report the number of frames in each file back to
+    the indexing process; the resulting table is the same as for a
+    serial index. The number of processes is not stored in the
+    database, so it must be given again when a cache is reopened in
+    order to be used::
+
+        cache.index(Garnett(processes=8))
+
+    Garnett objects create the following tables in the database:
 
     - garnett_frames: Contains entries for each frame found in all trajectory files
+    - garnett_pos_offsets: Contains the location of each frame within pos files
+    - garnett_frame_stats: Contains summaries of the attributes of frames (only if `statistics=True`)
 
     The **garnett_frames** table has the following columns:
 
@@ -47,12 +137,60 @@ class Garnett:
     - orientations: Garnett orientations object for the frame
     - shapedef: Garnett shapedef object for the frame
 
+    The **garnett_pos_offsets** table has the following columns:
+
+    - file_id: files table identifier for the pos file
+    - frame: Integer (0-based) corresponding to the frame index within the trajectory
+    - offset: Position (in bytes) of the start of the frame within the file
+    - length: Length (in bytes) of the frame
+
+    Because the location of each frame of a pos file is stored when
+    it is indexed, selecting data from a pos file only parses the
+    frames that are requested, rather than scanning the entire file.
+
+    **Frame statistics**: With `statistics=True`, every frame is read
+    once when trajectories are indexed and each of its attributes is
+    summarized in the **garnett_frame_stats** table, which has the
+    following columns:
+
+    - file_id, frame: identify the frame in garnett_frames
+    - attribute: name of the frame attribute (i.e. "positions")
+    - length: size of the first axis of the attribute (i.e. number of particles)
+    - size: total number of elements of the attribute
+    - ndim: number of dimensions of the attribute
+    - shape: shape of the attribute, as a JSON list
+    - dtype: numpy dtype of the attribute
+    - minimum, maximum, mean: statistics of numeric attributes (otherwise null)
+
+    Boxes are summarized by their box matrix; each frame also has a
+    "box_volume" attribute, the (scalar) volume of its box. Frames can
+    then be filtered without reading any trajectories::
+
+        cache.index(Garnett(statistics=True))
+        cache.query('SELECT positions FROM garnett_frames '
+                    'JOIN garnett_frame_stats USING (file_id, frame) '
+                    'WHERE attribute = "positions" AND length > 10000')
+
+    **Frame cache**: Each frame is decoded once and shared among all
+    of the columns selected from its row, so selecting `box`,
+    `positions`, and `orientations` together costs the same as
+    selecting one of them. Only the few most recently decoded frames
+    are kept (separately for each thread); the number can be changed
+    with :py:meth:`set_frame_cache_size`. Arrays selected from cached
+    frames are read-only views, so they should be copied before
+    being modified.
+
     .. note::
         Consult the garnett documentation to find more details
         about the encoding of the various data types listed here.
 
     """
     opened_trajectories_ = weakref.WeakKeyDictionary()
+    opened_trajectories_lock_ = threading.Lock()
+    read_lock_ = threading.Lock()
+    # thread-local caches of recently decoded frames
+    frame_caches_ = threading.local()
+    frame_cache_size_ = 4
 
     binary_formats = {'zip', 'tar', 'sqlite', 'gsd'}
 
@@ -70,10 +208,13 @@ class Garnett:
     known_frame_attributes = ['box', 'types', 'positions', 'velocities',
                               'orientations', 'shapedef']
 
-    def __init__(self, exclude_regexes=(), exclude_suffixes=()):
+    def __init__(self, exclude_regexes=(), exclude_suffixes=(), processes=None,
+                 statistics=False):
         self.exclude_regexes = set(exclude_regexes)
         self.compiled_regexes_ = [re.compile(pat) for pat in self.exclude_regexes]
         self.exclude_suffixes = set(exclude_suffixes)
+        self.processes = processes
+        self.statistics = bool(statistics)
 
     def index(self, cache, conn, mine_id=None, force=False):
         self.check_adapters()
@@ -89,6 +230,23 @@ class Garnett:
                      attributes=all_attributes)
         conn.execute(query)
 
+        if not cache.read_only:
+            # read-only caches indexed by older versions may not have
+            # this table; frames are then found by scanning the file
+            conn.execute('CREATE TABLE IF NOT EXISTS garnett_pos_offsets '
+                         '(file_id INTEGER, frame INTEGER, offset INTEGER, '
+                         'length INTEGER, '
+                         'CONSTRAINT unique_garnett_pos_offset '
+                         'UNIQUE (file_id, frame) ON CONFLICT REPLACE)')
+
+            # likewise, no statistics are available without this table
+            conn.execute('CREATE TABLE IF NOT EXISTS garnett_frame_stats '
+                         '(file_id INTEGER, frame INTEGER, attribute TEXT, '
+                         'length INTEGER, size INTEGER, ndim INTEGER, shape TEXT, '
+                         'dtype TEXT, minimum REAL, maximum REAL, mean REAL, '
+                         'CONSTRAINT unique_garnett_frame_stats '
+                         'UNIQUE (file_id, frame, attribute) ON CONFLICT REPLACE)')
+
         # don't do file IO if we aren't forced
         if not force or cache.read_only:
             return
@@ -98,27 +256,57 @@ class Garnett:
                 (mine_id,)):
             pass
 
-        insert_query = 'INSERT INTO garnett_frames VALUES ({})'.format(
-            ', '.join((len(self.known_frame_attributes) + 2)*'?'))
+        files = []
         for row in conn.execute(
-                'SELECT rowid, * from files WHERE (update_time > ?) AND '
-                '(path LIKE "%.zip" OR '
-                'path LIKE "%.tar" OR path LIKE "%.sqlite" OR '
-                'path LIKE "%.pos" OR path LIKE "%.gsd")',
+                'SELECT rowid, * from files WHERE '
+                'suffix IN ("zip", "tar", "sqlite", "pos", "gsd") '
+                'AND update_time > ?',
                 (mine_update_time,)):
             file_id, row = row[0], row[1:]
             path = row[0]
-            suffix = path.split('.')[-1]
+            suffix = Cache.get_file_suffix(path)
 
             valid = all([
                 suffix not in self.exclude_suffixes,
                 all(regex.search(path) is None for regex in self.compiled_regexes_)
                 ])
-            if not valid:
-                continue
-
+            if valid:
+                files.append((file_id, row, suffix))
+
+        if not self.processes or self.processes <= 1:
+            count_frames = self.count_frames_serial_
+        else:
+            count_frames = self.count_frames_parallel_
+
+        with cache.batch_writer(conn) as writer:
+            for (file_id, frame_count, offsets, stats) in count_frames(cache, files):
+                for frame in range(frame_count):
+                    values = [file_id, frame]
+                    for attr in self.known_frame_attributes:
+                        values.append(encode_garnett_data(file_id, cache.unique_id, frame, attr))
+                    writer.insert('garnett_frames', values)
+
+                for (frame, (offset, length)) in enumerate(offsets or ()):
+                    writer.insert('garnett_pos_offsets', (file_id, frame, offset, length))
+
+                for (frame, attribute, values) in stats or ():
+                    writer.insert('garnett_frame_stats', (file_id, frame, attribute) + values)
+
+    def count_frames_serial_(self, cache, files):
+        for (file_id, row, suffix) in files:
             try:
-                trajectory = self.get_opened_trajectory(cache, row, suffix)
+                if suffix == 'pos':
+                    with cache.pinned_file(row, 'rb') as opened_file:
+                        opened_file.seek(0)
+                        (frame_count, offsets) = self.scan_frames_(opened_file, suffix)
+                else:
+                    trajectory = self.get_opened_trajectory(cache, row, suffix)
+                    (frame_count, offsets) = (len(trajectory), None)
+
+                stats = None
+                if self.statistics:
+                    stats = self.frame_statistics_(
+                        self.get_opened_trajectory(cache, row, suffix))
             except garnett.errors.ParserError as e:
                 logger.warning('{}: {}'.format(row[0], e))
                 continue
@@ -128,11 +316,35 @@ class Garnett:
                 logger.warning('{}: {}'.format(row[0], e))
                 continue
 
-            for frame in range(len(trajectory)):
-                values = [file_id, frame]
-                for attr in self.known_frame_attributes:
-                    values.append(encode_garnett_data(file_id, cache.unique_id, frame, attr))
-                conn.execute(insert_query, values)
+            yield (file_id, frame_count, offsets, stats)
+
+    def count_frames_parallel_(self, cache, files):
+        tasks = []
+        for (file_id, row, suffix) in files:
+            (open_mode, _) = self.get_open_args_(suffix)
+            if suffix == 'pos':
+                open_mode = 'rb'
+            tasks.append((file_id, row, open_mode, (suffix, self.statistics)))
+
+        for ((file_id, row, _, _), future) in util.map_cached_files(
+                cache, tasks, scan_garnett_frames, self.processes):
+            try:
+                (frame_count, offsets, stats) = future.result()
+            except garnett.errors.ParserError as e:
+                logger.warning('{}: {}'.format(row[0], e))
+                continue
+            except RuntimeError as e:
+                logger.warning('{}: {}'.format(row[0], e))
+                continue
+
+            yield (file_id, frame_count, offsets, stats)
+
+    def remove_files(self, cache, conn, file_ids):
+        """Remove the frames found in the given files."""
+        values = [(file_id,) for file_id in file_ids]
+        conn.executemany('DELETE FROM garnett_frames WHERE file_id = ?', values)
+        conn.executemany('DELETE FROM garnett_pos_offsets WHERE file_id = ?', values)
+        conn.executemany('DELETE FROM garnett_frame_stats WHERE file_id = ?', values)
 
     @classmethod
     def check_adapters(cls):
@@ -145,24 +357,145 @@ class Garnett:
 
         for attr in cls.known_frame_attributes:
             upper_name = 'GARNETT_{}'.format(attr.upper())
-            sqlite3.register_converter(upper_name, convert_garnett_data)
+            sqlite3.register_converter(
+                upper_name, util.deferrable_converter(convert_garnett_data))
         cls.has_registered_adapters = True
 
     def __getstate__(self):
-        return [list(sorted(self.exclude_regexes)),
-                list(sorted(self.exclude_suffixes))]
+        result = [list(sorted(self.exclude_regexes)),
+                  list(sorted(self.exclude_suffixes))]
+        # only store non-default options so that previously-created
+        # caches keep recognizing their mines
+        if self.statistics:
+            result.append(self.statistics)
+        return result
 
     def __setstate__(self, state):
-        self.__init__(*state)
+        # statistics option was added later
+        (exclude_regexes, exclude_suffixes, statistics) = (list(state) + [False])[:3]
+        self.__init__(exclude_regexes, exclude_suffixes, statistics=statistics)
 
     @classmethod
-    def get_opened_trajectory(cls, cache, row, suffix):
-        open_mode = 'rb' if suffix in Garnett.binary_formats else 'r'
+    def scan_frames_(cls, opened_file, suffix):
+        """Return the number of frames in an opened file and, for pos
+        files (which must be opened in binary mode), the location of
+        each frame."""
+        if suffix == 'pos':
+            offsets = scan_pos_frames(opened_file)
+            if not offsets:
+                raise garnett.errors.ParserError('Did not read a single complete frame.')
+            return (len(offsets), offsets)
+
+        return (len(cls.readers[suffix]().read(opened_file)), None)
+
+    @classmethod
+    def frame_statistics_(cls, trajectory):
+        """Return a list of (frame, attribute, statistics) tuples
+        summarizing each attribute of every frame in a trajectory (see
+        :py:func:`pyqaxe.util.array_statistics`)."""
+        result = []
+        for frame in range(len(trajectory)):
+            frame_object = trajectory[frame]
+            for attribute in cls.known_frame_attributes:
+                try:
+                    value = getattr(frame_object, attribute)
+                except AttributeError:
+                    # attribute isn't available in this frame
+                    continue
+
+                if attribute == 'box':
+                    result.append((frame, 'box_volume', util.array_statistics(
+                        garnett_box_volume(value))))
+                    value = value.get_box_matrix()
+
+                stats = util.array_statistics(value)
+                if stats is not None:
+                    result.append((frame, attribute, stats))
+        return result
+
+    @classmethod
+    def read_pos_frame_(cls, cache, row, file_id, frame):
+        """Parse a single frame of a pos file using its stored location.
+
+        Returns None if the location of the frame is not known.
+
+        """
+        try:
+            locations = cache.connection_.execute(
+                'SELECT offset, length FROM garnett_pos_offsets '
+                'WHERE file_id = ? AND frame = ?', (file_id, frame)).fetchall()
+        except sqlite3.OperationalError:
+            # caches indexed by older versions have no offsets table
+            return None
+
+        if not locations:
+            return None
+        (offset, length) = locations[0]
+
+        with cache.pinned_file(row, 'rb') as opened_file:
+            with cls.read_lock_:
+                opened_file.seek(offset)
+                contents = opened_file.read(length)
+
+        # decode the text in the same way as files opened in text mode
+        stream = io.TextIOWrapper(io.BytesIO(contents))
+        return cls.readers['pos']().read(stream)[0]
+
+    @classmethod
+    def get_frame_cache_(cls):
+        try:
+            result = cls.frame_caches_.frames
+        except AttributeError:
+            result = cls.frame_caches_.frames = util.LRU_Cache(
+                read_garnett_frame, lambda frame: None, cls.frame_cache_size_)
+
+        if result.max_size != cls.frame_cache_size_:
+            result.max_size = cls.frame_cache_size_
+            result.trim()
+        return result
+
+    @classmethod
+    def get_frame_cache_size(cls):
+        """Return the maximum number of decoded frames to keep (in each thread)."""
+        return cls.frame_cache_size_
+
+    @classmethod
+    def set_frame_cache_size(cls, value):
+        """Set the maximum number of decoded frames to keep (in each thread)."""
+        cls.frame_cache_size_ = value
+
+    @classmethod
+    def get_frame_cache_stats(cls):
+        """Return a dictionary of hit, miss, and eviction counts for
+        decoded frames in the current thread."""
+        return cls.get_frame_cache_().stats()
+
+    @classmethod
+    def get_open_args_(cls, suffix):
+        open_mode = 'rb' if suffix in cls.binary_formats else 'r'
         named = suffix in cls.named_formats
-        opened_file = cache.open_file(row, open_mode, named=named)
+        return (open_mode, named)
 
-        if opened_file not in cls.opened_trajectories_:
-            opened_file.seek(0)
-            cls.opened_trajectories_[opened_file] = Garnett.readers[suffix]().read(opened_file)
+    @classmethod
+    def get_trajectory_(cls, opened_file, suffix):
+        with cls.opened_trajectories_lock_:
+            if opened_file not in cls.opened_trajectories_:
+                opened_file.seek(0)
+                cls.opened_trajectories_[opened_file] = cls.readers[suffix]().read(opened_file)
 
-        return cls.opened_trajectories_[opened_file]
+            return cls.opened_trajectories_[opened_file]
+
+    @classmethod
+    def get_opened_trajectory(cls, cache, row, suffix):
+        (open_mode, named) = cls.get_open_args_(suffix)
+        opened_file = cache.open_file(row, open_mode, named=named)
+        return cls.get_trajectory_(opened_file, suffix)
+
+    @classmethod
+    @contextlib.contextmanager
+    def pinned_trajectory(cls, cache, row, suffix):
+        """Context manager to open a trajectory, keeping its file open
+        until the context exits."""
+        (open_mode, named) = cls.get_open_args_(suffix)
+        with cache.pinned_file(row, open_mode, named=named) as opened_file:
+            yield cls.get_trajectory_(opened_file, suffix)
@@ -1,35 +1,172 @@
 import gtar
 import json
 import logging
+import os
+import pickle
 import re
 import sqlite3
+import tarfile
+import threading
+import urllib.parse
+import zipfile
 from .. import Cache, util
 
 logger = logging.getLogger(__name__)
 
 def open_gtar(cache_id, file_row):
     cache = Cache.get_opened_cache(cache_id)
-    opened_file = cache.open_file(file_row, 'rb', named=True)
-    gtar_traj = gtar.GTAR(opened_file.name, 'r')
-    return (opened_file, gtar_traj)
+    # keep the (possibly temporary) file alive for as long as the
+    # trajectory is open
+    opened_file = cache.pin_file(file_row, 'rb', named=True)
+    try:
+        gtar_traj = gtar.GTAR(opened_file.name, 'r')
+    except Exception:
+        cache.unpin_file(file_row, 'rb', named=True)
+        raise
+    # trajectories can be shared between threads, but only read by one at a time
+    lock = threading.Lock()
+    return (opened_file, gtar_traj, cache_id, file_row, lock)
 
 def close_gtar(args):
-    (opened_file, gtar_traj) = args
+    (opened_file, gtar_traj, cache_id, file_row, _) = args
     gtar_traj.close()
-    opened_file.close()
+    try:
+        cache = Cache.get_opened_cache(cache_id)
+    except KeyError:
+        opened_file.close()
+    else:
+        cache.unpin_file(file_row, 'rb', named=True)
+
+def gtar_size(args):
+    opened_file = args[0]
+    try:
+        return os.fstat(opened_file.fileno()).st_size
+    except OSError:
+        return 0
+
+def read_gtar_record(cache_id, file_row, path):
+    with GTAR.opened_trajectories_.pinned(cache_id, file_row) as args:
+        with args[4]:
+            return args[1].readPath(path)
+
+def read_cached_gtar_record(cache_id, file_id, update_time, file_row, path):
+    result = read_gtar_record(cache_id, file_row, path)
+    if hasattr(result, 'setflags'):
+        result.setflags(write=False)
+    return result
+
+def gtar_record_size(data):
+    try:
+        return data.nbytes
+    except AttributeError:
+        return len(data)
 
 def encode_gtar_data(path, file_id, cache_id):
     return json.dumps([path, file_id, cache_id]).encode('UTF-8')
 
+def encode_inline_gtar_data(data):
+    return pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL)
+
 def convert_gtar_data(contents):
+    # records stored in the database are pickles (which begin with
+    # the PROTO opcode) rather than JSON lists of their location
+    if contents[:1] == pickle.PROTO:
+        return pickle.loads(contents)
+
     (path, file_id, cache_id) = json.loads(contents.decode('UTF-8'))
     cache = Cache.get_opened_cache(cache_id)
-    for row in cache.query('SELECT * from files WHERE rowid = ?', (file_id,)):
-        # set row for open_file below
+    row = cache.get_file_row(file_id)
+
+    if not GTAR.decoded_records_.max_bytes:
+        return read_gtar_record(cache_id, row, path)
+
+    # the file's modification time is part of the key so that
+    # re-indexed files aren't read from stale entries
+    result = GTAR.decoded_records_(cache_id, file_id, row[2], row, path)
+    # give out read-only views so that the cached array can't be modified
+    return result.view() if hasattr(result, 'view') else result
+
+def gtar_record_sizes(filename):
+    """Return {path: size in bytes} for the records of a trajectory
+    file, taken from the listing of its members (zip and tar archives)
+    or its table of files (sqlite databases) without reading the
+    records themselves.
+
+    Returns an empty dictionary if the sizes can't be found this way.
+
+    """
+    try:
+        with open(filename, 'rb') as f:
+            header = f.read(16)
+
+        if header == b'SQLite format 3\x00':
+            uri = 'file:{}?mode=ro'.format(urllib.parse.quote(filename))
+            conn = sqlite3.connect(uri, uri=True)
+            try:
+                return dict(conn.execute('SELECT path, uncompressed_size FROM file_list'))
+            finally:
+                conn.close()
+        elif zipfile.is_zipfile(filename):
+            with zipfile.ZipFile(filename) as zf:
+                return {info.filename: info.file_size for info in zf.infolist()}
+        elif tarfile.is_tarfile(filename):
+            with tarfile.open(filename) as tf:
+                return {member.name: member.size for member in tf.getmembers()}
+    except (OSError, sqlite3.Error, zipfile.BadZipFile, tarfile.TarError):
         pass
 
-    (_, traj) = GTAR.opened_trajectories_(cache_id, row)
-    return traj.readPath(path)
+    return {}
+
+def gtar_record_metadata(traj, statistics=False, inline_bytes=0, filename=None):
+    """Return a list of (path, group, index, behavior, format,
+    resolution, name, statistics, inline) tuples for all records in an
+    opened trajectory.
+
+    If `statistics` is True, every record is read to find its
+    statistics (see :py:func:`pyqaxe.util.array_statistics`);
+    otherwise they are None. If `inline_bytes` is nonzero, `inline` is
+    the decoded data of records whose stored size is less than
+    `inline_bytes` bytes; otherwise it is None. Record sizes are found
+    from the trajectory file `filename` (see
+    :py:func:`gtar_record_sizes`), so that large records aren't read
+    just to be measured; records whose size isn't known are not
+    inlined.
+
+    """
+    sizes = {}
+    if inline_bytes and filename is not None:
+        sizes = gtar_record_sizes(filename)
+
+    result = []
+    for record in traj.getRecordTypes():
+        group = record.getGroup()
+        behavior = int(record.getBehavior())
+        format_ = int(record.getFormat())
+        resolution = int(record.getResolution())
+        name = record.getName()
+        for frame in traj.queryFrames(record):
+            record.setIndex(frame)
+            path = record.getPath()
+            (data, stats, inline) = (None, None, None)
+            if inline_bytes and sizes.get(path, inline_bytes) < inline_bytes:
+                data = inline = traj.readPath(path)
+            if statistics:
+                data = traj.readPath(path) if data is None else data
+                stats = util.array_statistics(data)
+            result.append((path, group, frame, behavior,
+                           format_, resolution, name, stats, inline))
+    return result
+
+def read_gtar_metadata(filename, mode, statistics=False, inline_bytes=0):
+    with gtar.GTAR(filename, 'r') as traj:
+        return gtar_record_metadata(traj, statistics, inline_bytes, filename)
+
+def gtar_index_key(index):
+    # a string that sorts (by plain byte comparison) in the same order
+    # as the gtar_frame collation: by length, then lexicographically
+    if index is None:
+        return None
+    return '{:08d}{}'.format(len(index), index)
 
 def collate_gtar_index(left, right):
     left = (len(left), left)
@@ -51,11 +188,15 @@ class GTAR:
     contents are read on-demand.
 
     :param exclude_frames_regexes: Iterable of regex patterns of quantity names that should be excluded as columns from `gtar_frames` table (see below)
+    :param processes: Number of processes to use to read the contents of archives when indexing (see below)
+    :param statistics: If True, read every record when indexing to store a summary of its contents (see below)
+    :param inline_bytes: Store the data of records smaller than this many bytes in the database when indexing (see below)
 
     GTAR objects create the following table in the database:
 
     - gtar_records: Contains links to data found in all getar-format files
     - gtar_frames: Contains sets of data stored by index for all getar-format files
+    - gtar_record_stats: Contains summaries of the data of records (only if `statistics=True`)
 
     The **gtar_records** table has the following columns:
 
@@ -68,55 +209,161 @@ class GTAR:
     - name: *name* for the record
     - file_id: files table identifier for the archive containing this record
     - data: exposes the data of the record. Value is a string, bytes, or array-like object depending on the stored format.
+    - gtar_index_key: sort key for *index* (see below)
 
     The **gtar_frames** table's columns depend on which records are
     found among the indexed files. For each unique index, it lists all
     quantities found among all archives as columns (note that some
     quantity names may need to be surrounded by quotes) up to that
-    index. gtar_frames contains the following additional columns:
+    index. When the mine is re-indexed, only the rows for newly
+    indexed archives are rebuilt, and columns are added as new
+    quantity names are found. gtar_frames contains the following
+    additional columns:
 
     - gtar_index: *index* for the records
+    - gtar_index_key: sort key for *index* (see below)
     - file_id: files table identifier for the archive containing this record
 
     :
         cache.query('SELECT box, position FROM gtar_frames')
 
-    GTAR objects register a **gtar_frame** collation that can be used
-    to sort indices in the standard GTAR way, rather than sqlite's
-    default string comparison::
+    **Sorting by index**: The **gtar_index_key** column of both tables
+    is a string that sqlite sorts natively in the standard GTAR way
+    (by length, then lexicographically), rather than sqlite's default
+    string comparison. It is indexed, so ordering by it or filtering
+    a range of frames is much faster than comparing `gtar_index`
+    directly. The **gtar_frame_key** SQL function converts an index
+    into its key::
+
+        cache.query('SELECT data FROM gtar_records WHERE name = "position" '
+                    'ORDER BY gtar_index_key')
+        cache.query('SELECT position FROM gtar_frames WHERE gtar_index_key '
+                    'BETWEEN gtar_frame_key("100") AND gtar_frame_key("200")')
+
+    For compatibility, GTAR objects also register a **gtar_frame**
+    collation that sorts `gtar_index` values in the same order::
 
         cache.query('SELECT data FROM gtar_records WHERE name = "position" '
                     'ORDER BY gtar_index COLLATE gtar_frame')
 
+    **Decoded data cache**: By default, record data are read from
+    their archive each time they are selected. Decoded records can
+    instead be kept in memory, up to a given total size in bytes, by
+    calling :py:meth:`set_data_cache_bytes`; the least-recently-used
+    records are discarded first. Records are decoded outside of the
+    cache's lock, so threads can decode different records at the same
+    time. Arrays returned from the cache are read-only views, so they
+    must be copied before being modified::
+
+        GTAR.set_data_cache_bytes(512*1024*1024)
+        cache.query('SELECT position FROM gtar_frames')
+        print(GTAR.get_data_cache_stats())
+
+    **Parallel indexing**: Reading the list of records stored in
+    each archive can be slow for large zip or sqlite files. With
+    `processes=N`, archives are opened by a pool of N worker
+    processes while the records they find are inserted into the
+    database by the indexing process; the resulting tables are
+    identical to those built by a serial index. Like the
+    `exclude_frames_regexes` option, the number of processes is not
+    stored in the database, so it must be given again when a cache is
+    reopened in order to be used::
+
+        cache.index(GTAR(processes=8))
+
+    **Record statistics**: With `statistics=True`, the data of every
+    record are read once when archives are indexed and summarized in
+    the **gtar_record_stats** table, which has the following columns:
+
+    - file_id, path: identify the record in gtar_records
+    - length: size of the first axis of the data (number of characters for text)
+    - size: total number of elements of the data
+    - ndim: number of dimensions of the data
+    - shape: shape of the data, as a JSON list
+    - dtype: numpy dtype of the data (or "str" or "bytes")
+    - minimum, maximum, mean: statistics of numeric data (otherwise null)
+
+    Records can then be filtered by their size or values without
+    reading any archives::
+
+        cache.index(GTAR(statistics=True))
+        cache.query('SELECT r.data FROM gtar_records AS r '
+                    'JOIN gtar_record_stats USING (file_id, path) '
+                    'WHERE r.name = "position" AND length > 10000')
+
+    **Inline records**: Selecting data normally opens the archive
+    containing each record (first copying it to a temporary file, if
+    it is inside another archive). With `inline_bytes=N`, the data of
+    records whose stored size is less than N bytes (such as boxes,
+    type names, or scalar quantities) are instead copied into the
+    database when archives are indexed, so selecting them never
+    touches the archive. Record sizes are taken from the archive's
+    listing of its members, so only the records that are copied are
+    read while indexing::
+
+        cache.index(GTAR(inline_bytes=1024))
+        cache.query('SELECT box FROM gtar_frames')
+
     .. note::
         Consult the libgetar documentation to find more details about
         how records are encoded.
 
     """
-    opened_trajectories_ = util.LRU_Cache(open_gtar, close_gtar, 16)
+    opened_trajectories_ = util.LRU_Cache(open_gtar, close_gtar, 16, sizer=gtar_size)
+    decoded_records_ = util.LRU_Cache(
+        read_cached_gtar_record, lambda data: None, 1 << 20, max_bytes=None,
+        sizer=gtar_record_size)
+    GTAR_FRAMES_KEY_COLUMNS = ('file_id', 'gtar_group', 'gtar_index', 'gtar_index_key')
     GTAR_FRAMES_COLUMN_WARNING = 128
     GTAR_FRAMES_COLUMN_SKIP = 512
 
-    def __init__(self, exclude_frames_regexes=(r'\.',)):
+    def __init__(self, exclude_frames_regexes=(r'\.',), processes=None, statistics=False,
+                 inline_bytes=0):
         self.exclude_frames_regexes = set(exclude_frames_regexes)
+        self.processes = processes
+        self.statistics = bool(statistics)
+        self.inline_bytes = int(inline_bytes or 0)
         self.compiled_frames_regexes_ = [re.compile(pat) for pat in self.exclude_frames_regexes]
 
-    def index(self, cache, conn, mine_id=None, force=False):
+    def register(self, cache, conn, mine_id=None):
+        """Register the gtar_frame collation and gtar_frame_key function
+        with a connection."""
         self.check_adapters()
 
         conn.create_collation('gtar_frame', collate_gtar_index)
+        try:
+            conn.create_function('gtar_frame_key', 1, gtar_index_key, deterministic=True)
+        except TypeError:
+            # deterministic argument requires python 3.8
+            conn.create_function('gtar_frame_key', 1, gtar_index_key)
+
+    def index(self, cache, conn, mine_id=None, force=False):
+        self.register(cache, conn, mine_id)
 
         conn.execute('CREATE TABLE IF NOT EXISTS gtar_records '
                      '(path TEXT, gtar_group TEXT, gtar_index TEXT, '
                      'gtar_behavor INTEGER, gtar_format INTEGER, '
                      'gtar_resolution INTEGER, name TEXT, '
-                     'file_id INTEGER, data GTAR_DATA, '
+                     'file_id INTEGER, data GTAR_DATA, gtar_index_key TEXT, '
                      'CONSTRAINT unique_gtar_path '
                      'UNIQUE (path, file_id) ON CONFLICT IGNORE)')
 
-        conn.execute('CREATE INDEX IF NOT EXISTS gtar_record_fileids '
-                     'ON gtar_records (file_id, gtar_group, '
-                     'gtar_index COLLATE gtar_frame)')
+        if not cache.read_only:
+            self.add_index_keys_(conn)
+
+            conn.execute('CREATE INDEX IF NOT EXISTS gtar_record_keys '
+                         'ON gtar_records (file_id, gtar_group, gtar_index_key)')
+            conn.execute('CREATE INDEX IF NOT EXISTS gtar_record_name_keys '
+                         'ON gtar_records (name, gtar_index_key)')
+
+            # read-only caches indexed by older versions may not have
+            # this table, in which case no statistics are available
+            conn.execute('CREATE TABLE IF NOT EXISTS gtar_record_stats '
+                         '(file_id INTEGER, path TEXT, length INTEGER, size INTEGER, '
+                         'ndim INTEGER, shape TEXT, dtype TEXT, minimum REAL, '
+                         'maximum REAL, mean REAL, '
+                         'CONSTRAINT unique_gtar_record_stats '
+                         'UNIQUE (file_id, path) ON CONFLICT REPLACE)')
 
         # don't do file IO if we aren't forced
         if not force or cache.read_only:
@@ -127,15 +374,142 @@ class GTAR:
                 (mine_id,)):
             pass
 
-        for row in conn.execute(
-                'SELECT rowid, * from files WHERE (update_time > ?) AND '
-                '(path LIKE "%.zip" OR path LIKE "%.tar" OR path LIKE "%.sqlite")',
-                (mine_update_time,)):
+        rows = conn.execute(
+            'SELECT rowid, * from files WHERE suffix IN ("zip", "tar", "sqlite") '
+            'AND update_time > ?', (mine_update_time,)).fetchall()
+
+        if not self.processes or self.processes <= 1:
+            read_metadata = self.read_metadata_serial_
+        else:
+            read_metadata = self.read_metadata_parallel_
+
+        indexed_file_ids = []
+        with cache.batch_writer(conn) as writer:
+            for (file_id, row, metadata) in read_metadata(cache, rows):
+                self.index_records_(cache, writer, file_id, metadata)
+                indexed_file_ids.append(file_id)
+
+        with cache.batch_writer(conn) as writer:
+            self.update_frames_(conn, writer, indexed_file_ids)
+
+    def add_index_keys_(self, conn):
+        """Add and populate gtar_index_key columns for tables created by
+        older versions."""
+        for table in ['gtar_records', 'gtar_frames']:
+            columns = [row[1] for row in conn.execute('PRAGMA table_info({})'.format(table))]
+            if not columns or 'gtar_index_key' in columns:
+                continue
+
+            conn.execute('ALTER TABLE {} ADD COLUMN gtar_index_key TEXT'.format(table))
+            conn.execute('UPDATE {} SET gtar_index_key = gtar_frame_key(gtar_index)'.format(table))
+
+            if table == 'gtar_records':
+                # this index called the python collation for every comparison
+                conn.execute('DROP INDEX IF EXISTS gtar_record_fileids')
+            else:
+                conn.execute('CREATE INDEX IF NOT EXISTS gtar_frame_fileids '
+                             'ON gtar_frames (file_id)')
+                conn.execute('CREATE INDEX IF NOT EXISTS gtar_frame_keys '
+                             'ON gtar_frames (gtar_index_key)')
+
+    def get_frames_columns_(self, conn):
+        """Return the list of quantity columns in gtar_frames, or None
+        if the table doesn't exist."""
+        columns = [row[1] for row in conn.execute('PRAGMA table_info(gtar_frames)')]
+        if not columns:
+            return None
+        return [column for column in columns if column not in self.GTAR_FRAMES_KEY_COLUMNS]
+
+    def filter_frames_names_(self, names):
+        return [name for name in names if
+                all(pat.search(name) is None for pat in self.compiled_frames_regexes_)]
+
+    def update_frames_(self, conn, writer, file_ids):
+        """Rebuild the gtar_frames rows for the given files, creating the
+        table or adding columns to it as needed."""
+        columns = self.get_frames_columns_(conn)
+
+        if columns is None:
+            file_ids = [row[0] for row in conn.execute(
+                'SELECT DISTINCT file_id FROM gtar_records')]
+            new_names = self.filter_frames_names_(row[0] for row in conn.execute(
+                'SELECT DISTINCT name FROM gtar_records'))
+            columns = []
+        else:
+            names = set()
+            for file_id in file_ids:
+                names.update(row[0] for row in conn.execute(
+                    'SELECT DISTINCT name FROM gtar_records WHERE file_id = ?',
+                    (file_id,)))
+            new_names = self.filter_frames_names_(names.difference(columns))
+
+        column_count = len(columns) + len(new_names)
+        if column_count > self.GTAR_FRAMES_COLUMN_SKIP:
+            logger.warning('Attempting to create {} columns in gtar_frames, '
+                           'skipping instead'.format(column_count))
+            conn.execute('DROP TABLE IF EXISTS gtar_frames')
+            return
+        elif new_names and column_count > self.GTAR_FRAMES_COLUMN_WARNING:
+            logger.warning('Creating {} columns in gtar_frames'.format(column_count))
+
+        if not columns:
+            column_defs = ['file_id INTEGER', 'gtar_group TEXT', 'gtar_index TEXT',
+                           'gtar_index_key TEXT']
+            column_defs.extend([
+                '"{name}" GTAR_DATA'.format(name=name) for name in sorted(new_names)
+            ])
+            query = ('CREATE TABLE gtar_frames ({})').format(
+                ', '.join(column_defs))
+            conn.execute(query)
+            conn.execute('CREATE INDEX gtar_frame_fileids ON gtar_frames (file_id)')
+            conn.execute('CREATE INDEX gtar_frame_keys ON gtar_frames (gtar_index_key)')
+        else:
+            for name in sorted(new_names):
+                conn.execute('ALTER TABLE gtar_frames ADD COLUMN '
+                             '"{name}" GTAR_DATA'.format(name=name))
+        columns = columns + sorted(new_names)
+
+        conn.executemany('DELETE FROM gtar_frames WHERE file_id = ?',
+                         [(file_id,) for file_id in file_ids])
+        for file_id in file_ids:
+            self.pivot_frames_(conn, writer, file_id, columns)
+
+    def pivot_frames_(self, conn, writer, file_id, names):
+        """Insert the gtar_frames rows for a single file."""
+        insert_columns = list(self.GTAR_FRAMES_KEY_COLUMNS) + names
+        name_column_indices = {name: i for (i, name) in enumerate(names)}
+        last_group_index = (None, None, None)
+        current_row = [None]*len(names)
+        for (group, index, key, name, data) in conn.execute(
+                # pass data through a function to make the record stay
+                # as a bytestring rather than being automatically read
+                'SELECT gtar_group, gtar_index, gtar_index_key, name, likely(data) FROM '
+                'gtar_records WHERE file_id = ? '
+                'ORDER BY gtar_group, gtar_index_key', (file_id,)):
+
+            group_index = (group, index, key)
+            if (group_index != last_group_index and
+                any(val is not None for val in current_row)):
+
+                writer.insert('gtar_frames', (file_id,) + last_group_index + tuple(current_row),
+                              columns=insert_columns)
+                if group != last_group_index[0]:
+                    current_row = [None]*len(names)
+
+            last_group_index = group_index
+            if name in name_column_indices:
+                current_row[name_column_indices[name]] = data
+        if any(val is not None for val in current_row):
+            writer.insert('gtar_frames', (file_id,) + last_group_index + tuple(current_row),
+                          columns=insert_columns)
+
+    def read_metadata_serial_(self, cache, rows):
+        for row in rows:
             file_id = row[0]
             row = row[1:]
 
             try:
-                (_, traj) = GTAR.opened_trajectories_(cache.unique_id, row)
+                (opened_file, traj) = GTAR.opened_trajectories_.pin(cache.unique_id, row)[:2]
             except RuntimeError as e:
                 # gtar library throws RuntimeErrors when archives are
                 # corrupted, for example; skip this one with a warning
@@ -145,69 +519,58 @@ class GTAR:
                 logger.warning('{}: {}'.format(row[0], e))
                 continue
 
-            for record in traj.getRecordTypes():
-                group = record.getGroup()
-                behavior = record.getBehavior()
-                format_ = record.getFormat()
-                resolution = record.getResolution()
-                name = record.getName()
-                for frame in traj.queryFrames(record):
-                    record.setIndex(frame)
-                    path = record.getPath()
-
-                    encoded_data = encode_gtar_data(
-                        path, file_id, cache.unique_id)
-                    values = (path, group, frame, behavior, format_,
-                              resolution, name, file_id, encoded_data)
-                    conn.execute(
-                        'INSERT INTO gtar_records VALUES '
-                        '(?, ?, ?, ?, ?, ?, ?, ?, ?)', values)
-
-        conn.execute('DROP TABLE IF EXISTS gtar_frames')
-
-        all_names = list(sorted(row[0] for row in conn.execute(
-            'SELECT DISTINCT name FROM gtar_records') if
-            all(pat.search(row[0]) is None for pat in self.compiled_frames_regexes_)))
-        column_defs = ['file_id INTEGER', 'gtar_group TEXT', 'gtar_index TEXT']
-        column_defs.extend([
-            '"{name}" GTAR_DATA'.format(name=name) for name in all_names
-        ])
-
-        if len(all_names) > self.GTAR_FRAMES_COLUMN_SKIP:
-            logger.warning('Attempting to create {} columns in gtar_frames, '
-                           'skipping instead'.format(len(all_names)))
-            return
-        elif len(all_names) > self.GTAR_FRAMES_COLUMN_WARNING:
-            logger.warning('Creating {} columns in gtar_frames'.format(len(all_names)))
-
-        query = ('CREATE TABLE gtar_frames ({})').format(
-            ', '.join(column_defs))
-        conn.execute(query)
-
-        name_column_indices = {name: i for (i, name) in enumerate(all_names)}
-        last_fileid_group_index = (None, None, None)
-        current_row = [None]*len(all_names)
-        insert_query = 'INSERT INTO gtar_frames VALUES ({})'.format(
-            ', '.join((len(last_fileid_group_index) + len(all_names))*'?'))
-        for (fileid, group, index, name, data) in cache.query(
-                # pass data through a function to make the record stay
-                # as a bytestring rather than being automatically read
-                'SELECT file_id, gtar_group, gtar_index, name, likely(data) FROM '
-                'gtar_records ORDER BY file_id, gtar_group, gtar_index COLLATE gtar_frame'):
+            try:
+                # reading individual records (for statistics or inline
+                # data) can fail the same way as opening the archive
+                metadata = gtar_record_metadata(
+                    traj, self.statistics, self.inline_bytes, opened_file.name)
+            except RuntimeError as e:
+                logger.warning('{}: {}'.format(row[0], e))
+                continue
+            finally:
+                GTAR.opened_trajectories_.unpin(cache.unique_id, row)
 
-            fileid_group_index = (fileid, group, index)
-            if (fileid_group_index != last_fileid_group_index and
-                any(val is not None for val in current_row)):
+            yield (file_id, row, metadata)
 
-                conn.execute(insert_query, list(last_fileid_group_index) + list(current_row))
-                if fileid_group_index[:2] != last_fileid_group_index[:2]:
-                    current_row = [None]*len(all_names)
+    def read_metadata_parallel_(self, cache, rows):
+        tasks = ((row[0], row[1:], 'rb', (self.statistics, self.inline_bytes))
+                 for row in rows)
+        for ((file_id, row, _, _), future) in util.map_cached_files(
+                cache, tasks, read_gtar_metadata, self.processes):
+            try:
+                metadata = future.result()
+            except RuntimeError as e:
+                logger.warning('{}: {}'.format(row[0], e))
+                continue
+            except PermissionError as e:
+                logger.warning('{}: {}'.format(row[0], e))
+                continue
 
-            last_fileid_group_index = fileid_group_index
-            if name in name_column_indices:
-                current_row[name_column_indices[name]] = data
-        if any(val is not None for val in current_row):
-            conn.execute(insert_query, list(last_fileid_group_index) + list(current_row))
+            yield (file_id, row, metadata)
+
+    def index_records_(self, cache, writer, file_id, metadata):
+        for (path, group, frame, behavior, format_, resolution, name, stats, inline) in metadata:
+            if inline is not None:
+                encoded_data = encode_inline_gtar_data(inline)
+            else:
+                encoded_data = encode_gtar_data(path, file_id, cache.unique_id)
+            values = (path, group, frame, behavior, format_,
+                      resolution, name, file_id, encoded_data,
+                      gtar_index_key(frame))
+            writer.insert('gtar_records', values)
+
+            if stats is not None:
+                writer.insert('gtar_record_stats', (file_id, path) + stats)
+
+    def remove_files(self, cache, conn, file_ids):
+        """Remove the records found in the given files."""
+        values = [(file_id,) for file_id in file_ids]
+        conn.executemany('DELETE FROM gtar_records WHERE file_id = ?', values)
+        conn.executemany('DELETE FROM gtar_record_stats WHERE file_id = ?', values)
+
+        for _ in conn.execute('SELECT name FROM sqlite_master WHERE '
+                              'type = "table" AND name = "gtar_frames"'):
+            conn.executemany('DELETE FROM gtar_frames WHERE file_id = ?', values)
 
     @classmethod
     def check_adapters(cls):
@@ -218,14 +581,24 @@ class GTAR:
             # hasn't been registered yet, run the rest of this function
             pass
 
-        sqlite3.register_converter('GTAR_DATA', convert_gtar_data)
+        sqlite3.register_converter('GTAR_DATA', util.deferrable_converter(convert_gtar_data))
         cls.has_registered_adapters = True
 
     def __getstate__(self):
-        return [list(sorted(self.exclude_frames_regexes))]
+        result = [list(sorted(self.exclude_frames_regexes))]
+        # only store non-default options so that previously-created
+        # caches keep recognizing their mines
+        if self.statistics or self.inline_bytes:
+            result.append(self.statistics)
+        if self.inline_bytes:
+            result.append(self.inline_bytes)
+        return result
 
     def __setstate__(self, state):
-        self.__init__(*state)
+        # statistics and inline_bytes options were added later
+        (exclude_frames_regexes, statistics, inline_bytes) = (list(state) + [False, 0])[:3]
+        self.__init__(exclude_frames_regexes, statistics=statistics,
+                      inline_bytes=inline_bytes)
 
     @classmethod
     def get_cache_size(cls):
@@ -236,3 +609,46 @@ class GTAR:
     def set_cache_size(cls, value):
         """Set the maximum number of files to keep open."""
         cls.opened_trajectories_.max_size = value
+
+    @classmethod
+    def get_cache_bytes(cls):
+        """Return the maximum total size (in bytes) of files to keep open."""
+        return cls.opened_trajectories_.max_bytes
+
+    @classmethod
+    def set_cache_bytes(cls, value):
+        """Set the maximum total size (in bytes) of files to keep open.
+
+        Set to None to disable the limit.
+
+        """
+        cls.opened_trajectories_.max_bytes = value
+        cls.opened_trajectories_.trim()
+
+    @classmethod
+    def get_cache_stats(cls):
+        """Return a dictionary of hit, miss, and eviction counts for opened files."""
+        return cls.opened_trajectories_.stats()
+
+    @classmethod
+    def get_data_cache_bytes(cls):
+        """Return the maximum total size (in bytes) of decoded records to keep in memory."""
+        return cls.decoded_records_.max_bytes
+
+    @classmethod
+    def set_data_cache_bytes(cls, value):
+        """Set the maximum total size (in bytes) of decoded records to keep in memory.
+
+        Set to None (default) or 0 to disable caching of decoded records.
+
+        """
+        cls.decoded_records_.max_bytes = value
+        if value:
+            cls.decoded_records_.trim()
+        else:
+            cls.decoded_records_.clear()
+
+    @classmethod
+    def get_data_cache_stats(cls):
+        """Return a dictionary of hit, miss, and eviction counts for decoded records."""
+        return cls.decoded_records_.stats()
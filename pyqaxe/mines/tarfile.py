@@ -1,18 +1,28 @@
+import bz2
 import datetime
+import gzip
 import io
+import lzma
 import logging
 import os
 import re
+import sqlite3
 import stat
 import tarfile
+import threading
 import weakref
 
-from .. import Cache
+try:
+    import indexed_gzip
+except ImportError:
+    indexed_gzip = None
+
+from .. import Cache, util
 
 logger = logging.getLogger(__name__)
 
 class TarFile:
-    """Expose the files within one or more tar-format archives.
+    """Expose the files within one or more (possibly compressed) tar-format archives.
 
     `TarFile` populates the files table from one or more "source" tar
     archives. These archives can be entries that have been found by
@@ -38,6 +48,26 @@ class TarFile:
     to the files table. Relative link pathss are interpreted with
     respect to the tar file they come from.
 
+    **Member locations**: When an archive is indexed, the location and
+    size of each member's data within the archive are stored in the
+    **tarfile_members** table (with columns parent, path, offset,
+    size, and compression). Members of uncompressed archives are then
+    opened by reading directly from that location, without scanning
+    the headers of the archive first. They can also be accessed
+    without copying as slices of a memory map of the archive using
+    :py:meth:`pyqaxe.Cache.map_file`.
+
+    **Compressed archives**: Archives compressed with gzip, bzip2, or
+    xz (i.e. `.tar.gz`, `.tgz`, `.tar.bz2`, or `.tar.xz` files) can be
+    indexed as well. Normally, reading a member of a compressed
+    archive requires decompressing the archive up to that member. If
+    the `indexed_gzip` package is installed (`pip install pyqaxe[gzip]`),
+    the decompressor state
+    is saved every `GZIP_CHECKPOINT_SPACING` bytes while gzip-compressed
+    archives are indexed (in the **tarfile_checkpoints** table), so
+    members can be read by decompressing only from the nearest
+    checkpoint.
+
     Examples::
 
         cache.index(TarFile('archive.tar', relative=True))
@@ -47,6 +77,15 @@ class TarFile:
 
     # map opened file objects -> tarfile objects
     opened_tarfiles_ = weakref.WeakKeyDictionary()
+    opened_tarfiles_lock_ = threading.Lock()
+    # map opened file objects -> seekable decompressed gzip streams
+    opened_gzips_ = weakref.WeakKeyDictionary()
+
+    TARFILE_SUFFIXES = ('.tar', '.tgz', '.tar.gz', '.tbz', '.tbz2',
+                        '.tar.bz2', '.txz', '.tar.xz')
+
+    # uncompressed bytes between saved decompressor states
+    GZIP_CHECKPOINT_SPACING = 4*1024*1024
 
     def __init__(self, target=None, exclude_regexes=(), exclude_suffixes=(), relative=False):
         self.exclude_regexes = set(exclude_regexes)
@@ -71,43 +110,174 @@ class TarFile:
             self.target = os.path.relpath(self.target, self.relative_to)
 
     def index(self, cache, conn, mine_id=None, force=False):
+        if not cache.read_only:
+            # read-only caches indexed by older versions may not have
+            # these tables; members are then read through tarfile
+            conn.execute('CREATE TABLE IF NOT EXISTS tarfile_members '
+                         '(parent INTEGER, path TEXT, offset INTEGER, '
+                         'size INTEGER, compression TEXT, '
+                         'CONSTRAINT unique_tarfile_member '
+                         'UNIQUE (parent, path) ON CONFLICT REPLACE)')
+            conn.execute('CREATE TABLE IF NOT EXISTS tarfile_checkpoints '
+                         '(file_id INTEGER, spacing INTEGER, data BLOB, '
+                         'CONSTRAINT unique_tarfile_checkpoint '
+                         'UNIQUE (file_id) ON CONFLICT REPLACE)')
+
         if not force or cache.read_only:
             return
 
-        files_to_index = []
-        if self.target is not None:
-            target = self.target
-            if self.relative_to:
-                target = os.path.join(self.relative_to, target)
-            stat_ = os.stat(target)
-            mtime = datetime.datetime.fromtimestamp(stat_.st_mtime)
-            rowid = cache.insert_file(conn, None, target, mtime, None).lastrowid
-            for row in conn.execute('SELECT rowid, path, * from files WHERE rowid = ?', (rowid,)):
-                files_to_index.append(row)
-        else:
-            for row in conn.execute('SELECT rowid, path, * from files WHERE path LIKE "%.tar"'):
-                files_to_index.append(row)
+        with cache.batch_writer(conn) as writer:
+            files_to_index = []
+            if self.target is not None:
+                target = self.target
+                if self.relative_to:
+                    target = os.path.join(self.relative_to, target)
+                stat_ = os.stat(target)
+                mtime = datetime.datetime.fromtimestamp(stat_.st_mtime)
+                rowid = cache.insert_file(
+                    conn, None, target, mtime, None, writer=writer, returning=True)
+                for row in conn.execute('SELECT rowid, path, * from files WHERE rowid = ?', (rowid,)):
+                    files_to_index.append(row)
+            else:
+                suffixes = {name.rsplit('.', 1)[-1] for name in self.TARFILE_SUFFIXES}
+                for row in conn.execute(
+                        'SELECT rowid, path, * from files WHERE suffix IN ({})'.format(
+                            ', '.join('"{}"'.format(suffix) for suffix in sorted(suffixes)))):
+                    if row[1].lower().endswith(self.TARFILE_SUFFIXES):
+                        files_to_index.append(row)
+
+            for row in files_to_index:
+                tf_id, tf_path, row = row[0], row[1], row[2:]
+                if indexed_gzip is not None and self.is_gzip_(cache.open_file(row, 'rb')):
+                    self.index_gzip_contents_(cache, conn, mine_id, tf_id, tf_path, row, writer)
+                    continue
 
-        for row in files_to_index:
-            tf_id, tf_path, row = row[0], row[1], row[2:]
-            tf = self.get_opened_tarfile(cache, row)
-            self.index_contents_(tf, cache, conn, mine_id, tf_id, tf_path)
+                tf = self.get_opened_tarfile(cache, row)
+                self.index_contents_(tf, cache, conn, mine_id, tf_id, tf_path, writer)
 
-    def index_contents_(self, tf, cache, conn, mine_id, tf_id, tf_path):
+    def index_gzip_contents_(self, cache, conn, mine_id, tf_id, tf_path, row, writer):
+        with cache.pinned_file(row, 'rb') as opened_file:
+            opened_file.seek(0)
+            stream = indexed_gzip.IndexedGzipFile(
+                fileobj=opened_file, spacing=self.GZIP_CHECKPOINT_SPACING)
+            tf = tarfile.open(fileobj=stream, mode='r:')
+            self.index_contents_(tf, cache, conn, mine_id, tf_id, tf_path, writer, 'gz')
+
+            stream.build_full_index()
+            checkpoints = io.BytesIO()
+            stream.raw.export_index(fileobj=checkpoints)
+            writer.insert('tarfile_checkpoints', (
+                tf_id, self.GZIP_CHECKPOINT_SPACING, checkpoints.getvalue()))
+
+            with self.opened_tarfiles_lock_:
+                self.opened_gzips_[opened_file] = stream
+
+    def index_contents_(self, tf, cache, conn, mine_id, tf_id, tf_path, writer,
+                        compression=None):
+        if compression is None:
+            compression = self.get_compression_(tf)
         for entry in tf:
             if entry.isfile():
                 mtime = datetime.datetime.fromtimestamp(entry.mtime)
-                cache.insert_file(conn, mine_id, entry.name, mtime, tf_id)
+                cache.insert_file(conn, mine_id, entry.name, mtime, tf_id, writer=writer)
+                if not entry.issparse():
+                    writer.insert('tarfile_members', (
+                        tf_id, entry.name, entry.offset_data, entry.size, compression))
             elif entry.issym():
                 path = os.path.join(tf_path, entry.linkname)
                 try:
                     stat_ = os.stat(path)
                     mtime = datetime.datetime.fromtimestamp(stat_.st_mtime)
                     if stat.S_ISREG(stat_.st_mode):
-                        cache.insert_file(conn, mine_id, entry.linkname, mtime, None)
+                        cache.insert_file(
+                            conn, mine_id, entry.linkname, mtime, None, writer=writer)
                 except FileNotFoundError:
                     logger.debug('Skipping TarFile symbolic link "{}"'.format(path))
 
+    def remove_files(self, cache, conn, file_ids):
+        """Remove the member locations of the given archives."""
+        values = [(file_id,) for file_id in file_ids]
+        conn.executemany('DELETE FROM tarfile_members WHERE parent = ?', values)
+        conn.executemany('DELETE FROM tarfile_checkpoints WHERE file_id = ?', values)
+
+    @staticmethod
+    def get_compression_(tf):
+        """Return the name of the compression used by an opened tarfile
+        ('' for uncompressed archives)."""
+        compressions = [(gzip.GzipFile, 'gz'), (bz2.BZ2File, 'bz2'),
+                        (lzma.LZMAFile, 'xz')]
+        for (cls, name) in compressions:
+            if isinstance(tf.fileobj, cls):
+                return name
+        return ''
+
+    @staticmethod
+    def is_gzip_(opened_file):
+        opened_file.seek(0)
+        return opened_file.read(2) == b'\x1f\x8b'
+
+    @classmethod
+    def get_opened_gzip_(cls, cache, parent, opened_file):
+        """Return a seekable stream of the decompressed contents of an
+        opened gzip-compressed archive, or None if no checkpoints were
+        saved for it."""
+        if indexed_gzip is None:
+            return None
+
+        with cls.opened_tarfiles_lock_:
+            if opened_file in cls.opened_gzips_:
+                return cls.opened_gzips_[opened_file]
+
+        try:
+            rows = cache.connection_.execute(
+                'SELECT spacing, data FROM tarfile_checkpoints WHERE file_id = ?',
+                (parent,)).fetchall()
+        except sqlite3.OperationalError:
+            return None
+        if not rows:
+            return None
+        (spacing, data) = rows[0]
+
+        with cls.opened_tarfiles_lock_:
+            if opened_file not in cls.opened_gzips_:
+                with util.FileSlice.read_lock_:
+                    opened_file.seek(0)
+                    stream = indexed_gzip.IndexedGzipFile(
+                        fileobj=opened_file, spacing=spacing)
+                    stream.raw.import_index(fileobj=io.BytesIO(data))
+                cls.opened_gzips_[opened_file] = stream
+            return cls.opened_gzips_[opened_file]
+
+    @staticmethod
+    def get_member_location_(cache, parent, filename):
+        try:
+            rows = cache.connection_.execute(
+                'SELECT offset, size, compression FROM tarfile_members '
+                'WHERE parent = ? AND path = ?', (parent, filename)).fetchall()
+        except sqlite3.OperationalError:
+            # caches indexed by older versions have no member table
+            return None
+
+        return rows[0] if rows else None
+
+    def map_file(self, filename, owning_cache, parent):
+        """Return a read-only view of a member of an uncompressed archive,
+        sliced from the mapping of the archive itself.
+
+        Returns None if the member can't be mapped directly.
+
+        """
+        if parent is None:
+            return None
+
+        location = self.get_member_location_(owning_cache, parent, filename)
+        if location is None or location[2] != '':
+            return None
+
+        (offset, size, _) = location
+        archive = owning_cache.map_file(owning_cache.get_file_row(parent))
+        return archive[offset:offset + size]
+
     def __getstate__(self):
         return [self.target, list(sorted(self.exclude_regexes)),
                 list(sorted(self.exclude_suffixes)), self.relative]
@@ -126,24 +296,43 @@ class TarFile:
     def get_opened_tarfile(cls, cache, row):
         opened_file = cache.open_file(row, 'rb')
 
-        if opened_file not in cls.opened_tarfiles_:
-            opened_file.seek(0)
-            cls.opened_tarfiles_[opened_file] = tarfile.open(fileobj=opened_file)
-        return cls.opened_tarfiles_[opened_file]
+        with cls.opened_tarfiles_lock_:
+            if opened_file not in cls.opened_tarfiles_:
+                opened_file.seek(0)
+                cls.opened_tarfiles_[opened_file] = tarfile.open(fileobj=opened_file)
+            return cls.opened_tarfiles_[opened_file]
 
     def open(self, filename, mode='r', owning_cache=None, parent=None):
         # links
         if parent is None:
             return open(filename, mode)
 
-        for parent_row in owning_cache.query(
-                'SELECT * FROM files WHERE rowid = ?', (parent,)):
-            pass
+        parent_row = owning_cache.get_file_row(parent)
+        location = self.get_member_location_(owning_cache, parent, filename)
 
-        tf = self.get_opened_tarfile(owning_cache, parent_row)
+        raw = None
+        if location is not None and location[2] in ('', 'gz'):
+            (offset, size, compression) = location
+            # keep the archive open for as long as the member is
+            archive = owning_cache.pin_file(parent_row, 'rb')
+            unpin = lambda: owning_cache.unpin_file(parent_row, 'rb')
+
+            if compression == '':
+                raw = util.FileSlice(archive, offset, size, unpin)
+            else:
+                stream = self.get_opened_gzip_(owning_cache, parent, archive)
+                if stream is not None:
+                    raw = util.FileSlice(stream, offset, size, unpin, pread=False)
+                else:
+                    unpin()
+
+        if raw is not None:
+            result = io.BufferedReader(raw)
+        else:
+            tf = self.get_opened_tarfile(owning_cache, parent_row)
+            member = tf.getmember(filename)
+            result = tf.extractfile(member)
 
-        member = tf.getmember(filename)
-        result = tf.extractfile(member)
         if 'b' not in mode:
             result = io.TextIOWrapper(result)
         return result
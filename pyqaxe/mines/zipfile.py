@@ -0,0 +1,338 @@
+import datetime
+import io
+import logging
+import os
+import re
+import sqlite3
+import struct
+import threading
+import weakref
+import zipfile
+import zlib
+
+from .. import Cache, util
+
+logger = logging.getLogger(__name__)
+
+# size and layout of the local file header preceding each member's data
+LOCAL_HEADER_FORMAT = '<4s2B4HL2L2H'
+LOCAL_HEADER_SIZE = struct.calcsize(LOCAL_HEADER_FORMAT)
+LOCAL_HEADER_SIGNATURE = b'PK\x03\x04'
+
+def parse_local_header(header):
+    """Return the size of the local file header and variable-length
+    fields given the fixed-size portion of a zip local file header."""
+    fields = struct.unpack(LOCAL_HEADER_FORMAT, bytes(header))
+    if fields[0] != LOCAL_HEADER_SIGNATURE:
+        raise zipfile.BadZipFile('Bad magic number for file header')
+    return LOCAL_HEADER_SIZE + fields[10] + fields[11]
+
+class DeflatedFile(io.RawIOBase):
+    """Read-only file object that decompresses a raw deflate stream.
+
+    Seeking forward decompresses (and discards) data up to the new
+    position; seeking backward starts decompressing from the
+    beginning again.
+
+    :param raw: Binary file object containing the compressed data
+    :param size: Size of the decompressed data in bytes
+
+    """
+    CHUNK_SIZE = 64*1024
+
+    def __init__(self, raw, size):
+        super().__init__()
+        self.raw = raw
+        self.size = size
+        self.reset_()
+
+    def reset_(self):
+        self.raw.seek(0)
+        self.decompressor_ = zlib.decompressobj(-zlib.MAX_WBITS)
+        self.position_ = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position_
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self.position_ + offset
+        elif whence == io.SEEK_END:
+            position = self.size + offset
+        else:
+            raise ValueError('Invalid whence ({})'.format(whence))
+
+        if position < 0:
+            raise ValueError('Negative seek position {}'.format(position))
+
+        if position < self.position_:
+            self.reset_()
+
+        scratch = bytearray(self.CHUNK_SIZE)
+        while self.position_ < position:
+            view = memoryview(scratch)[:position - self.position_]
+            if not self.readinto(view):
+                break
+
+        self.position_ = position
+        return position
+
+    def readinto(self, buffer_):
+        count = min(len(buffer_), self.size - self.position_)
+        if count <= 0:
+            return 0
+
+        data = b''
+        while not data:
+            source = self.decompressor_.unconsumed_tail
+            if not source:
+                source = self.raw.read(self.CHUNK_SIZE)
+                if not source:
+                    raise EOFError('Compressed file ended before the end of the data')
+            data = self.decompressor_.decompress(source, count)
+
+        buffer_[:len(data)] = data
+        self.position_ += len(data)
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            self.raw.close()
+        super().close()
+
+class ZipFile:
+    """Expose the files within one or more zip archives.
+
+    `ZipFile` populates the files table from one or more "source" zip
+    archives. These archives can be entries that have been found by
+    previously-indexed mines (`target=None`) or a single file that
+    exists somewhere in the filesystem (`target='/path/to/file.zip'`).
+
+    :param target: Optional single zip file to open. If not given, expose records found inside all zip archives
+    :param exclude_regexes: Iterable of regex patterns that should be excluded from addition to the list of files upon a successful search
+    :param exclude_suffixes: Iterable of suffixes that should be excluded from addition to the list of files
+    :param relative: Whether to use absolute or relative paths for `target` argument (see :py:class:`TarFile`)
+    :param exclude_archive_regexes: Iterable of regex patterns of archive paths that should not be opened when `target` is not given
+
+    Indexing only reads the central directory at the end of each
+    archive, rather than every member. The location, size, and
+    compression of each member are stored in the **zipfile_members**
+    table (with columns parent, path, header_offset, size,
+    compressed_size, and compression), so members can be opened
+    directly without reading the central directory again. Members
+    that are stored without compression can also be accessed without
+    copying as slices of a memory map of the archive using
+    :py:meth:`pyqaxe.Cache.map_file`.
+
+    Without a `target`, every file with a `.zip` suffix is opened,
+    including GTAR trajectories stored as zip files (which
+    :py:class:`GTAR` indexes as well), so their records also appear
+    in the files table. Use `exclude_archive_regexes` to skip them.
+    Members whose modification time is not a valid date (i.e. a
+    zeroed DOS timestamp) are given the time of the archive itself.
+
+    Examples::
+
+        cache.index(ZipFile('archive.zip', relative=True))
+        cache.index(ZipFile(exclude_suffixes=['json']))
+        cache.index(ZipFile(exclude_archive_regexes=['/dump[^/]*[.]zip$']))
+
+    """
+
+    # map opened file objects -> zipfile objects
+    opened_zipfiles_ = weakref.WeakKeyDictionary()
+    opened_zipfiles_lock_ = threading.Lock()
+
+    def __init__(self, target=None, exclude_regexes=(), exclude_suffixes=(), relative=False,
+                 exclude_archive_regexes=()):
+        self.exclude_regexes = set(exclude_regexes)
+        self.compiled_regexes_ = [re.compile(pat) for pat in self.exclude_regexes]
+        self.exclude_suffixes = set(exclude_suffixes)
+        self.exclude_archive_regexes = set(exclude_archive_regexes)
+        self.compiled_archive_regexes_ = [
+            re.compile(pat) for pat in self.exclude_archive_regexes]
+
+        self.relative = relative
+        if isinstance(relative, Cache):
+            if relative.location == ':memory:':
+                logger.warning('Making a ZipFile mine relative to a transient cache')
+                self.relative_to = None
+            else:
+                self.relative_to = os.path.dirname(relative.location)
+                self.relative = relative.unique_id
+        elif relative:
+            self.relative_to = os.path.abspath(os.curdir)
+        else:
+            self.relative_to = None
+
+        self.target = target
+        if self.relative_to and self.target is not None:
+            self.target = os.path.relpath(self.target, self.relative_to)
+
+    def index(self, cache, conn, mine_id=None, force=False):
+        if not cache.read_only:
+            conn.execute('CREATE TABLE IF NOT EXISTS zipfile_members '
+                         '(parent INTEGER, path TEXT, header_offset INTEGER, '
+                         'size INTEGER, compressed_size INTEGER, compression INTEGER, '
+                         'CONSTRAINT unique_zipfile_member '
+                         'UNIQUE (parent, path) ON CONFLICT REPLACE)')
+
+        if not force or cache.read_only:
+            return
+
+        with cache.batch_writer(conn) as writer:
+            files_to_index = []
+            if self.target is not None:
+                target = self.target
+                if self.relative_to:
+                    target = os.path.join(self.relative_to, target)
+                stat_ = os.stat(target)
+                mtime = datetime.datetime.fromtimestamp(stat_.st_mtime)
+                rowid = cache.insert_file(
+                    conn, None, target, mtime, None, writer=writer, returning=True)
+                for row in conn.execute('SELECT rowid, * from files WHERE rowid = ?', (rowid,)):
+                    files_to_index.append(row)
+            else:
+                for row in conn.execute('SELECT rowid, * from files WHERE suffix = "zip"'):
+                    if any(regex.search(row[1]) for regex in self.compiled_archive_regexes_):
+                        continue
+                    files_to_index.append(row)
+
+            for row in files_to_index:
+                zf_id, row = row[0], row[1:]
+                try:
+                    zf = self.get_opened_zipfile(cache, row)
+                except zipfile.BadZipFile as e:
+                    logger.warning('{}: {}'.format(row[0], e))
+                    continue
+                self.index_contents_(zf, cache, conn, mine_id, zf_id, row[2], writer)
+
+    def index_contents_(self, zf, cache, conn, mine_id, zf_id, zf_mtime, writer):
+        for info in zf.infolist():
+            if info.is_dir():
+                continue
+
+            valid = all([
+                info.filename.split('.')[-1] not in self.exclude_suffixes,
+                all(regex.search(info.filename) is None for regex in self.compiled_regexes_)
+                ])
+            if not valid:
+                continue
+
+            try:
+                mtime = datetime.datetime(*info.date_time)
+            except ValueError:
+                mtime = zf_mtime
+            cache.insert_file(conn, mine_id, info.filename, mtime, zf_id, writer=writer)
+
+            # encrypted members can only be read through zipfile
+            if not info.flag_bits & 0x1:
+                writer.insert('zipfile_members', (
+                    zf_id, info.filename, info.header_offset, info.file_size,
+                    info.compress_size, info.compress_type))
+
+    def remove_files(self, cache, conn, file_ids):
+        """Remove the member locations of the given archives."""
+        conn.executemany('DELETE FROM zipfile_members WHERE parent = ?',
+                         [(file_id,) for file_id in file_ids])
+
+    def __getstate__(self):
+        result = [self.target, list(sorted(self.exclude_regexes)),
+                  list(sorted(self.exclude_suffixes)), self.relative]
+        # only store non-default options, so mines pickled before they
+        # existed are still found in the mines table
+        if self.exclude_archive_regexes:
+            result.append(list(sorted(self.exclude_archive_regexes)))
+        return result
+
+    def __setstate__(self, state):
+        state = list(state)
+
+        relative = state[3]
+        if isinstance(relative, str):
+            relative = Cache.get_opened_cache(relative)
+            state[3] = relative
+
+        self.__init__(*state)
+
+    @classmethod
+    def get_opened_zipfile(cls, cache, row):
+        opened_file = cache.open_file(row, 'rb')
+
+        with cls.opened_zipfiles_lock_:
+            if opened_file not in cls.opened_zipfiles_:
+                opened_file.seek(0)
+                cls.opened_zipfiles_[opened_file] = zipfile.ZipFile(opened_file)
+            return cls.opened_zipfiles_[opened_file]
+
+    @staticmethod
+    def get_member_location_(cache, parent, filename):
+        try:
+            rows = cache.connection_.execute(
+                'SELECT header_offset, size, compressed_size, compression '
+                'FROM zipfile_members WHERE parent = ? AND path = ?',
+                (parent, filename)).fetchall()
+        except sqlite3.OperationalError:
+            return None
+
+        return rows[0] if rows else None
+
+    def open(self, filename, mode='r', owning_cache=None, parent=None):
+        parent_row = owning_cache.get_file_row(parent)
+        location = self.get_member_location_(owning_cache, parent, filename)
+
+        raw = None
+        if location is not None and location[3] in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+            (header_offset, size, compressed_size, compression) = location
+            # keep the archive open for as long as the member is
+            archive = owning_cache.pin_file(parent_row, 'rb')
+            unpin = lambda: owning_cache.unpin_file(parent_row, 'rb')
+
+            try:
+                header = util.FileSlice(archive, header_offset, LOCAL_HEADER_SIZE)
+                data_offset = header_offset + parse_local_header(header.read())
+            except Exception:
+                unpin()
+                raise
+
+            if compression == zipfile.ZIP_STORED:
+                raw = util.FileSlice(archive, data_offset, size, unpin)
+            else:
+                raw = DeflatedFile(io.BufferedReader(util.FileSlice(
+                    archive, data_offset, compressed_size, unpin)), size)
+
+        if raw is not None:
+            result = io.BufferedReader(raw)
+        else:
+            zf = self.get_opened_zipfile(owning_cache, parent_row)
+            with self.opened_zipfiles_lock_:
+                result = zf.open(filename)
+
+        if 'b' not in mode:
+            result = io.TextIOWrapper(result)
+        return result
+
+    def map_file(self, filename, owning_cache, parent):
+        """Return a read-only view of a member stored without compression,
+        sliced from the mapping of the archive itself.
+
+        Returns None if the member can't be mapped directly.
+
+        """
+        location = self.get_member_location_(owning_cache, parent, filename)
+        if location is None or location[3] != zipfile.ZIP_STORED:
+            return None
+
+        (header_offset, size, _, _) = location
+        archive = owning_cache.map_file(owning_cache.get_file_row(parent))
+        data_offset = header_offset + parse_local_header(
+            archive[header_offset:header_offset + LOCAL_HEADER_SIZE])
+        return archive[data_offset:data_offset + size]
@@ -1,38 +1,227 @@
+import collections
+import concurrent.futures
+import contextlib
+import functools
+import hashlib
+import io
+import json
+import os
+import tempfile
+import threading
+import time
 
 LEFT = -1
 RIGHT = 1
 
 class LRU_Cache:
-    def __init__(self, generator, finalizer, max_size=16):
+    """Memoize the results of a function, keeping only recently-used values.
+
+    Results are generated by calling `generator` with the arguments
+    given to the cache and are passed to `finalizer` when they are
+    evicted. Lookups and evictions are constant-time operations.
+
+    Entries are evicted (least-recently-used first) whenever more than
+    `max_size` entries are held or, if `max_bytes` is given, whenever
+    the total size of all held entries (as measured by calling
+    `sizer` on each result) exceeds `max_bytes`.
+
+    Entries can be *pinned* to prevent them from being evicted while
+    they are in use; pinned entries do not count toward either limit
+    until they are unpinned. Pins are reference-counted, so values
+    can be shared safely between threads: all operations are
+    protected by a (reentrant) lock, and a value is only finalized
+    once no thread has it pinned. Values are generated without
+    holding the lock, so other threads can use the cache in the
+    meantime; threads requesting a value that is already being
+    generated wait for that result rather than generating it again.
+    Values whose generation started before the cache was last cleared
+    are finalized rather than stored, and generated again.
+
+    :param generator: Function to generate a new value from the cache arguments
+    :param finalizer: Function to call on values when they are evicted
+    :param max_size: Maximum number of (unpinned) entries to keep
+    :param max_bytes: Optional maximum total size of (unpinned) entries to keep
+    :param sizer: Function returning the size of a generated value, used with `max_bytes`
+
+    """
+    def __init__(self, generator, finalizer, max_size=16, max_bytes=None,
+                 sizer=None):
         self.max_size = max_size
-        self.usage_history_ = []
-        self.ticks_ = 0
+        self.max_bytes = max_bytes
         self.generator = generator
         self.finalizer = finalizer
-        self.results_ = {}
-        self.last_param_ticks_ = {}
-        self.tick_params_ = {}
+        self.sizer = sizer
+        # params -> (result, size); ordered from least- to most-recently used
+        self.results_ = collections.OrderedDict()
+        # params -> [result, size, pin count]
+        self.pinned_ = {}
+        # params -> Future for values that are being generated
+        self.pending_ = {}
+        # incremented by clear(), to discard values generated before it
+        self.generation_ = 0
+        self.total_bytes_ = 0
+        self.hits = self.misses = self.evictions = 0
+        # reentrant, since finalizers may use the cache
+        self.lock_ = threading.RLock()
+
+    @staticmethod
+    def make_key_(args, kwargs):
+        return (args, tuple((k, kwargs[k]) for k in sorted(kwargs)))
 
     def __call__(self, *args, **kwargs):
-        params = (args, tuple((k, kwargs[k]) for k in sorted(kwargs)))
+        params = self.make_key_(args, kwargs)
+        return self.get_(params, args, kwargs)
+
+    def lookup_(self, params, pin):
+        """Return (True, value) for a value that is already held, or
+        (False, future) if it is not. Must be called with the lock held."""
+        if params in self.pinned_:
+            self.hits += 1
+            entry = self.pinned_[params]
+            if pin:
+                entry[2] += 1
+            return (True, entry[0])
+
+        if params in self.results_:
+            self.hits += 1
+            if pin:
+                (result, size) = self.results_.pop(params)
+                self.total_bytes_ -= size
+                self.pinned_[params] = [result, size, 1]
+            else:
+                self.results_.move_to_end(params)
+                (result, _) = self.results_[params]
+            return (True, result)
 
-        if params not in self.results_:
-            self.results_[params] = self.generator(*args, **kwargs)
-            self.last_param_ticks_[params] = self.ticks_
-            self.tick_params_[self.ticks_] = params
-        else: # update tick <-> parameter tracking machinery
-            self.tick_params_.pop(self.last_param_ticks_[params])
-            self.tick_params_[self.ticks_] = params
-            self.last_param_ticks_[params] = self.ticks_
+        return (False, self.pending_.get(params))
 
-        while len(self) > self.max_size:
-            self.popleft()
+    def get_(self, params, args, kwargs, pin=False):
+        while True:
+            with self.lock_:
+                (found, value) = self.lookup_(params, pin)
+                if found:
+                    self.trim()
+                    return value
+                elif value is None:
+                    # generate the value in this thread
+                    self.misses += 1
+                    generation = self.generation_
+                    future = self.pending_[params] = concurrent.futures.Future()
 
-        self.ticks_ += 1
-        return self.results_[params]
+            if value is not None:
+                # wait for another thread to generate the value, then
+                # look it up again
+                value.result()
+                continue
+
+            try:
+                result = self.generator(*args, **kwargs)
+                size = self.sizer(result) if self.sizer is not None else 0
+            except BaseException as e:
+                with self.lock_:
+                    self.finish_pending_(params, future)
+                future.set_exception(e)
+                raise
+
+            with self.lock_:
+                self.finish_pending_(params, future)
+                current = generation == self.generation_
+                if current:
+                    if pin:
+                        self.pinned_[params] = [result, size, 1]
+                    else:
+                        self.results_[params] = (result, size)
+                        self.total_bytes_ += size
+                    self.trim()
+            future.set_result(None)
+
+            if current:
+                return result
+            # the cache was cleared while the value was being generated
+            self.finalizer(result)
+
+    def finish_pending_(self, params, future):
+        # clear() may have already removed the entry
+        if self.pending_.get(params) is future:
+            del self.pending_[params]
 
     def __len__(self):
-        return len(self.results_)
+        return len(self.results_) + len(self.pinned_)
+
+    def __contains__(self, params):
+        return params in self.results_ or params in self.pinned_
+
+    def over_budget_(self):
+        if len(self.results_) > self.max_size:
+            return True
+        return self.max_bytes is not None and self.total_bytes_ > self.max_bytes
+
+    def trim(self):
+        """Evict entries until the size limits are satisfied."""
+        with self.lock_:
+            # always leave the most-recently-used entry alone so that the
+            # value just requested is still valid when it is returned
+            while len(self.results_) > 1 and self.over_budget_():
+                self.popleft()
+                self.evictions += 1
+
+    def pin(self, *args, **kwargs):
+        """Retrieve (generating, if necessary) a value and prevent it from
+        being evicted until a matching call to :py:meth:`unpin`.
+
+        Pins are counted, so an entry pinned N times must be unpinned
+        N times before it can be evicted again.
+
+        """
+        params = self.make_key_(args, kwargs)
+        return self.get_(params, args, kwargs, pin=True)
+
+    def unpin(self, *args, **kwargs):
+        """Release a pin created by :py:meth:`pin`.
+
+        Unpinning an entry that is not currently pinned is a no-op.
+
+        """
+        with self.lock_:
+            params = self.make_key_(args, kwargs)
+            entry = self.pinned_.get(params)
+            if entry is None:
+                return
+
+            entry[2] -= 1
+            if entry[2] <= 0:
+                del self.pinned_[params]
+                (result, size, _) = entry
+                self.results_[params] = (result, size)
+                self.total_bytes_ += size
+                self.trim()
+
+    @contextlib.contextmanager
+    def pinned(self, *args, **kwargs):
+        """Context manager that pins a value for the duration of the context."""
+        result = self.pin(*args, **kwargs)
+        try:
+            yield result
+        finally:
+            self.unpin(*args, **kwargs)
+
+    @property
+    def total_bytes(self):
+        """Total size of all entries, as measured by `sizer`."""
+        with self.lock_:
+            return self.total_bytes_ + sum(entry[1] for entry in self.pinned_.values())
+
+    def stats(self):
+        """Return a dictionary of hit, miss, and eviction counts."""
+        with self.lock_:
+            return dict(hits=self.hits, misses=self.misses,
+                        evictions=self.evictions, size=len(self),
+                        pinned=len(self.pinned_), bytes=self.total_bytes)
+
+    def reset_stats(self):
+        """Reset the hit, miss, and eviction counters."""
+        with self.lock_:
+            self.hits = self.misses = self.evictions = 0
 
     def popleft(self):
         return self.pop_(LEFT)
@@ -41,22 +230,508 @@ class LRU_Cache:
         return self.pop_(RIGHT)
 
     def pop_(self, side=LEFT):
-        if len(self) == 0:
-            name = {LEFT: 'popleft', RIGHT: 'pop'}[side]
-            raise IndexError('{} from empty LRU_Cache'.format(name))
+        with self.lock_:
+            if not self.results_:
+                name = {LEFT: 'popleft', RIGHT: 'pop'}[side]
+                raise IndexError('{} from empty LRU_Cache'.format(name))
 
-        extremum = max if side == RIGHT else min
-        oldest_tick = extremum(self.tick_params_)
-        oldest_params = self.tick_params_[oldest_tick]
-        self.last_param_ticks_.pop(oldest_params)
-        self.tick_params_.pop(oldest_tick)
-
-        self.finalizer(self.results_.pop(oldest_params))
-        return oldest_params
+            (params, (result, size)) = self.results_.popitem(last=(side == RIGHT))
+            self.total_bytes_ -= size
+            self.finalizer(result)
+            return params
 
     def clear(self):
-        while len(self):
-            self.pop()
+        """Finalize and remove all entries, including pinned ones.
+
+        Values that are being generated when the cache is cleared are
+        not stored.
+
+        """
+        with self.lock_:
+            self.generation_ += 1
+            # new requests generate their values again
+            self.pending_.clear()
+
+            pinned = list(self.pinned_.values())
+            self.pinned_.clear()
+            for (result, _, _) in pinned:
+                self.finalizer(result)
+
+            while self.results_:
+                self.pop()
 
     def __del__(self):
         self.clear()
+
+class BatchWriter:
+    """Buffer rows to be inserted into database tables.
+
+    Rows are collected per table and written with
+    :py:meth:`sqlite3.Connection.executemany` whenever `chunk_size`
+    rows have accumulated for a table, when :py:meth:`flush` is
+    called, when the writer is used as a context manager and the
+    context exits without an exception, or (if `flush_interval` is
+    given) when a row is inserted at least `flush_interval` seconds
+    after rows were last written.
+
+    :param conn: `sqlite3.Connection` to write to
+    :param chunk_size: Number of rows to buffer for each table before writing them
+    :param on_flush: Optional function to call with the list of table names after rows are written
+    :param flush_interval: Optional maximum number of seconds to buffer rows for
+
+    Examples::
+
+        with BatchWriter(conn) as writer:
+            for values in rows:
+                writer.insert('files', values)
+
+    """
+    def __init__(self, conn, chunk_size=1024, on_flush=None, flush_interval=None):
+        self.conn = conn
+        self.chunk_size = chunk_size
+        self.on_flush = on_flush
+        self.flush_interval = flush_interval
+        self.last_flush_time_ = time.monotonic()
+        # (table, number of values) -> list of buffered rows
+        self.buffers_ = collections.OrderedDict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+
+    @staticmethod
+    def make_query_(table, columns):
+        if isinstance(columns, int):
+            return 'INSERT INTO {} VALUES ({})'.format(table, ', '.join(columns*'?'))
+        return 'INSERT INTO {} ({}) VALUES ({})'.format(
+            table, ', '.join('"{}"'.format(column) for column in columns),
+            ', '.join(len(columns)*'?'))
+
+    def insert(self, table, values, returning=False, columns=None):
+        """Insert a row of values into a table.
+
+        If `returning` is True, all rows buffered for `table` are
+        written, the new row is inserted immediately, and its rowid
+        is returned. Otherwise the row is buffered and None is
+        returned.
+
+        If `columns` is given, it is a sequence of the names of the
+        columns that `values` correspond to; otherwise, `values` must
+        give a value for each column of the table, in order.
+
+        """
+        values = tuple(values)
+        key = (table, len(values) if columns is None else tuple(columns))
+
+        if returning:
+            self.flush(table)
+            return self.conn.execute(self.make_query_(*key), values).lastrowid
+
+        buffer_ = self.buffers_.setdefault(key, [])
+        buffer_.append(values)
+        if (self.flush_interval is not None and
+                time.monotonic() - self.last_flush_time_ >= self.flush_interval):
+            self.flush()
+        elif len(buffer_) >= self.chunk_size:
+            self.flushed_([table] if self.flush_(key) else [])
+
+    def flush_(self, key):
+        rows = self.buffers_.pop(key, None)
+        if rows:
+            self.conn.executemany(self.make_query_(*key), rows)
+            return True
+        return False
+
+    def flushed_(self, tables):
+        self.last_flush_time_ = time.monotonic()
+        if tables and self.on_flush is not None:
+            self.on_flush(tables)
+
+    def flush(self, table=None):
+        """Write all buffered rows (optionally only those for a single table)."""
+        tables = []
+        for key in list(self.buffers_):
+            if (table is None or key[0] == table) and self.flush_(key):
+                tables.append(key[0])
+        self.flushed_(tables)
+
+    def __len__(self):
+        return sum(len(rows) for rows in self.buffers_.values())
+
+class FileSlice(io.RawIOBase):
+    """Read-only file object for a range of bytes within another file.
+
+    Reads go directly to the given offset of the underlying file
+    (using `os.pread` when possible), so many members of the same
+    archive can be read at once without interfering with each other.
+    Archive mines use this to open members at known locations.
+
+    :param fileobj: Underlying binary file object
+    :param offset: Position of the start of the data within `fileobj`
+    :param size: Size of the data in bytes
+    :param on_close: Optional function to call when this file is closed
+    :param pread: Whether the file descriptor of `fileobj` (if any) can be read directly, rather than seeking and reading `fileobj`
+
+    """
+    read_lock_ = threading.Lock()
+
+    def __init__(self, fileobj, offset, size, on_close=None, pread=True):
+        super().__init__()
+        self.fileobj = fileobj
+        self.offset = offset
+        self.size = size
+        self.on_close = on_close
+        self.position_ = 0
+
+        self.fileno_ = None
+        if pread:
+            try:
+                self.fileno_ = fileobj.fileno()
+            except (AttributeError, OSError, io.UnsupportedOperation):
+                pass
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position_
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self.position_ + offset
+        elif whence == io.SEEK_END:
+            position = self.size + offset
+        else:
+            raise ValueError('Invalid whence ({})'.format(whence))
+
+        if position < 0:
+            raise ValueError('Negative seek position {}'.format(position))
+        self.position_ = position
+        return position
+
+    def read_range_(self, position, count):
+        if self.fileno_ is not None and hasattr(os, 'pread'):
+            return os.pread(self.fileno_, count, position)
+
+        with self.read_lock_:
+            self.fileobj.seek(position)
+            return self.fileobj.read(count)
+
+    def readinto(self, buffer_):
+        count = min(len(buffer_), self.size - self.position_)
+        if count <= 0:
+            return 0
+
+        data = self.read_range_(self.offset + self.position_, count)
+        buffer_[:len(data)] = data
+        self.position_ += len(data)
+        return len(data)
+
+    def close(self):
+        if not self.closed and self.on_close is not None:
+            self.on_close()
+        super().close()
+
+class ExtractionDirectory:
+    """Keep extracted copies of files in a directory on disk.
+
+    Copies are identified by a key (any JSON-serializable value) and
+    kept between calls (and between processes) until the total size
+    of the directory exceeds `max_bytes`, at which point the
+    least-recently-used copies are deleted.
+
+    Several processes can safely share a directory: copies are
+    written to temporary files and atomically renamed into place, and
+    copies that are deleted while they are open remain readable
+    through the open file (on platforms that allow deleting open
+    files; elsewhere, they are simply not deleted). Temporary files
+    left behind by writers that crashed are deleted once they are
+    older than `TEMPORARY_MAX_AGE` seconds.
+
+    :param path: Directory to store copies in (created if necessary)
+    :param max_bytes: Optional maximum total size of all copies
+
+    """
+    # number of times to extract a copy that is deleted by another
+    # process before it can be opened
+    EXTRACT_ATTEMPTS = 3
+
+    # seconds after which unfinished temporary files are deleted
+    TEMPORARY_MAX_AGE = 24*60*60
+
+    def __init__(self, path, max_bytes=None):
+        self.path = path
+        self.max_bytes = max_bytes
+        os.makedirs(path, exist_ok=True)
+
+    def get_path_(self, key, basename):
+        digest = hashlib.sha1(json.dumps(key).encode('UTF-8')).hexdigest()
+        return os.path.join(self.path, '{}-{}'.format(digest, basename))
+
+    def open(self, key, basename, mode, write):
+        """Open the copy of a file, creating it if necessary.
+
+        :param key: JSON-serializable identifier of the file
+        :param basename: Name of the original file (copies keep it as a suffix)
+        :param mode: Mode to open the copy with
+        :param write: Function to call with a binary file object to write a new copy
+
+        """
+        target = self.get_path_(key, basename)
+        try:
+            result = open(target, mode)
+        except FileNotFoundError:
+            pass
+        else:
+            try:
+                # mark as recently used
+                os.utime(target)
+            except OSError:
+                pass
+            return result
+
+        for attempt in range(self.EXTRACT_ATTEMPTS):
+            self.extract_(target, basename, write)
+            try:
+                result = open(target, mode)
+            except FileNotFoundError:
+                # trimmed by another thread or process in the meantime
+                if attempt + 1 == self.EXTRACT_ATTEMPTS:
+                    raise
+                continue
+
+            # trim only once the new copy is open, so it stays readable
+            self.trim(keep=target)
+            return result
+
+    def extract_(self, target, basename, write):
+        with tempfile.NamedTemporaryFile(
+                'wb', dir=self.path, prefix='.', suffix='-' + basename,
+                delete=False) as f:
+            try:
+                write(f)
+            except BaseException:
+                f.close()
+                os.unlink(f.name)
+                raise
+        os.replace(f.name, target)
+
+    def entries_(self, temporary=False):
+        result = []
+        for entry in os.scandir(self.path):
+            # copies that are still being written start with '.'
+            if entry.name.startswith('.') != temporary:
+                continue
+            try:
+                stat_ = entry.stat()
+            except FileNotFoundError:
+                continue
+            result.append((stat_.st_mtime, stat_.st_size, entry.path))
+        return result
+
+    def remove_stale_temporaries_(self):
+        cutoff = time.time() - self.TEMPORARY_MAX_AGE
+        for (mtime, _, path) in self.entries_(temporary=True):
+            if mtime >= cutoff:
+                continue
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+    @property
+    def total_bytes(self):
+        """Total size of all copies in the directory."""
+        return sum(entry[1] for entry in self.entries_())
+
+    def trim(self, keep=None):
+        """Delete the least-recently-used copies until the directory
+        fits within `max_bytes`.
+
+        Temporary files that were abandoned by crashed writers are
+        deleted as well.
+
+        :param keep: Optional path of a copy that should not be deleted
+
+        """
+        self.remove_stale_temporaries_()
+
+        if self.max_bytes is None:
+            return
+
+        entries = sorted(self.entries_())
+        total = sum(entry[1] for entry in entries)
+        for (_, size, path) in entries:
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                # already removed by another process
+                pass
+            except OSError:
+                continue
+            total -= size
+
+class DeferredValue:
+    """A database value whose conversion into a python object has been
+    postponed by :py:func:`deferred_conversion`.
+
+    :param converter: sqlite3 converter function for the value
+    :param contents: Contents of the value as stored in the database
+
+    """
+    __slots__ = ('converter', 'contents')
+
+    def __init__(self, converter, contents):
+        self.converter = converter
+        self.contents = contents
+
+    def resolve(self):
+        """Convert the value."""
+        return self.converter(self.contents)
+
+deferred_conversion_ = threading.local()
+
+def deferrable_converter(converter):
+    """Wrap an sqlite3 converter function so that, while
+    :py:func:`deferred_conversion` is active in the current thread,
+    it returns a :py:class:`DeferredValue` rather than converting
+    values immediately."""
+    @functools.wraps(converter)
+    def result(contents):
+        if getattr(deferred_conversion_, 'active', False):
+            return DeferredValue(converter, contents)
+        return converter(contents)
+    return result
+
+@contextlib.contextmanager
+def deferred_conversion():
+    """Context manager to postpone the conversion of values fetched
+    by the current thread (for converters wrapped by
+    :py:func:`deferrable_converter`)."""
+    previous = getattr(deferred_conversion_, 'active', False)
+    deferred_conversion_.active = True
+    try:
+        yield
+    finally:
+        deferred_conversion_.active = previous
+
+def conversion_deferred():
+    """Return True if :py:func:`deferred_conversion` is active in the
+    current thread."""
+    return getattr(deferred_conversion_, 'active', False)
+
+def resolve_row(row):
+    """Convert any deferred values in a row."""
+    return tuple(value.resolve() if isinstance(value, DeferredValue) else value
+                 for value in row)
+
+def array_statistics(value):
+    """Return a (length, size, ndim, shape, dtype, minimum, maximum,
+    mean) tuple summarizing a value read from a file, or None if the
+    value can't be summarized.
+
+    Strings and bytes are summarized by their length. Other values
+    are converted to numpy arrays, where `length` is the size of the
+    first axis (1 for scalars) and `shape` is a JSON list; `minimum`,
+    `maximum`, and `mean` are only given for non-empty arrays of real
+    numbers.
+
+    """
+    if isinstance(value, (str, bytes)):
+        return (len(value), len(value), 1, json.dumps([len(value)]),
+                type(value).__name__, None, None, None)
+
+    import numpy as np
+
+    try:
+        array = np.asarray(value)
+    except Exception:
+        return None
+    if array.dtype.kind in 'OV':
+        return None
+
+    length = array.shape[0] if array.ndim else 1
+    (minimum, maximum, mean) = (None, None, None)
+    if array.size and array.dtype.kind in 'biuf':
+        minimum = float(np.min(array))
+        maximum = float(np.max(array))
+        mean = float(np.mean(array, dtype=np.float64))
+
+    return (length, int(array.size), array.ndim, json.dumps(list(array.shape)),
+            str(array.dtype), minimum, maximum, mean)
+
+def map_cached_files(cache, tasks, function, processes, max_pending=None):
+    """Call a function on files from a cache in a pool of worker processes.
+
+    `tasks` is an iterable of `(key, row, mode, args)` tuples, where
+    `key` is any value for use by the caller and `row` is a row from
+    the files table. Each file is pinned as a named file
+    (so that files found inside archives are copied to a temporary
+    file) and `function(filename, mode, *args)` is called in a worker
+    process, where `filename` is the name of a real file on disk.
+
+    Yields `(task, future)` pairs in the same order as `tasks`;
+    results and errors (including errors opening the file in the
+    calling process) are retrieved with `future.result()`. Each file
+    is kept pinned until the caller requests the next item.
+
+    :param cache: `Cache` object to open files from
+    :param tasks: Iterable of (key, row, mode, args) tuples
+    :param function: Picklable function to call in worker processes
+    :param processes: Number of worker processes to use
+    :param max_pending: Maximum number of files to open and submit at once (default: 2*processes)
+
+    """
+    max_pending = max_pending or 2*processes
+    # (task, future, whether the file is pinned)
+    pending = collections.deque()
+
+    try:
+        with concurrent.futures.ProcessPoolExecutor(processes) as pool:
+            try:
+                for task in tasks:
+                    (_, row, mode, args) = task
+                    try:
+                        opened_file = cache.pin_file(row, mode, named=True)
+                    except Exception as e:
+                        future = concurrent.futures.Future()
+                        future.set_exception(e)
+                        pending.append((task, future, False))
+                    else:
+                        future = pool.submit(function, opened_file.name, mode, *args)
+                        pending.append((task, future, True))
+
+                    while len(pending) >= max_pending:
+                        (task, future, _) = pending[0]
+                        yield (task, future)
+                        release_(cache, pending.popleft())
+
+                while pending:
+                    (task, future, _) = pending[0]
+                    yield (task, future)
+                    release_(cache, pending.popleft())
+            except BaseException:
+                for (_, future, _) in pending:
+                    future.cancel()
+                raise
+    finally:
+        # the pool has shut down, so no workers are still reading
+        while pending:
+            release_(cache, pending.popleft())
+
+def release_(cache, item):
+    ((_, row, mode, _), _, pinned) = item
+    if pinned:
+        cache.unpin_file(row, mode, named=True)
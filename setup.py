@@ -31,6 +31,9 @@ setup(name='pyqaxe',
           'Topic :: Database :: Front-Ends'
       ],
       description='Dataset indexing and curation tool',
+      extras_require={
+          'gzip': ['indexed_gzip'],
+      },
       install_requires=['scandir ; python_version<"3.5"'],
       license='BSD',
       long_description=long_description,
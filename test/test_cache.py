@@ -1,10 +1,32 @@
+import concurrent.futures
+import datetime
+import gc
 import os
 import sqlite3
 import tempfile
+import threading
 import unittest
 
 import pyqaxe as pyq
 
+class CountingMine:
+    """Mine that counts how often it is indexed and registered."""
+    calls = []
+
+    def index(self, cache, conn, mine_id=None, force=False):
+        self.calls.append('index')
+        self.register(cache, conn, mine_id)
+
+    def register(self, cache, conn, mine_id=None):
+        self.calls.append('register')
+        conn.create_function('pyq_test_double', 1, lambda x: 2*x)
+
+    def __getstate__(self):
+        return []
+
+    def __setstate__(self, state):
+        pass
+
 class CacheTests(unittest.TestCase):
 
     @classmethod
@@ -48,6 +70,216 @@ class CacheTests(unittest.TestCase):
                 for (path,) in cache.query('select path from files limit 2'):
                     cache2 = pyq.Cache(f.name)
 
+    def test_wal(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            with open(os.path.join(dirname, 'test.txt'), 'w') as f:
+                f.write('Test text')
+
+            location = os.path.join(dirname, 'test.sqlite')
+            cache = pyq.Cache(location, journal='wal', commit_interval=0)
+            self.assertEqual(cache.journal_mode, 'wal')
+            cache.index(pyq.mines.Directory(dirname, exclude_suffixes=['sqlite', 'sqlite-wal', 'sqlite-shm']))
+
+            with cache.connection_ as conn:
+                # hold a write transaction open in the indexing cache
+                conn.execute('INSERT INTO files (path) VALUES ("new")')
+
+                # readers see the last committed snapshot
+                reader = pyq.Cache(location, read_only=True)
+                for (count,) in reader.query('select count(*) from files'):
+                    pass
+                self.assertEqual(count, 1)
+
+            self.assertEqual(len(cache.checkpoint('truncate')), 3)
+            with self.assertRaises(ValueError):
+                cache.checkpoint('sometimes')
+            with self.assertRaises(ValueError):
+                cache.set_journal_mode('wal; DROP TABLE files')
+
+            for (count,) in reader.query('select count(*) from files'):
+                pass
+            self.assertEqual(count, 2)
+
+    def test_iter_batches(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            for i in range(5):
+                with open(os.path.join(dirname, 'test_{}.txt'.format(i)), 'w') as f:
+                    f.write('Test text')
+
+            location = os.path.join(dirname, 'test.sqlite')
+            cache = pyq.Cache(location, journal='wal')
+            cache.index(pyq.mines.Directory(dirname, exclude_suffixes=['sqlite', 'sqlite-wal', 'sqlite-shm']))
+            # another connection to write to the database
+            writer = sqlite3.connect(location, timeout=0)
+
+            query = ('SELECT path, update_time, CAST(update_time AS TEXT) '
+                     'FROM files WHERE path LIKE ? ORDER BY path')
+            expected = list(cache.query(query, ('%.txt',)))
+
+            paths = []
+            found = []
+            for batch in cache.iter_batches(query, ('%.txt',), batch_size=2):
+                self.assertLessEqual(len(batch), 2)
+                for (path, update_time, raw) in batch:
+                    paths.append(os.path.basename(path))
+                    # decoded like query, unless asked otherwise
+                    self.assertIsInstance(update_time, datetime.datetime)
+                    self.assertIsInstance(raw, str)
+                found.extend(batch)
+
+                # the database isn't locked between batches
+                with writer:
+                    writer.execute('INSERT INTO files (path) VALUES ("new")')
+
+            self.assertEqual(paths, ['test_{}.txt'.format(i) for i in range(5)])
+            self.assertEqual(found, expected)
+            writer.close()
+            cache.close()
+
+    def test_threads(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            for i in range(8):
+                with open(os.path.join(dirname, 'test_{}.txt'.format(i)), 'w') as f:
+                    f.write(str(i))
+
+            for location in [':memory:', os.path.join(dirname, 'test.sqlite')]:
+                cache = pyq.Cache(location)
+                cache.set_cache_size(2)
+                cache.index(pyq.mines.Directory(dirname, exclude_suffixes=['sqlite']))
+
+                def read(i):
+                    for row in cache.query('select * from files where path like ?',
+                                           ('%test_{}.txt'.format(i),)):
+                        with cache.pinned_file(row) as f:
+                            f.seek(0)
+                            return f.read()
+
+                with concurrent.futures.ThreadPoolExecutor(4) as pool:
+                    contents = list(pool.map(read, range(8)))
+
+                self.assertEqual(contents, [str(i) for i in range(8)])
+                cache.close()
+
+    def test_thread_connections(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            cache = pyq.Cache(os.path.join(dirname, 'test.sqlite'))
+            cache.index(pyq.mines.Directory(dirname, exclude_suffixes=['sqlite']))
+
+            def count(_):
+                for (result,) in cache.query('select count(*) from files'):
+                    return result
+
+            for _ in range(4):
+                threads = [threading.Thread(target=count, args=(i,)) for i in range(4)]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+                del threads
+                gc.collect()
+
+                # only the connection of the main thread remains open
+                self.assertEqual(len(cache.connections_), 1)
+
+            cache.close()
+
+    def test_register_threads(self):
+        for location in [':memory:', os.path.join(self.temp_dir.name, 'register.sqlite')]:
+            cache = pyq.Cache(location)
+            cache.index(CountingMine())
+            del CountingMine.calls[:]
+
+            def double(x):
+                for (result,) in cache.query('select pyq_test_double(?)', (x,)):
+                    return result
+
+            with concurrent.futures.ThreadPoolExecutor(4) as pool:
+                self.assertEqual(list(pool.map(double, range(32))),
+                                 [2*x for x in range(32)])
+
+            # new connections only register functions, without indexing
+            self.assertNotIn('index', CountingMine.calls)
+            cache.close()
+
+    def test_file_rows(self):
+        with pyq.Cache() as cache:
+            cache.index(pyq.mines.Directory(self.temp_dir.name))
+
+            for (rowid, *row) in cache.query('select rowid, * from files limit 1'):
+                pass
+
+            self.assertEqual(cache.get_file_row(rowid), tuple(row))
+            # repeated lookups use the remembered row
+            cache.get_file_row(rowid)
+            self.assertEqual(cache.file_rows_.stats()['hits'], 1)
+
+            with cache.connection_ as conn:
+                cache.remove_files(conn, [rowid])
+
+            with self.assertRaises(KeyError):
+                cache.get_file_row(rowid)
+
+    def test_file_rows_threads(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            for i in range(2):
+                with open(os.path.join(dirname, 'test_{}.txt'.format(i)), 'w') as f:
+                    f.write(str(i))
+
+            cache = pyq.Cache(os.path.join(dirname, 'test.sqlite'))
+            cache.index(pyq.mines.Directory(dirname, exclude_suffixes=['sqlite']))
+            rowids = [row[0] for row in cache.query('select rowid from files order by rowid')]
+
+            for _ in range(2):
+                cache.get_file_row(rowids[0])
+            self.assertEqual(cache.file_rows_.stats()['hits'], 1)
+
+            # lookups in other threads don't discard this thread's rows
+            with concurrent.futures.ThreadPoolExecutor(2) as pool:
+                list(pool.map(cache.get_file_row, 4*rowids))
+            cache.get_file_row(rowids[0])
+            self.assertEqual(cache.file_rows_.stats()['hits'], 2)
+
+            # neither do modifications of other tables
+            with cache.connection_ as conn:
+                conn.execute('CREATE TABLE other (a INTEGER)')
+                conn.execute('INSERT INTO other VALUES (1)')
+            for _ in cache.query('select * from other'):
+                pass
+            cache.get_file_row(rowids[0])
+            self.assertEqual(cache.file_rows_.stats()['hits'], 3)
+
+            # files removed by another thread are forgotten
+            def remove(rowid):
+                with cache.connection_ as conn:
+                    cache.remove_files(conn, [rowid])
+            with concurrent.futures.ThreadPoolExecutor(1) as pool:
+                pool.submit(remove, rowids[0]).result()
+
+            with self.assertRaises(KeyError):
+                cache.get_file_row(rowids[0])
+            cache.close()
+
+    def test_suffix(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            location = os.path.join(dirname, 'test.sqlite')
+            # files table as created by older versions
+            with sqlite3.connect(location) as conn:
+                conn.execute(
+                    'CREATE TABLE files (path TEXT, mine_id INTEGER, '
+                    'update_time TIMESTAMP, parent INTEGER, CONSTRAINT unique_path '
+                    'UNIQUE (path, mine_id, parent) ON CONFLICT REPLACE)')
+                conn.execute('INSERT INTO files VALUES ("/a/old.TAR", NULL, NULL, NULL)')
+            conn.close()
+
+            cache = pyq.Cache(location)
+            with cache.connection_ as conn:
+                cache.insert_file(conn, None, '/a.b/new.tar.gz')
+                cache.insert_file(conn, None, '/a.b/none')
+
+            suffixes = dict(cache.query('select path, suffix from files'))
+            self.assertEqual(suffixes, {'/a/old.TAR': 'tar', '/a.b/new.tar.gz': 'gz',
+                                        '/a.b/none': ''})
+
     def test_context(self):
         with open(os.path.join(self.temp_dir.name, 'test_context.txt'), 'w') as f:
             f.write('Test text')
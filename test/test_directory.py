@@ -39,6 +39,26 @@ class DirectoryTests(unittest.TestCase):
 
         self.assertEqual(count, len(contents))
 
+    def test_workers(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            for i in range(4):
+                for j in range(3):
+                    subdir = os.path.join(dirname, 'dir_{}'.format(i), 'sub_{}'.format(j))
+                    os.makedirs(subdir)
+                    for k in range(3):
+                        with open(os.path.join(subdir, 'test_{}.txt'.format(k)), 'w') as f:
+                            f.write('test text')
+
+            def get_paths(**kwargs):
+                cache = pyq.Cache()
+                cache.index(pyq.mines.Directory(dirname, **kwargs))
+                return [path for (path,) in cache.query('select path from files order by rowid')]
+
+            serial_paths = get_paths()
+            self.assertEqual(len(serial_paths), 4*3*3)
+            self.assertEqual(sorted(get_paths(workers=4)), sorted(serial_paths))
+            self.assertEqual(get_paths(workers=4, ordered=True), serial_paths)
+
     def test_relocate(self):
         with tempfile.TemporaryDirectory() as dirname:
             os.mkdir(os.path.join(dirname, 'test'))
@@ -103,5 +123,85 @@ class DirectoryTests(unittest.TestCase):
             with new_cache.open_file(row) as f:
                 self.assertEqual(f.read(), 'test text')
 
+    def test_incremental(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            def write(*names):
+                with open(os.path.join(dirname, *names), 'w') as f:
+                    f.write('test text')
+
+            def touch(*names, mtime):
+                os.utime(os.path.join(dirname, *names), (mtime, mtime))
+
+            os.mkdir(os.path.join(dirname, 'sub'))
+            os.mkdir(os.path.join(dirname, 'gone'))
+            for names in [('a.txt',), ('b.txt',), ('sub', 'c.txt'), ('gone', 'd.txt')]:
+                write(*names)
+                touch(*names, mtime=1000)
+            for name in ['sub', 'gone', '']:
+                touch(name, mtime=1000)
+
+            cache = pyq.Cache()
+            mine = pyq.mines.Directory(dirname, incremental=True)
+            cache.index(mine)
+
+            def get_files():
+                return {os.path.relpath(path, dirname): rowid for (rowid, path) in
+                        cache.query('select rowid, path from files')}
+
+            old_files = get_files()
+            self.assertEqual(set(old_files), {'a.txt', 'b.txt', 'sub/c.txt', 'gone/d.txt'})
+
+            # modify a file without touching its directory
+            touch('a.txt', mtime=2000)
+            cache.index(mine, force=True)
+            self.assertEqual(get_files(), old_files)
+
+            os.remove(os.path.join(dirname, 'b.txt'))
+            write('e.txt')
+            os.remove(os.path.join(dirname, 'gone', 'd.txt'))
+            os.rmdir(os.path.join(dirname, 'gone'))
+            touch('', mtime=3000)
+            cache.index(mine, force=True)
+
+            new_files = get_files()
+            self.assertEqual(set(new_files), {'a.txt', 'sub/c.txt', 'e.txt'})
+            # unchanged directories aren't re-inserted
+            self.assertEqual(new_files['sub/c.txt'], old_files['sub/c.txt'])
+            # modified files are re-inserted once their directory changes
+            self.assertNotEqual(new_files['a.txt'], old_files['a.txt'])
+
+    def test_incremental_existing(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            for subdir in ['sub', 'gone']:
+                os.mkdir(os.path.join(dirname, subdir))
+            for names in [('a.txt',), ('b.txt',), ('sub', 'c.txt'), ('gone', 'd.txt')]:
+                with open(os.path.join(dirname, *names), 'w') as f:
+                    f.write('test text')
+
+            cache = pyq.Cache()
+            cache.index(pyq.mines.Directory(dirname))
+            old_files = {os.path.relpath(path, dirname): rowid for (rowid, path) in
+                         cache.query('select rowid, path from files')}
+
+            os.remove(os.path.join(dirname, 'b.txt'))
+            os.remove(os.path.join(dirname, 'gone', 'd.txt'))
+            os.rmdir(os.path.join(dirname, 'gone'))
+            cache.index(pyq.mines.Directory(dirname, incremental=True), force=True)
+
+            # files found by the first mine are taken over, not inserted again
+            new_files = {os.path.relpath(path, dirname): rowid for (rowid, path) in
+                         cache.query('select rowid, path from files')}
+            self.assertEqual(new_files, {name: old_files[name] for name in ['a.txt', 'sub/c.txt']})
+            # the first mine is replaced by the incremental one
+            self.assertEqual([mine.incremental for mine in cache.mines.values()], [True])
+
+            # re-indexing the first mine doesn't insert the files again
+            with open(os.path.join(dirname, 'e.txt'), 'w') as f:
+                f.write('test text')
+            cache.index(pyq.mines.Directory(dirname), force=True)
+            paths = sorted(os.path.relpath(path, dirname) for (path,) in
+                           cache.query('select path from files'))
+            self.assertEqual(paths, ['a.txt', 'e.txt', 'sub/c.txt'])
+
 if __name__ == '__main__':
     unittest.main()
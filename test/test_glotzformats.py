@@ -1,5 +1,6 @@
 import json
 import os
+import sqlite3
 import tarfile
 import tempfile
 import unittest
@@ -56,6 +57,29 @@ class GlotzFormatsTests(unittest.TestCase):
             cache.close()
 
             cache = pyq.Cache(f.name)
+            # mines with default options are stored in the same way as
+            # by older versions, so they are recognized again
+            self.assertEqual(GlotzFormats().__getstate__(), [[], []])
+            cache.index(GlotzFormats())
+            self.assertEqual(len(cache.mines), 2)
+
+    def test_read_only_old_cache(self):
+        with tempfile.NamedTemporaryFile(suffix='.sqlite') as f:
+            cache = pyq.Cache(f.name)
+            cache.index(pyq.mines.Directory(
+                self.temp_dir.name, exclude_suffixes=['tar']))
+            cache.index(GlotzFormats())
+            cache.close()
+
+            # tables added by later versions
+            with sqlite3.connect(f.name) as conn:
+                conn.execute('DROP TABLE glotzformats_pos_offsets')
+                conn.execute('DROP TABLE glotzformats_frame_stats')
+            conn.close()
+
+            cache = pyq.Cache(f.name, read_only=True)
+            count = len(list(cache.query('select positions from glotzformats_frames')))
+            self.assertEqual(count, self.NUM_FRAMES)
 
     def test_read_data(self):
         cache = pyq.Cache()
@@ -79,5 +103,88 @@ class GlotzFormatsTests(unittest.TestCase):
 
         self.assertEqual(count, self.NUM_FRAMES)
 
+    def test_processes(self):
+        cache = pyq.Cache()
+        cache.index(pyq.mines.Directory(self.temp_dir.name))
+        cache.index(pyq.mines.TarFile(self.tarfile_name))
+        cache.index(GlotzFormats(exclude_regexes=[r'.*\.tar$'], processes=2))
+
+        frames = list(cache.query(
+            'select file_id, frame from glotzformats_frames order by file_id, frame'))
+        self.assertEqual(len(frames), 2*self.NUM_FRAMES)
+
+        count = 0
+        for (positions,) in cache.query('select positions from glotzformats_frames'):
+            count += 1
+
+        self.assertEqual(count, 2*self.NUM_FRAMES)
+
+    def test_pos_offsets(self):
+        cache = pyq.Cache()
+        cache.index(pyq.mines.Directory(self.temp_dir.name))
+        cache.index(GlotzFormats(exclude_suffixes=['tar']))
+
+        offsets = list(cache.query(
+            'select offset, length from glotzformats_pos_offsets order by frame'))
+        self.assertEqual(len(offsets), self.NUM_FRAMES)
+        for ((offset, length), (next_offset, _)) in zip(offsets, offsets[1:]):
+            self.assertEqual(offset + length, next_offset)
+
+        last_frame = self.NUM_FRAMES - 1
+        for (positions,) in cache.query(
+                'select positions from glotzformats_frames where frame = ?', (last_frame,)):
+            pass
+        np.testing.assert_allclose(positions[0], [1 + last_frame, 2 + last_frame, 3 + last_frame])
+
+    def test_frame_cache(self):
+        cache = pyq.Cache()
+        cache.index(pyq.mines.Directory(self.temp_dir.name))
+        cache.index(GlotzFormats(exclude_suffixes=['tar']))
+
+        GlotzFormats.get_frame_cache_().reset_stats()
+        count = 0
+        for (box, positions, types) in cache.query(
+                'select box, positions, types from glotzformats_frames'):
+            count += 1
+
+        self.assertEqual(count, self.NUM_FRAMES)
+        stats = GlotzFormats.get_frame_cache_stats()
+        self.assertEqual(stats['misses'], self.NUM_FRAMES)
+        self.assertEqual(stats['hits'], 2*self.NUM_FRAMES)
+
+    def test_frame_cache_read_only(self):
+        cache = pyq.Cache()
+        cache.index(pyq.mines.Directory(self.temp_dir.name))
+        cache.index(GlotzFormats(exclude_suffixes=['tar']))
+
+        query = 'select positions from glotzformats_frames order by file_id, frame limit 1'
+        for (positions,) in cache.query(query):
+            expected = positions.tolist()
+            # cached frames can't be modified through the results
+            with self.assertRaises(ValueError):
+                positions[0] = 0
+
+        for (positions,) in cache.query(query):
+            self.assertEqual(positions.tolist(), expected)
+
+    def test_statistics(self):
+        for processes in (None, 2):
+            cache = pyq.Cache()
+            cache.index(pyq.mines.Directory(self.temp_dir.name))
+            cache.index(GlotzFormats(exclude_suffixes=['tar'], statistics=True, processes=processes))
+
+            stats = {(frame, attribute): values for (frame, attribute, *values) in cache.query(
+                'select frame, attribute, length, size, shape, minimum, maximum '
+                'from glotzformats_frame_stats')}
+            last_frame = self.NUM_FRAMES - 1
+            self.assertEqual(stats[last_frame, 'positions'],
+                             [2, 6, '[2, 3]', -1 + last_frame, 3 + last_frame])
+            self.assertEqual(stats[0, 'types'][:3], [2, 2, '[2]'])
+
+            found = list(cache.query(
+                'select count(*) from glotzformats_frames join glotzformats_frame_stats '
+                'using (file_id, frame) where attribute = "box_volume" and mean = 1000'))
+            self.assertEqual(found, [(self.NUM_FRAMES,)])
+
 if __name__ == '__main__':
     unittest.main()
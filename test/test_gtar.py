@@ -1,15 +1,21 @@
+import concurrent.futures
 import json
 import os
+import sqlite3
 import tempfile
+import threading
+import time
 import unittest
+from unittest import mock
 
 import pyqaxe as pyq
 
 try:
     import gtar
+    import numpy as np
     from pyqaxe.mines.gtar import GTAR
 except ImportError:
-    gtar = GTAR = None
+    gtar = np = GTAR = None
 
 @unittest.skipIf(gtar is None, "Failed to import gtar")
 class GTARTests(unittest.TestCase):
@@ -48,6 +54,28 @@ class GTARTests(unittest.TestCase):
             cache.close()
 
             cache = pyq.Cache(f.name)
+            # mines with default options are stored in the same way as
+            # by older versions, so they are recognized again
+            self.assertEqual(GTAR().__getstate__(), [[r'\.']])
+            cache.index(GTAR())
+            self.assertEqual(len(cache.mines), 2)
+
+    def test_read_only_old_cache(self):
+        with tempfile.NamedTemporaryFile(suffix='.sqlite') as f:
+            cache = pyq.Cache(f.name)
+            cache.index(pyq.mines.Directory(self.temp_dir.name))
+            cache.index(GTAR())
+            cache.close()
+
+            # tables added by later versions
+            with sqlite3.connect(f.name) as conn:
+                conn.execute('DROP TABLE gtar_record_stats')
+            conn.close()
+
+            cache = pyq.Cache(f.name, read_only=True)
+            for (data,) in cache.query('select data from gtar_records '
+                                       'where name = "position" limit 1'):
+                self.assertEqual(data.shape, (2, 3))
 
     def test_read_data(self):
         cache = pyq.Cache()
@@ -86,6 +114,149 @@ class GTARTests(unittest.TestCase):
 
         self.assertEqual(new_cache_size, cache_owner.get_cache_size())
 
+    def test_data_cache(self):
+        cache = pyq.Cache()
+        cache.index(pyq.mines.Directory(self.temp_dir.name))
+        cache.index(GTAR())
+
+        GTAR.set_data_cache_bytes(1024*1024)
+        try:
+            old_hits = GTAR.get_data_cache_stats()['hits']
+            for _ in range(2):
+                for (positions,) in cache.query(
+                        'select data from gtar_records where name = "position"'):
+                    with self.assertRaises(ValueError):
+                        positions[0][0] = 3
+            self.assertEqual(GTAR.get_data_cache_stats()['hits'] - old_hits, 2)
+        finally:
+            GTAR.set_data_cache_bytes(None)
+
+    def test_data_cache_threads(self):
+        import pyqaxe.mines.gtar as gtar_mine
+
+        cache = pyq.Cache()
+        cache.index(pyq.mines.Directory(self.temp_dir.name))
+        cache.index(GTAR())
+
+        (started, release) = (threading.Event(), threading.Event())
+        read_gtar_record = gtar_mine.read_gtar_record
+
+        def slow_read(cache_id, file_row, path):
+            if path.endswith('orientation.f32.ind'):
+                started.set()
+                self.assertTrue(release.wait(10))
+            return read_gtar_record(cache_id, file_row, path)
+
+        def read(name):
+            return [row[0] for row in cache.query(
+                'select data from gtar_records where name = ?', (name,))]
+
+        GTAR.set_data_cache_bytes(1024*1024)
+        try:
+            with mock.patch.object(gtar_mine, 'read_gtar_record', slow_read), \
+                 concurrent.futures.ThreadPoolExecutor(2) as pool:
+                slow = pool.submit(read, 'orientation')
+                self.assertTrue(started.wait(10))
+                # other records are decoded while the first one is
+                positions = pool.submit(read, 'position').result(10)
+                release.set()
+                orientations = slow.result(10)
+        finally:
+            release.set()
+            GTAR.set_data_cache_bytes(None)
+
+        self.assertEqual(len(positions), 2)
+        self.assertEqual(orientations[0].shape, (2, 4))
+
+    def test_query_arrays(self):
+        cache = pyq.Cache()
+        cache.index(pyq.mines.Directory(self.temp_dir.name))
+        cache.index(GTAR())
+
+        query = ('select gtar_index, data from gtar_records where name = "position" '
+                 'order by file_id, gtar_index_key')
+        (indices, positions) = cache.query_arrays(query)
+
+        rows = list(cache.query(query))
+        self.assertEqual(list(indices), [row[0] for row in rows])
+        self.assertEqual(positions.shape, (len(rows), 2, 3))
+        for (stacked, row) in zip(positions, rows):
+            self.assertEqual(stacked.tolist(), row[1].tolist())
+
+        with self.assertRaises(ValueError):
+            cache.query_arrays('select data from gtar_records where name = "position" '
+                               'or name = "orientation"')
+
+        # the first frame has no orientations
+        (indices, orientations) = cache.query_arrays(
+            'select gtar_index, orientation from gtar_frames order by gtar_index_key')
+        self.assertEqual(indices[0], '')
+        self.assertEqual(orientations.shape, (len(indices), 2, 4))
+        for (index, orientation) in zip(indices, orientations):
+            self.assertEqual(np.isnan(orientation).all(), index != '10')
+
+        with self.assertRaises(ValueError):
+            cache.query_arrays('select orientation from gtar_frames', fill_value='a')
+
+    def test_query_arrays_mixed_types(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            with gtar.GTAR(os.path.join(dirname, 'test.zip'), 'w') as traj:
+                traj.writePath('frames/0/value.i32.ind', [1, 2])
+                traj.writePath('frames/1/value.f32.ind', [1.5, 2.5])
+
+            cache = pyq.Cache()
+            cache.index(pyq.mines.Directory(dirname))
+            cache.index(GTAR())
+
+            (values,) = cache.query_arrays(
+                'select data from gtar_records where name = "value" order by gtar_index_key')
+            # floats after integers aren't truncated
+            self.assertEqual(values.dtype.kind, 'f')
+            self.assertEqual(values.tolist(), [[1, 2], [1.5, 2.5]])
+
+    def test_query_prefetched(self):
+        cache = pyq.Cache()
+        cache.index(pyq.mines.Directory(self.temp_dir.name))
+        cache.index(GTAR())
+
+        query = ('select path, gtar_index, data from gtar_records where name = "position" '
+                 'order by file_id, gtar_index_key')
+        expected = list(cache.query(query))
+        self.assertGreater(len(expected), 1)
+
+        for prefetch in (1, 2, 64):
+            found = list(cache.query_prefetched(query, prefetch=prefetch))
+            self.assertEqual([row[:2] for row in found], [row[:2] for row in expected])
+            for (row, expected_row) in zip(found, expected):
+                self.assertEqual(row[2].tolist(), expected_row[2].tolist())
+
+        # worker threads (and their connections) are reused between calls
+        connection_count = len(cache.connections_)
+        for _ in range(4):
+            list(cache.query_prefetched(query))
+        self.assertEqual(len(cache.decode_pools_), 1)
+        self.assertEqual(len(cache.connections_), connection_count)
+
+        # stopping early doesn't leave conversion deferred
+        for row in cache.query_prefetched(query):
+            break
+        for row in cache.query(query):
+            self.assertEqual(row[2].shape, (2, 3))
+
+    def test_iter_batches(self):
+        cache = pyq.Cache()
+        cache.index(pyq.mines.Directory(self.temp_dir.name))
+        cache.index(GTAR())
+
+        query = ('select path, gtar_index, data from gtar_records where name = "position" '
+                 'order by file_id, gtar_index_key')
+        expected = list(cache.query(query))
+
+        found = [row for batch in cache.iter_batches(query, batch_size=1) for row in batch]
+        self.assertEqual([row[:2] for row in found], [row[:2] for row in expected])
+        for (row, expected_row) in zip(found, expected):
+            self.assertEqual(row[2].tolist(), expected_row[2].tolist())
+
     def test_inside_tar_archive(self):
         cache = pyq.Cache()
         cache.index(pyq.mines.TarFile(self.nested_tar_name))
@@ -132,5 +303,208 @@ class GTARTests(unittest.TestCase):
                 pass
             self.assertEqual(frame_count, 1)
 
+    def test_gtar_frames_update(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            with gtar.GTAR(os.path.join(dirname, 'first.zip'), 'w') as traj:
+                traj.writePath('frames/1/position.f32.ind', [[0, 0, 0]])
+
+            cache = pyq.Cache()
+            directory = pyq.mines.Directory(dirname)
+            gtar_mine = GTAR()
+            cache.index(directory)
+            cache.index(gtar_mine)
+
+            with gtar.GTAR(os.path.join(dirname, 'second.zip'), 'w') as traj:
+                traj.writePath('frames/1/position.f32.ind', [[1, 1, 1]])
+                traj.writePath('frames/2/velocity.f32.ind', [[2, 2, 2]])
+            # coarse filesystem timestamps can otherwise date the new
+            # file before the last index of the mine
+            newer = time.time() + 10
+            os.utime(os.path.join(dirname, 'second.zip'), (newer, newer))
+
+            cache.index(directory, force=True)
+            cache.index(gtar_mine, force=True)
+
+            rows = list(cache.query(
+                'select gtar_index, position, velocity from gtar_frames '
+                'order by file_id, gtar_index collate gtar_frame'))
+            self.assertEqual(len(rows), 3)
+            self.assertEqual(rows[0][2], None)
+            # position is carried forward from frame 1
+            self.assertEqual(rows[2][1][0][0], 1)
+            self.assertEqual(rows[2][2][0][0], 2)
+
+    def test_index_key(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            with gtar.GTAR(os.path.join(dirname, 'test.zip'), 'w') as traj:
+                for index in ['9', '10', '100', '11', '2']:
+                    traj.writePath('frames/{}/position.f32.ind'.format(index), [[0, 0, 0]])
+
+            cache = pyq.Cache()
+            cache.index(pyq.mines.Directory(dirname))
+            cache.index(GTAR())
+
+            collated = [row[0] for row in cache.query(
+                'select gtar_index from gtar_records order by gtar_index collate gtar_frame')]
+            keyed = [row[0] for row in cache.query(
+                'select gtar_index from gtar_records order by gtar_index_key')]
+            self.assertEqual(collated, ['2', '9', '10', '11', '100'])
+            self.assertEqual(keyed, collated)
+
+            selected = [row[0] for row in cache.query(
+                'select gtar_index from gtar_frames where gtar_index_key between '
+                'gtar_frame_key("9") and gtar_frame_key("11") order by gtar_index_key')]
+            self.assertEqual(selected, ['9', '10', '11'])
+
+    def test_processes(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            for i in range(5):
+                fname = os.path.join(dirname, 'test_{}.zip'.format(i))
+                with gtar.GTAR(fname, 'w') as traj:
+                    for index in range(i + 1):
+                        traj.writePath('frames/{}/position.f32.ind'.format(index), [[i, 0, 0]])
+            with open(os.path.join(dirname, 'corrupt.zip'), 'wb') as f:
+                f.write(b'not a zip file')
+
+            results = []
+            for processes in (None, 2):
+                cache = pyq.Cache()
+                cache.index(pyq.mines.Directory(dirname))
+                with self.assertLogs('pyqaxe.mines.gtar', 'WARNING'):
+                    cache.index(GTAR(processes=processes))
+                results.append(list(cache.query(
+                    'select gtar_records.path, gtar_group, gtar_index, gtar_index_key, name, '
+                    'files.path from gtar_records join files on file_id = files.rowid '
+                    'order by gtar_records.rowid')))
+
+            self.assertEqual(len(results[0]), 15)
+            self.assertEqual(results[0], results[1])
+
+    def test_statistics(self):
+        for processes in (None, 2):
+            with tempfile.NamedTemporaryFile(suffix='.sqlite') as f:
+                cache = pyq.Cache(f.name)
+                cache.index(pyq.mines.Directory(self.temp_dir.name))
+                cache.index(GTAR(statistics=True, processes=processes))
+                cache.close()
+
+                # the option persists when the cache is reopened
+                cache = pyq.Cache(f.name)
+                self.assertTrue(any(getattr(mine, 'statistics', False)
+                                    for mine in cache.mines.values()))
+
+                stats = {row[0]: row[1:] for row in cache.query(
+                    'select gtar_record_stats.path, length, size, ndim, shape, dtype, '
+                    'minimum, maximum, mean '
+                    'from gtar_record_stats join files on file_id = files.rowid '
+                    'where files.path like "%test.zip"')}
+                self.assertEqual(stats['frames/10/position.f32.ind'],
+                                 (2, 6, 2, '[2, 3]', 'float32', -1, 3, 10/6))
+                self.assertEqual(stats['test.json'][:5], (18, 18, 1, '[18]', 'str'))
+
+                found = [row[0] for row in cache.query(
+                    'select gtar_index from gtar_records join gtar_record_stats '
+                    'using (file_id, path) where name = "orientation" and maximum = 1')]
+                self.assertEqual(found, ['10'])
+
+        cache = pyq.Cache()
+        cache.index(pyq.mines.Directory(self.temp_dir.name))
+        cache.index(GTAR())
+        for (count,) in cache.query('select count(*) from gtar_record_stats'):
+            self.assertEqual(count, 0)
+
+    def test_corrupt_record(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            fname = os.path.join(dirname, 'corrupt.zip')
+            with gtar.GTAR(fname, 'w') as traj:
+                traj.writePath('position.f32.ind', [[1, 2, 3]]*100)
+            with gtar.GTAR(os.path.join(dirname, 'valid.zip'), 'w') as traj:
+                traj.writePath('position.f32.ind', [[1, 2, 3]])
+
+            # overwrite the compressed data of the record, keeping
+            # the archive's directory intact
+            with open(fname, 'r+b') as f:
+                f.seek(30 + len('position.f32.ind'))
+                f.write(b'\xff'*16)
+
+            results = []
+            for processes in (None, 2):
+                cache = pyq.Cache()
+                cache.index(pyq.mines.Directory(dirname))
+                with self.assertLogs('pyqaxe.mines.gtar', 'WARNING'):
+                    cache.index(GTAR(statistics=True, processes=processes))
+                results.append(list(cache.query(
+                    'select files.path, gtar_record_stats.path from gtar_record_stats '
+                    'join files on file_id = files.rowid')))
+
+            self.assertEqual(len(results[0]), 1)
+            self.assertEqual(results[0], results[1])
+
+    def test_inline_bytes(self):
+        query = ('select gtar_records.path, data from gtar_records '
+                 'join files on file_id = files.rowid where files.path like "%test.zip" '
+                 'order by gtar_records.path')
+
+        cache = pyq.Cache()
+        cache.index(pyq.mines.Directory(self.temp_dir.name))
+        cache.index(GTAR())
+        expected = dict(cache.query(query))
+
+        for processes in (None, 2):
+            with tempfile.NamedTemporaryFile(suffix='.sqlite') as f:
+                cache = pyq.Cache(f.name)
+                cache.index(pyq.mines.Directory(self.temp_dir.name))
+                # orientations (32 bytes) are too large to be stored
+                cache.index(GTAR(inline_bytes=32, processes=processes))
+                cache.close()
+
+                cache = pyq.Cache(f.name)
+                self.assertEqual([mine.inline_bytes for mine in cache.mines.values()
+                                  if isinstance(mine, GTAR)], [32])
+                GTAR.opened_trajectories_.clear()
+                GTAR.opened_trajectories_.reset_stats()
+
+                found = dict(cache.query(query.replace(
+                    'order by', 'and name != "orientation" order by')))
+                self.assertEqual(GTAR.opened_trajectories_.stats()['misses'], 0)
+
+                found.update(cache.query(query))
+                self.assertEqual(GTAR.opened_trajectories_.stats()['misses'], 1)
+
+                self.assertEqual(sorted(found), sorted(expected))
+                for (path, data) in expected.items():
+                    if hasattr(data, 'tolist'):
+                        self.assertEqual(found[path].dtype, data.dtype)
+                        (data, found[path]) = (data.tolist(), found[path].tolist())
+                    self.assertEqual(found[path], data)
+
+    def test_inline_bytes_formats(self):
+        import pyqaxe.mines.gtar as gtar_mine
+
+        with tempfile.TemporaryDirectory() as dirname:
+            for suffix in ('zip', 'tar', 'sqlite'):
+                with gtar.GTAR(os.path.join(dirname, 'test.{}'.format(suffix)), 'w') as traj:
+                    traj.writePath('box.f32.uni', [1, 1, 1, 0, 0, 0])
+                    traj.writePath('position.f32.ind', np.zeros((1024, 3)))
+
+                # records are measured without being read
+                sizes = gtar_mine.gtar_record_sizes(os.path.join(dirname, 'test.{}'.format(suffix)))
+                self.assertEqual(sizes, {'box.f32.uni': 24, 'position.f32.ind': 1024*3*4})
+
+            cache = pyq.Cache()
+            cache.index(pyq.mines.Directory(dirname))
+            cache.index(GTAR(inline_bytes=1024))
+
+            GTAR.opened_trajectories_.clear()
+            GTAR.opened_trajectories_.reset_stats()
+            boxes = [data.tolist() for (data,) in cache.query(
+                'select data from gtar_records where name = "box"')]
+            self.assertEqual(boxes, 3*[[1, 1, 1, 0, 0, 0]])
+            self.assertEqual(GTAR.opened_trajectories_.stats()['misses'], 0)
+
+            for (data,) in cache.query('select data from gtar_records where name = "position"'):
+                self.assertEqual(data.shape, (1024, 3))
+            self.assertEqual(GTAR.opened_trajectories_.stats()['misses'], 3)
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,10 +1,16 @@
 import os
+import sqlite3
 import tarfile
 import tempfile
 import unittest
 
 import pyqaxe as pyq
 
+try:
+    import indexed_gzip
+except ImportError:
+    indexed_gzip = None
+
 class TarFileTests(unittest.TestCase):
     file_contents = {
         'test1.txt': 'test 1',
@@ -88,5 +94,146 @@ class TarFileTests(unittest.TestCase):
                              number_of_tarfiles*(len(self.file_contents) - 1))
         self.assertEqual(count, number_of_entries)
 
+    def test_member_locations(self):
+        with tempfile.NamedTemporaryFile(suffix='.sqlite') as f:
+            cache = pyq.Cache(f.name)
+            cache.index(pyq.mines.TarFile(self.example_tar_name))
+            cache.close()
+
+            cache = pyq.Cache(f.name)
+            locations = list(cache.query('select path, size from tarfile_members'))
+            self.assertEqual(len(locations), len(self.file_contents) - 1)
+            for (fname, size) in locations:
+                self.assertEqual(size, len(self.file_contents[fname]))
+
+            for row in cache.query('select path, * from files where path like "%.txt"'):
+                (fname, row) = row[0], row[1:]
+                with cache.open_file(row) as opened:
+                    self.assertEqual(self.file_contents[fname], opened.read())
+                    opened.seek(2)
+                    self.assertEqual(self.file_contents[fname][2:], opened.read())
+
+            # members were read without opening the archive with tarfile
+            for row in cache.query('select * from files where path like "%.tar"'):
+                archive = cache.open_file(row, 'rb')
+                self.assertNotIn(archive, pyq.mines.TarFile.opened_tarfiles_)
+
+    def test_read_only_old_cache(self):
+        with tempfile.NamedTemporaryFile(suffix='.sqlite') as f:
+            cache = pyq.Cache(f.name)
+            cache.index(pyq.mines.TarFile(self.example_tar_name))
+            cache.close()
+
+            # tables added by later versions
+            with sqlite3.connect(f.name) as conn:
+                conn.execute('DROP TABLE tarfile_members')
+                conn.execute('DROP TABLE tarfile_checkpoints')
+            conn.close()
+
+            cache = pyq.Cache(f.name, read_only=True)
+            for row in cache.query('select path, * from files where path like "%.txt"'):
+                (fname, row) = row[0], row[1:]
+                with cache.open_file(row) as opened:
+                    self.assertEqual(self.file_contents[fname], opened.read())
+
+    def test_map_file(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            nested_name = os.path.join(dirname, 'nested.tar')
+            with tarfile.open(nested_name, 'w') as tf:
+                tf.add(self.example_tar_name, arcname='inner.tar')
+
+            cache = pyq.Cache()
+            cache.index(pyq.mines.TarFile(nested_name))
+            cache.index(pyq.mines.TarFile())
+
+            for row in cache.query('select * from files where parent is null'):
+                with open(nested_name, 'rb') as f:
+                    self.assertEqual(cache.map_file(row), f.read())
+
+            run_count = 0
+            for row in cache.query('select path, * from files where path like "%.txt"'):
+                (fname, row) = row[0], row[1:]
+                view = cache.map_file(row)
+                self.assertTrue(view.readonly)
+                self.assertEqual(view.tobytes().decode(), self.file_contents[fname])
+                run_count += 1
+
+            self.assertEqual(run_count, len(self.file_contents) - 1)
+
+    def test_extract_dir(self):
+        with tempfile.NamedTemporaryFile(suffix='.sqlite') as f, \
+             tempfile.TemporaryDirectory() as extract_dir:
+            cache = pyq.Cache(f.name, extract_dir=extract_dir)
+            cache.index(pyq.mines.TarFile(self.example_tar_name))
+
+            names = []
+            for row in cache.query('select path, * from files where path like "%.txt"'):
+                (fname, row) = row[0], row[1:]
+                with cache.open_file(row, named=True) as opened:
+                    self.assertEqual(opened.read(), self.file_contents[fname])
+                    names.append(opened.name)
+            cache.close()
+
+            self.assertEqual(len(os.listdir(extract_dir)), len(self.file_contents) - 1)
+
+            cache = pyq.Cache(f.name, extract_dir=extract_dir)
+            for row in cache.query('select * from files where path like "%.txt"'):
+                with cache.open_file(row, named=True) as opened:
+                    self.assertIn(opened.name, names)
+
+    def test_compressed(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            names = ['test.tar.gz', 'test.tgz', 'test.tar.bz2', 'test.tar.xz']
+            for (name, compression) in zip(names, ['gz', 'gz', 'bz2', 'xz']):
+                mode = 'w:{}'.format(compression)
+                with tarfile.open(os.path.join(dirname, name), mode) as tf:
+                    for fname in self.file_contents:
+                        tf.add(os.path.join(self.temp_dir.name, fname), arcname=fname)
+
+            cache = pyq.Cache()
+            cache.index(pyq.mines.Directory(dirname))
+            cache.index(pyq.mines.TarFile())
+
+            run_count = 0
+            for row in cache.query('select path, * from files where path like "%.txt"'):
+                (fname, row) = row[0], row[1:]
+                with cache.open_file(row) as f:
+                    self.assertEqual(self.file_contents[fname], f.read())
+                run_count += 1
+
+            self.assertEqual(run_count, len(names)*len(self.file_contents))
+
+    @unittest.skipIf(indexed_gzip is None, "Failed to import indexed_gzip")
+    def test_gzip_checkpoints(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            names = ['test.tar.gz', 'test.tgz', 'test.tar.bz2']
+            for (name, compression) in zip(names, ['gz', 'gz', 'bz2']):
+                mode = 'w:{}'.format(compression)
+                with tarfile.open(os.path.join(dirname, name), mode) as tf:
+                    for fname in self.file_contents:
+                        tf.add(os.path.join(self.temp_dir.name, fname), arcname=fname)
+
+            cache = pyq.Cache()
+            cache.index(pyq.mines.Directory(dirname))
+            cache.index(pyq.mines.TarFile())
+
+            # only gzip-compressed archives have checkpoints
+            for (count,) in cache.query('select count(*) from tarfile_checkpoints'):
+                self.assertEqual(count, 2)
+
+            # gzip members were read from checkpoints in a new stream
+            pyq.mines.TarFile.opened_gzips_.clear()
+            for row in cache.query('select path, * from files where path like "%.txt"'):
+                (fname, row) = row[0], row[1:]
+                with cache.open_file(row, 'rb') as f:
+                    self.assertEqual(self.file_contents[fname].encode(), f.read())
+                    f.seek(2)
+                    self.assertEqual(self.file_contents[fname][2:].encode(), f.read())
+
+            for row in cache.query('select * from files where path like "%gz"'):
+                archive = cache.open_file(row, 'rb')
+                self.assertIn(archive, pyq.mines.TarFile.opened_gzips_)
+                self.assertNotIn(archive, pyq.mines.TarFile.opened_tarfiles_)
+
 if __name__ == '__main__':
     unittest.main()
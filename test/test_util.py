@@ -0,0 +1,243 @@
+import concurrent.futures
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+from pyqaxe.util import BatchWriter, ExtractionDirectory, LRU_Cache
+
+class LRUCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.finalized = []
+        self.cache = LRU_Cache(lambda x: [x], self.finalized.append, 2)
+
+    def test_evict_oldest(self):
+        self.cache(1)
+        self.cache(2)
+        self.cache(1)
+        self.cache(3)
+
+        self.assertEqual(self.finalized, [[2]])
+        self.assertEqual(len(self.cache), 2)
+        self.assertEqual(self.cache.stats()['evictions'], 1)
+
+    def test_hits_misses(self):
+        first = self.cache(1)
+        self.assertIs(self.cache(1), first)
+        self.cache(2)
+
+        stats = self.cache.stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 2)
+
+    def test_pin(self):
+        pinned = self.cache.pin(1)
+        for i in range(2, 6):
+            self.cache(i)
+
+        self.assertNotIn(pinned, self.finalized)
+        self.assertIs(self.cache(1), pinned)
+
+        self.cache.unpin(1)
+        self.cache(6)
+        self.cache(7)
+        self.assertIn(pinned, self.finalized)
+
+    def test_max_bytes(self):
+        cache = LRU_Cache(lambda x: [x]*x, self.finalized.append, 16,
+                          max_bytes=10, sizer=len)
+        cache(4)
+        cache(5)
+        self.assertEqual(self.finalized, [])
+        cache(3)
+        self.assertEqual(self.finalized, [[4]*4])
+        self.assertEqual(cache.total_bytes, 8)
+
+    def test_clear(self):
+        self.cache.pin(1)
+        self.cache(2)
+        self.cache.clear()
+
+        self.assertEqual(len(self.cache), 0)
+        self.assertEqual(sorted(self.finalized), [[1], [2]])
+
+    def test_concurrent_generation(self):
+        release = threading.Event()
+        calls = []
+
+        def generate(x):
+            calls.append(x)
+            if x == 1:
+                # block until another thread has used the cache
+                self.assertTrue(release.wait(10))
+            return [x]
+
+        cache = LRU_Cache(generate, self.finalized.append, 4)
+        with concurrent.futures.ThreadPoolExecutor(4) as pool:
+            slow = [pool.submit(cache, 1), pool.submit(cache.pin, 1)]
+            # other values can be generated while 1 is being generated
+            self.assertEqual(pool.submit(cache, 2).result(10), [2])
+            release.set()
+            (first, second) = [future.result(10) for future in slow]
+
+        # the value is only generated once and shared between threads
+        self.assertIs(first, second)
+        self.assertEqual(sorted(calls), [1, 2])
+        self.assertEqual(cache.stats()['pinned'], 1)
+
+    def test_generator_error(self):
+        def generate(x):
+            raise ValueError(x)
+
+        cache = LRU_Cache(generate, self.finalized.append, 4)
+        for _ in range(2):
+            with self.assertRaises(ValueError):
+                cache(1)
+        self.assertEqual(cache.stats()['misses'], 2)
+
+    def test_clear_during_generation(self):
+        started = threading.Event()
+        release = threading.Event()
+        generated = []
+
+        def generate(x):
+            generated.append(x)
+            if len(generated) == 1:
+                started.set()
+                self.assertTrue(release.wait(10))
+            return [len(generated)]
+
+        cache = LRU_Cache(generate, self.finalized.append, 4)
+        with concurrent.futures.ThreadPoolExecutor(1) as pool:
+            slow = pool.submit(cache, 1)
+            self.assertTrue(started.wait(10))
+            cache.clear()
+            release.set()
+            # the value generated before the clear is discarded
+            self.assertEqual(slow.result(10), [2])
+
+        self.assertEqual(self.finalized, [[1]])
+        self.assertEqual(cache(1), [2])
+        self.assertEqual(cache.stats()['size'], 1)
+
+class BatchWriterTests(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = sqlite3.connect(':memory:')
+        self.conn.execute('CREATE TABLE test (a INTEGER, b TEXT)')
+
+    def count(self):
+        for (count,) in self.conn.execute('SELECT count(*) FROM test'):
+            return count
+
+    def test_chunks(self):
+        writer = BatchWriter(self.conn, chunk_size=3)
+        for i in range(4):
+            writer.insert('test', (i, str(i)))
+
+        self.assertEqual(self.count(), 3)
+        self.assertEqual(len(writer), 1)
+
+        writer.flush()
+        self.assertEqual(self.count(), 4)
+
+    def test_returning(self):
+        with BatchWriter(self.conn) as writer:
+            writer.insert('test', (0, 'a'))
+            rowid = writer.insert('test', (1, 'b'), returning=True)
+
+            # returning flushes the previously-buffered rows first
+            self.assertEqual(self.count(), 2)
+
+        for (a,) in self.conn.execute('SELECT a FROM test WHERE rowid = ?', (rowid,)):
+            self.assertEqual(a, 1)
+
+    def test_flush_interval(self):
+        flushed = []
+        writer = BatchWriter(self.conn, chunk_size=100, on_flush=flushed.append,
+                             flush_interval=0)
+        writer.insert('test', (0, 'a'))
+
+        # rows are written once the interval has passed, however few
+        self.assertEqual(self.count(), 1)
+        self.assertEqual(flushed, [['test']])
+
+class ExtractionDirectoryTests(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.writes = []
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def writer(self, contents):
+        def write(f):
+            self.writes.append(contents)
+            f.write(contents)
+        return write
+
+    def test_reuse(self):
+        extracted = ExtractionDirectory(self.temp_dir.name)
+        for _ in range(2):
+            with extracted.open(['a', 1], 'a.txt', 'rb', self.writer(b'abc')) as f:
+                self.assertTrue(f.name.endswith('a.txt'))
+                self.assertEqual(f.read(), b'abc')
+
+        self.assertEqual(self.writes, [b'abc'])
+
+        # a separate object sharing the same directory reuses the copy
+        extracted = ExtractionDirectory(self.temp_dir.name)
+        with extracted.open(['a', 1], 'a.txt', 'r', self.writer(b'abc')) as f:
+            self.assertEqual(f.read(), 'abc')
+        self.assertEqual(len(self.writes), 1)
+
+    def test_max_bytes(self):
+        extracted = ExtractionDirectory(self.temp_dir.name, max_bytes=8)
+        for key in range(3):
+            extracted.open([key], 'test', 'rb', self.writer(b'1234')).close()
+            # make sure modification times differ
+            os.utime(extracted.get_path_([key], 'test'), (key, key))
+
+        self.assertEqual(extracted.total_bytes, 8)
+        self.assertFalse(os.path.exists(extracted.get_path_([0], 'test')))
+        self.assertTrue(os.path.exists(extracted.get_path_([2], 'test')))
+
+    def test_concurrent_trim(self):
+        extracted = ExtractionDirectory(self.temp_dir.name)
+        target = extracted.get_path_(['a'], 'a.txt')
+
+        replace = os.replace
+        def replace_and_trim(src, dst):
+            replace(src, dst)
+            # another process trims the first copy as soon as it appears
+            if len(self.writes) == 1:
+                os.unlink(dst)
+
+        with mock.patch('os.replace', replace_and_trim):
+            with extracted.open(['a'], 'a.txt', 'rb', self.writer(b'abc')) as f:
+                self.assertEqual(f.read(), b'abc')
+                self.assertEqual(f.name, target)
+        self.assertEqual(self.writes, [b'abc', b'abc'])
+
+    def test_stale_temporaries(self):
+        extracted = ExtractionDirectory(self.temp_dir.name)
+        stale = os.path.join(self.temp_dir.name, '.stale-test')
+        fresh = os.path.join(self.temp_dir.name, '.fresh-test')
+        for name in (stale, fresh):
+            with open(name, 'wb') as f:
+                f.write(b'partial')
+        old = time.time() - 2*extracted.TEMPORARY_MAX_AGE
+        os.utime(stale, (old, old))
+
+        extracted.open(['a'], 'a.txt', 'rb', self.writer(b'abc')).close()
+        self.assertFalse(os.path.exists(stale))
+        self.assertTrue(os.path.exists(fresh))
+        self.assertEqual(extracted.total_bytes, 3)
+
+if __name__ == '__main__':
+    unittest.main()
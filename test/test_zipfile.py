@@ -0,0 +1,132 @@
+import os
+import tempfile
+import unittest
+import zipfile
+
+import pyqaxe as pyq
+
+class ZipFileTests(unittest.TestCase):
+    file_contents = {
+        'test1.txt': 'test 1',
+        'test2.txt': 'test 2',
+        'dir/test3.txt': 'test 3 abcd'*1024,
+        'test4.json': '{}',
+    }
+
+    @classmethod
+    def setUpClass(cls):
+        cls.temp_dir = tempfile.TemporaryDirectory()
+
+        cls.example_zip_name = os.path.join(cls.temp_dir.name, 'test.zip')
+        with zipfile.ZipFile(cls.example_zip_name, 'w') as zf:
+            for (i, fname) in enumerate(sorted(cls.file_contents)):
+                compression = zipfile.ZIP_DEFLATED if i%2 else zipfile.ZIP_STORED
+                zf.writestr(fname, cls.file_contents[fname], compression)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.temp_dir.cleanup()
+
+    def test_restore(self):
+        with tempfile.NamedTemporaryFile(suffix='.sqlite') as f:
+            cache = pyq.Cache(f.name)
+            cache.index(pyq.mines.ZipFile(self.example_zip_name))
+            cache.close()
+
+            cache = pyq.Cache(f.name)
+
+    def test_read(self):
+        with tempfile.NamedTemporaryFile(suffix='.sqlite') as f:
+            cache = pyq.Cache(f.name)
+            cache.index(pyq.mines.ZipFile(self.example_zip_name))
+            cache.close()
+
+            cache = pyq.Cache(f.name)
+            run_count = 0
+            for row in cache.query('select path, * from files where parent notnull'):
+                (fname, row) = row[0], row[1:]
+                with cache.open_file(row) as opened:
+                    self.assertEqual(self.file_contents[fname], opened.read())
+                with cache.open_file(row, 'rb') as opened:
+                    opened.seek(5)
+                    self.assertEqual(self.file_contents[fname][5:10].encode(), opened.read(5))
+                    opened.seek(1)
+                    self.assertEqual(self.file_contents[fname][1:].encode(), opened.read())
+                run_count += 1
+
+            self.assertEqual(run_count, len(self.file_contents))
+
+            # members were read without opening the archive with zipfile
+            for row in cache.query('select * from files where path like "%.zip"'):
+                archive = cache.open_file(row, 'rb')
+                self.assertNotIn(archive, pyq.mines.ZipFile.opened_zipfiles_)
+
+    def test_map_file(self):
+        cache = pyq.Cache()
+        cache.index(pyq.mines.ZipFile(self.example_zip_name))
+
+        mapped = 0
+        for row in cache.query('select path, * from files where parent notnull'):
+            (fname, row) = row[0], row[1:]
+            view = cache.map_file(row)
+            self.assertEqual(view.tobytes().decode(), self.file_contents[fname])
+            mapped += 1
+
+        self.assertEqual(mapped, len(self.file_contents))
+        # stored members are sliced from a single mapping of the archive
+        self.assertEqual(cache.mapped_files_.stats()['misses'], 1)
+
+    def test_with_directory(self):
+        cache = pyq.Cache()
+        cache.index(pyq.mines.Directory(self.temp_dir.name))
+        cache.index(pyq.mines.ZipFile(exclude_regexes=['^dir/'], exclude_suffixes=['json']))
+
+        found = [row[0] for row in cache.query(
+            'select path from files where parent notnull order by path')]
+        self.assertEqual(found, ['test1.txt', 'test2.txt'])
+
+    def test_zero_date(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            zip_name = os.path.join(dirname, 'zero.zip')
+            with zipfile.ZipFile(zip_name, 'w') as zf:
+                zf.writestr(zipfile.ZipInfo('zero.txt', date_time=(1980, 0, 0, 0, 0, 0)), 'zero')
+                zf.writestr('valid.txt', 'valid')
+
+            cache = pyq.Cache()
+            cache.index(pyq.mines.ZipFile(zip_name))
+
+            (archive_time,) = next(cache.query(
+                'select update_time from files where parent is null'))
+            times = dict(cache.query('select path, update_time from files where parent notnull'))
+            self.assertEqual(set(times), {'zero.txt', 'valid.txt'})
+            self.assertEqual(times['zero.txt'], archive_time)
+
+            for row in cache.query('select * from files where path = "zero.txt"'):
+                with cache.open_file(row) as opened:
+                    self.assertEqual(opened.read(), 'zero')
+
+    def test_exclude_archives(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            for name in ['archive.zip', 'dump.zip']:
+                with zipfile.ZipFile(os.path.join(dirname, name), 'w') as zf:
+                    zf.writestr('{}.txt'.format(name), 'contents')
+
+            with tempfile.NamedTemporaryFile(suffix='.sqlite') as f:
+                cache = pyq.Cache(f.name)
+                cache.index(pyq.mines.Directory(dirname))
+                mine = pyq.mines.ZipFile(exclude_archive_regexes=[r'dump\.zip$'])
+                cache.index(mine)
+                cache.close()
+
+                cache = pyq.Cache(f.name)
+                found = [row[0] for row in cache.query(
+                    'select path from files where parent notnull')]
+                self.assertEqual(found, ['archive.zip.txt'])
+
+                restored = [m for m in cache.mines.values()
+                            if isinstance(m, pyq.mines.ZipFile)]
+                self.assertEqual(restored[0].__getstate__(), mine.__getstate__())
+                cache.close()
+
+if __name__ == '__main__':
+    unittest.main()